@@ -1,15 +1,20 @@
-from sqlalchemy.orm import registry, joinedload, class_mapper
+from sqlalchemy.orm import registry, class_mapper
+from sqlalchemy.orm.attributes import instance_state
 from sqlalchemy.orm.collections import InstrumentedList
 
 from ClassyFlaskDB.helpers.Decorators.LazyDecorator import LazyDecorator
 from ClassyFlaskDB.helpers.Decorators.capture_field_info import capture_field_info
 from ClassyFlaskDB.helpers.resolve_type import TypeResolver
 from ClassyFlaskDB.helpers.Decorators.AnyParam import AnyParam
-from ClassyFlaskDB.DATA.DATAEngine import DATAEngine
-from ClassyFlaskDB.helpers.Decorators.to_sql import to_sql
+from ClassyFlaskDB.DATA.EnginePool import EnginePool
+from ClassyFlaskDB.helpers.Decorators.to_sql import to_sql, list_items_key, list_rows_key
 from ClassyFlaskDB.DATA.ID_Type import ID_Type
+from ClassyFlaskDB.DATA.dirty_tracking import track_dirty_fields
+from ClassyFlaskDB.DATA.materializer import materialize
+from ClassyFlaskDB.DATA.table_json import to_table_json, from_table_json
+from sqlalchemy import event
 
-from dataclasses import dataclass, is_dataclass
+from dataclasses import dataclass
 from copy import deepcopy
 
 from typing import Any, Dict, Iterable, List, Type, TypeVar
@@ -24,7 +29,12 @@ class DATADecorator(AnyParam):
         self.mapper_registry = registry()
         TypeResolver.append_globals(globals())
         
+        # Made up front (it holds no engines until one is needed) so that
+        # threads calling to_json at once all share the one pool:
+        self._scratch_engines = EnginePool(self)
+        
         self._finalized = False
+        self._needs_engine_for_json = None
     
     def finalize(self, globals_return:Dict[str, Any]=None) -> None:
         if globals_return:
@@ -34,14 +44,44 @@ class DATADecorator(AnyParam):
         self.lazy["default"](self.mapper_registry)
         self.lazy.clear_group("default")
         self._finalized = True
+        
+        # Worked out once per set of decorated classes (decorate clears it),
+        # rather than on every to_json and from_json:
+        if self._needs_engine_for_json is None:
+            self._needs_engine_for_json = self._json_needs_engine()
+    
+    @property
+    def scratch_engines(self) -> EnginePool:
+        '''
+        The pool of in-memory engines that to_json and from_json use when
+        they need a database.
+        '''
+        return self._scratch_engines
+    
+    def _json_needs_engine(self) -> bool:
+        '''
+        Returns whether any decorated class has a field with a user supplied
+        "Column" or "type", whose values may need that column's type to
+        convert them from JSON, so from_json has to go through a DATAEngine.
+        '''
+        for cls in self.decorated_classes.values():
+            fields_info = getattr(cls, "FieldsInfo", None)
+            if fields_info is None:
+                continue
+            for field in fields_info.fields_dict.values():
+                if "Column" in field.metadata or "type" in field.metadata:
+                    return True
+        return False
     
     def decorate(self, cls:Type[clsType], generated_id_type:ID_Type=ID_Type.UUID, hashed_fields:List[str]=None, excluded_fields:Iterable[str]=[], included_fields:Iterable[str]=[], auto_include_fields=True, exclude_prefix:str="_") -> Type[clsType]:
         lazy_decorators = []
         self.decorated_classes[cls.__name__] = cls
+        self._needs_engine_for_json = None
         
         if self.auto_decorate_as_dataclass:
             cls = dataclass(cls)
         cls = capture_field_info(cls, excluded_fields=excluded_fields, included_fields=included_fields, auto_include_fields=auto_include_fields, exclude_prefix=exclude_prefix)
+        cls = track_dirty_fields(cls)
         if cls.FieldsInfo.primary_key_name is not None:
             cls._id_type_ = ID_Type.USER_SUPPLIED
         else:
@@ -68,6 +108,8 @@ class DATADecorator(AnyParam):
                 
                 if hashed_fields is None:
                     hashed_fields = deepcopy(cls.FieldsInfo.field_names)
+                # Only then is a stored object with the same hash stored as it is:
+                cls._hashes_all_fields_ = set(hashed_fields) >= set(cls.FieldsInfo.field_names)
                 
                 def get_hash_field_getters(cls: Type) -> Type:
                     field_getters = {}
@@ -145,6 +187,15 @@ class DATADecorator(AnyParam):
             return getattr(self, cls.FieldsInfo.primary_key_name)
         setattr(cls, "get_primary_key", get_primary_key)
         
+        def mark_loaded_objects_clean(cls: Type) -> Type:
+            def on_load(target, context):
+                data_engine = getattr(getattr(context, "session", None), "data_engine", None)
+                if data_engine is not None:
+                    data_engine.mark_clean(target)
+            event.listen(cls, 'load', on_load, restore_load_context=True)
+            return cls
+        lazy_decorators.append(mark_loaded_objects_clean)
+        
         cls = self.lazy([to_sql(), *lazy_decorators])(cls)
     
         # Define a custom __deepcopy__ method
@@ -163,7 +214,20 @@ class DATADecorator(AnyParam):
                 if hasattr(cls, "__cls_type__"):
                     yield "__cls_type__"
 
+            state = instance_state(self)
+            unloaded = state.unloaded
             for field_name in fields(cls):
+                if field_name in cls.FieldsInfo.list_fields_with_FieldsInfo:
+                    # Lists are loaded as their mapping rows (see OneToMany_List):
+                    keys = [list_items_key(field_name), list_rows_key(field_name)]
+                else:
+                    keys = [field_name]
+                if all(key in unloaded for key in keys):
+                    relationship = mapper.relationships.get(keys[-1], None)
+                    if state.detached or (relationship is not None and relationship.lazy == "raise"):
+                        # It can't be loaded, so leave it unloaded on the copy
+                        # too, which merging the copy will leave as it is:
+                        continue
                 value = getattr(self, field_name, None)
                 if value is not None:
                     if isinstance(value, InstrumentedList):
@@ -185,31 +249,31 @@ class DATADecorator(AnyParam):
         setattr(cls, '__deepcopy__', __deepcopy__)
         
         def to_json(cls_self):
-            engine = DATAEngine(self)
-            
-            obj = deepcopy(cls_self)
-            
-            engine.merge(obj)
-
-            json_data = engine.to_json()
-            engine.dispose()
+            self.finalize()
+            if not self._needs_engine_for_json:
+                json_data = to_table_json(cls_self, self.mapper_registry.metadata)
+            else:
+                with self.scratch_engines.engine() as engine:
+                    engine.merge(deepcopy(cls_self), copy=False)
+                    json_data = engine.to_json()
             
             return {
-                "primary_key":obj.get_primary_key(),
-                "type":type(obj).__name__,
+                "primary_key":cls_self.get_primary_key(),
+                "type":type(cls_self).__name__,
                 "obj":json_data
             }
             
         @staticmethod
         def from_json(json_data:dict):
-            engine = DATAEngine(self)
-            engine.insert_json(json_data["obj"])
+            self.finalize()
+            if not self._needs_engine_for_json:
+                return from_table_json(json_data["obj"], cls, json_data["primary_key"])
             
             pk_col = cls.__table__.c[cls.FieldsInfo.primary_key_name]
-            with engine.session() as session:
-                objs = deepcopy( session.query(cls).filter(pk_col==json_data["primary_key"]).first() )
-                
-            engine.dispose()
+            with self.scratch_engines.engine() as engine:
+                engine.insert_json(json_data["obj"])
+                with engine.session() as session:
+                    objs = materialize(session.query(cls).filter(pk_col==json_data["primary_key"]).first(), load=True)
             return objs
             
         setattr(cls, "to_json", to_json)
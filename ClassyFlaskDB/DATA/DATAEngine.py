@@ -1,22 +1,37 @@
-from sqlalchemy import Engine, create_engine, MetaData, DateTime, text, update
+from sqlalchemy import Engine, create_engine, MetaData, DateTime, Table, text, update, delete, select, event, bindparam, literal, inspect, exists, or_
+from sqlalchemy.sql import table as table_clause
+from sqlalchemy.schema import sort_tables_and_constraints
 from sqlalchemy.orm import Session as AlchemySession
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, class_mapper, object_mapper, make_transient_to_detached, attributes, selectinload, lazyload
 from copy import deepcopy
 import shutil
 
-from typing import Any
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+from dataclasses import dataclass
 from contextlib import contextmanager
 from datetime import datetime
+import tempfile
+import time
+import json
 import os
 import logging
 logging.basicConfig()
-from ClassyFlaskDB.helpers.Decorators.to_sql import type_map
+from ClassyFlaskDB.helpers.Decorators.to_sql import get_table_getter_setters, get_list_getter_setters, get_field_getter_setter, get_loaded_list, GetterSetter, OneToOneReference, OneToMany_List, CHANGED_LISTS
 from ClassyFlaskDB.DATA.ID_Type import ID_Type
+from ClassyFlaskDB.DATA import dirty_tracking
+from ClassyFlaskDB.DATA.DATAQuery import DATAQuery, DEFAULT_DEPTH, Page, polymorphic_entity, detach_loaded
+from ClassyFlaskDB.DATA.IdentityCache import IdentityCache
 
 def convert_to_column_type(value, column_type):
     if isinstance(column_type, DateTime):
-        if isinstance(value, datetime):
+        if value is None or isinstance(value, datetime):
             return value
+        try:
+            # Much faster than strptime, and covers what sqlite stores:
+            return datetime.fromisoformat(value.strip())
+        except ValueError:
+            pass
         try:
             return datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f %z")
         except ValueError:
@@ -24,49 +39,439 @@ def convert_to_column_type(value, column_type):
             return datetime.strptime(value.strip(), "%Y-%m-%d %H:%M:%S.%f")
     return value
 
+@contextmanager
+def open_text(path_or_stream:Union[str, IO[str]], mode:str) -> Iterator[IO[str]]:
+    '''
+    Opens path_or_stream as text if it is a path, otherwise uses it as it is
+    (without closing it).
+    '''
+    if isinstance(path_or_stream, (str, os.PathLike)):
+        with open(path_or_stream, mode, encoding="utf-8") as stream:
+            yield stream
+    else:
+        yield path_or_stream
+
+@dataclass
+class ChunkStats:
+    '''
+    Describes one committed chunk of a bulk write (see DATAEngine.add_all
+    and DATAEngine.merge_all).
+    '''
+    chunk_index: int
+    object_count: int
+    seconds: float
+
+# Max number of primary keys to put in a single "IN (...)" clause, this
+# keeps us well under SQLite's limit on the number of bound parameters:
+IN_CHUNK_SIZE = 500
+
+def children_of(obj:Any) -> Iterable[Any]:
+    '''
+    Yields every DATA object directly referenced by obj, either by a field
+    or as an item in a list field.
+    
+    Fields that are not loaded are skipped, they can not have changed, and
+    loading them would either query or raise if obj is detached.
+    '''
+    obj_dict = obj.__dict__
+    for child_name in obj.FieldsInfo.fields_with_FieldsInfo:
+        if child_name not in obj_dict:
+            continue
+        child = getattr(obj, child_name)
+        if child:
+            yield child
+    for child_name in obj.FieldsInfo.list_fields_with_FieldsInfo:
+        child = get_loaded_list(obj, child_name)
+        if child:
+            for child_item in child:
+                if child_item:
+                    yield child_item
+
+def crawl(instance:Any, visit:Callable[[Any], bool]) -> None:
+    '''
+    Walks every DATA object reachable from instance (including instance)
+    calling visit once on each of them. The children of an object are only
+    walked if visit returns True for it.
+    '''
+    closed_set = set()
+    open_list = [instance]
+    closed_set.add(id(instance))
+    while len(open_list)>0:
+        obj = open_list.pop()
+        if not visit(obj):
+            continue
+        
+        for child in children_of(obj):
+            if id(child) not in closed_set:
+                open_list.append(child)
+                closed_set.add(id(child))
+
+def find_prunable(instance:Any, is_known:Callable[[Any], bool], is_clean:Callable[[Any], bool]) -> List[Any]:
+    '''
+    Returns the objects reachable from instance that merging it does not need
+    to write or cascade into. Those are the known HASHID objects and the clean
+    objects, that no dirty object can be reached from.
+    
+    Objects that can only be reached through another prunable object are
+    not included.
+    '''
+    nodes = {id(instance): instance}
+    children :Dict[int, List[int]] = {}
+    open_list = [instance]
+    while len(open_list)>0:
+        obj = open_list.pop()
+        child_ids = children[id(obj)] = []
+        for child in children_of(obj):
+            child_ids.append(id(child))
+            if id(child) not in nodes:
+                nodes[id(child)] = child
+                open_list.append(child)
+    
+    # Anything a dirty object can be reached from has to be written too:
+    parents :Dict[int, List[int]] = {}
+    for parent_id, child_ids in children.items():
+        for child_id in child_ids:
+            parents.setdefault(child_id, []).append(parent_id)
+    open_list = [obj_id for obj_id in children.keys() if not is_known(nodes[obj_id]) and not is_clean(nodes[obj_id])]
+    must_write = set(open_list)
+    while len(open_list)>0:
+        for parent_id in parents.get(open_list.pop(), []):
+            if parent_id not in must_write:
+                must_write.add(parent_id)
+                open_list.append(parent_id)
+    
+    prunable = []
+    closed_set = set([id(instance)])
+    open_list = [id(instance)]
+    while len(open_list)>0:
+        obj_id = open_list.pop()
+        if obj_id not in must_write:
+            prunable.append(nodes[obj_id])
+            continue
+        for child_id in children[obj_id]:
+            if child_id not in closed_set:
+                closed_set.add(child_id)
+                open_list.append(child_id)
+    return prunable
+
+def sync_mapping_rows(connection:Any, getter_setter:OneToMany_List, objs:List[Any], chunk_size:int=IN_CHUNK_SIZE, check_stored:bool=True) -> None:
+    '''
+    Writes the list getter_setter stores for each of objs by diffing it,
+    position by position, against its stored mapping rows. So appending one
+    item to a long list inserts one row rather than rewriting all of them.
+    
+    :param connection: A Session or Connection to execute the statements with.
+    :param check_stored: False if none of objs have any mapping rows stored yet.
+    '''
+    table = getter_setter.mapping_table
+    parent_column = table.c[getter_setter.fk_name_parent]
+    position_column = table.c[getter_setter.position_name]
+    field_column = table.c[getter_setter.fk_name_field]
+    update_stmt = update(table).where(
+        parent_column == bindparam("__parent_pk__"),
+        position_column == bindparam("__position__")
+    ).values({field_column: bindparam("__field_pk__")})
+    delete_stmt = delete(table).where(
+        parent_column == bindparam("__parent_pk__"),
+        position_column >= bindparam("__length__")
+    )
+    
+    for i in range(0, len(objs), chunk_size):
+        chunk = objs[i:i+chunk_size]
+        stored :Dict[Any, Dict[int, Any]] = {}
+        if check_stored:
+            stored_rows = connection.execute(
+                select(parent_column, position_column, field_column).where(parent_column.in_([obj.get_primary_key() for obj in chunk]))
+            )
+            for parent_pk, position, field_pk in stored_rows:
+                stored.setdefault(parent_pk, {})[position] = field_pk
+        
+        deletes = []
+        updates = []
+        inserts = []
+        for obj in chunk:
+            parent_pk = obj.get_primary_key()
+            stored_items = stored.get(parent_pk, {})
+            rows = getter_setter.get_mapping_rows(obj)
+            for row in rows:
+                position = row[getter_setter.position_name]
+                if position not in stored_items:
+                    inserts.append(row)
+                elif stored_items[position] != row[getter_setter.fk_name_field]:
+                    updates.append({
+                        "__parent_pk__": parent_pk,
+                        "__position__": position,
+                        "__field_pk__": row[getter_setter.fk_name_field]
+                    })
+            if any(position >= len(rows) for position in stored_items):
+                deletes.append({"__parent_pk__": parent_pk, "__length__": len(rows)})
+        
+        if deletes:
+            connection.execute(delete_stmt, deletes)
+        if updates:
+            connection.execute(update_stmt, updates)
+        if inserts:
+            connection.execute(table.insert(), inserts)
+
 class Session(AlchemySession):
+    def __init__(self, *args, data_engine:"DATAEngine"=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.data_engine = data_engine
+        
+        # HASHID keys written in the current transaction, these become
+        # known to data_engine once it commits:
+        self._pending_hash_ids = set()
+        # HASHID keys deleted in the current transaction, these are
+        # forgotten by data_engine once it commits:
+        self._deleted_hash_ids = set()
+        # Keys of everything written in the current transaction, to
+        # invalidate in data_engine's identity_cache once it commits:
+        self._written_keys = set()
+        # Keys of the rows updated or deleted in the current transaction,
+        # whose clean marks data_engine invalidates once it commits:
+        self._overwritten_keys = set()
+    
+    def is_known(self, obj:Any) -> bool:
+        '''
+        Returns True if obj is a HASHID object that data_engine knows is
+        already stored. When a HASHID is a hash of all the object's content,
+        such an object does not need to be written (but what it references
+        may, if it is not hashed along with it).
+        '''
+        if self.data_engine is None:
+            return False
+        return self.data_engine.is_known(obj)
+    
+    def is_clean(self, obj:Any) -> bool:
+        '''
+        Returns True if obj is known to match what data_engine has stored.
+        '''
+        if self.data_engine is None:
+            return False
+        return self.data_engine.is_clean(obj)
+    
     def merge(self, instance, load=True, **kwargs):
         if hasattr(instance, 'FieldsInfo'):
-            def preserve_locked_fields_of(obj):
+            locked_objs = {}
+            def collect_locked_fields_of(obj):
                 if obj.__class__._id_type_ is not ID_Type.HASHID:
                     return #For performance, we don't really need to lock anything but
                            #for the classes with a HashIDs
-                fields_info = getattr(obj, 'FieldsInfo')
-                existing = self.get(obj.__class__, obj.get_primary_key())
-                if existing:
-                    for attr_name in fields_info.no_update_fields:
-                        preserved_value = getattr(existing, attr_name, None)
-                        setattr(obj, attr_name, preserved_value)
+                objs_by_pk = locked_objs.setdefault(obj.__class__, {})
+                objs_by_pk.setdefault(obj.get_primary_key(), []).append(obj)
             
-            def process_crawled(obj):
+            pruned = find_prunable(instance, self.is_known, self.is_clean)
+            pruned_ids = set(id(obj) for obj in pruned)
+            def process_crawled(obj) -> bool:
                 '''
                 A function we can extend latter to apply some logic to
                 every data decorator decorated class type field.
                 '''
-                preserve_locked_fields_of(obj)
+                if id(obj) in pruned_ids:
+                    return False
+                collect_locked_fields_of(obj)
+                return True
             
-            closed_set = set()
-            open_list = [instance]
-            closed_set.add(id(instance))
-            while len(open_list)>0:
-                obj = open_list.pop()
-                process_crawled(obj)
+            crawl(instance, process_crawled)
             
-                for child_name in obj.FieldsInfo.fields_with_FieldsInfo:
-                    child = getattr(obj, child_name)
-                    if child and id(child) not in closed_set:
-                        open_list.append(child)
-                        closed_set.add(id(child))
-                for child_name in obj.FieldsInfo.list_fields_with_FieldsInfo:
-                    child = getattr(obj, child_name)
-                    if child and id(child) not in closed_set:
-                        closed_set.add(id(child))
-                        for child_item in child:
-                            if child_item and id(child_item) not in closed_set:
-                                open_list.append(child_item)
+            # The identity map only holds weak references, so we hold on to
+            # the existing rows until the merge has found them there:
+            existing = []
+            for cls, objs_by_pk in locked_objs.items():
+                existing.extend(self._preserve_locked_fields(cls, objs_by_pk))
+                for pk in objs_by_pk.keys():
+                    self._pending_hash_ids.add((cls, pk))
             
+            if pruned:
+                return self._merge_pruned(instance, pruned, load, kwargs.get("options", None))
+        
         return super(Session, self).merge(instance, load=load, **kwargs)
     
+    def _merge_pruned(self, instance, pruned:List[Any], load:bool, options) -> Any:
+        '''
+        Merges instance the same way AlchemySession.merge does, except that
+        merge will not cascade into any of the objects in pruned. Each of those
+        is instead resolved to a persistent stub, without any SQL.
+        
+        This goes through AlchemySession._merge, the private method behind
+        merge, since merge has no way to skip objects. Its signature is the
+        same throughout SQLAlchemy 2.0, which setup.py pins to for this.
+        '''
+        _recursive = {
+            attributes.instance_state(obj): self._persistent_stub(obj)
+            for obj in pruned
+        }
+        
+        if load:
+            self._autoflush()
+        autoflush = self.autoflush
+        try:
+            self.autoflush = False
+            return self._merge(
+                attributes.instance_state(instance),
+                attributes.instance_dict(instance),
+                load=load,
+                options=options,
+                _recursive=_recursive,
+                _resolve_conflict_map={},
+            )
+        finally:
+            self.autoflush = autoflush
+    
+    def _persistent_stub(self, obj:Any) -> Any:
+        '''
+        Returns the persistent instance in this session with obj's primary
+        key, creating one that has nothing but its primary key loaded if it
+        is not in the identity map yet.
+        '''
+        mapper = object_mapper(obj)
+        primary_key = obj.get_primary_key()
+        key = mapper.identity_key_from_primary_key([primary_key])
+        stub = self.identity_map.get(key)
+        if stub is None:
+            stub = mapper.class_manager.new_instance()
+            setattr(stub, obj.FieldsInfo.primary_key_name, primary_key)
+            make_transient_to_detached(stub)
+            self.add(stub)
+        return stub
+    
+    def _preserve_locked_fields(self, cls:type, objs_by_pk:Dict[Any, List[Any]]) -> List[Any]:
+        '''
+        Restores the no_update fields of the objects in objs_by_pk from their
+        stored rows, loading the stored rows of cls with a few "IN" queries
+        rather than one query per object.
+        
+        :return: The stored objects that were loaded.
+        '''
+        pk_attr = getattr(cls, cls.FieldsInfo.primary_key_name)
+        pks = list(objs_by_pk.keys())
+        
+        existing_objs = []
+        for i in range(0, len(pks), IN_CHUNK_SIZE):
+            existing_objs.extend(self.query(cls).filter(pk_attr.in_(pks[i:i+IN_CHUNK_SIZE])).all())
+        
+        for existing in existing_objs:
+            for obj in objs_by_pk.get(existing.get_primary_key(), []):
+                for attr_name in cls.FieldsInfo.no_update_fields:
+                    preserved_value = getattr(existing, attr_name, None)
+                    setattr(obj, attr_name, preserved_value)
+        return existing_objs
+    
+@event.listens_for(Session, "before_flush")
+def _cascade_list_items(session:Session, flush_context, instances):
+    '''
+    List fields are viewonly relationships, so the save-update cascade does not
+    add the objects in them to the session, and the mapping rows of deleted
+    objects are not removed for us.
+    '''
+    checked = set()
+    while True:
+        unchecked = [obj for obj in session.new.union(session.dirty) if id(obj) not in checked]
+        if len(unchecked) == 0:
+            break
+        for obj in unchecked:
+            checked.add(id(obj))
+            for getter_setter in get_list_getter_setters(type(obj)):
+                for item in get_loaded_list(obj, getter_setter.field_info.field_name) or []:
+                    if item is not None and attributes.instance_state(item).transient:
+                        session.add(item)
+    
+    deleted :Dict[OneToMany_List, List[Any]] = {}
+    for obj in session.deleted:
+        for getter_setter in get_list_getter_setters(type(obj)):
+            deleted.setdefault(getter_setter, []).append(obj.get_primary_key())
+    for getter_setter, parent_pks in deleted.items():
+        parent_column = getter_setter.mapping_table.c[getter_setter.fk_name_parent]
+        for i in range(0, len(parent_pks), IN_CHUNK_SIZE):
+            session.connection().execute(delete(getter_setter.mapping_table).where(parent_column.in_(parent_pks[i:i+IN_CHUNK_SIZE])))
+
+@event.listens_for(Session, "after_flush")
+def _write_list_mapping_rows(session:Session, flush_context):
+    '''
+    Writes the mapping rows of the list fields that were set or changed in the
+    flush, once the objects they reference have been inserted.
+    '''
+    new :Dict[OneToMany_List, List[Any]] = {}
+    for obj in session.new:
+        for getter_setter in get_list_getter_setters(type(obj)):
+            if get_loaded_list(obj, getter_setter.field_info.field_name):
+                new.setdefault(getter_setter, []).append(obj)
+    
+    changed :Dict[OneToMany_List, List[Any]] = {}
+    for obj in session.dirty:
+        changed_lists = obj.__dict__.get(CHANGED_LISTS, None)
+        if not changed_lists:
+            continue
+        for getter_setter in get_list_getter_setters(type(obj)):
+            if getter_setter.field_info.field_name in changed_lists:
+                changed.setdefault(getter_setter, []).append(obj)
+    
+    for obj in session.new.union(session.dirty):
+        obj.__dict__.pop(CHANGED_LISTS, None)
+    
+    connection = session.connection()
+    for getter_setter, objs in new.items():
+        sync_mapping_rows(connection, getter_setter, objs, check_stored=False)
+    for getter_setter, objs in changed.items():
+        sync_mapping_rows(connection, getter_setter, objs)
+
+@event.listens_for(Session, "after_flush")
+def _collect_written_hash_ids(session:Session, flush_context):
+    for obj in session.new.union(session.dirty):
+        if getattr(obj.__class__, "_id_type_", None) is ID_Type.HASHID:
+            key = (obj.__class__, obj.get_primary_key())
+            session._pending_hash_ids.add(key)
+            session._deleted_hash_ids.discard(key)
+    for obj in session.deleted:
+        if getattr(obj.__class__, "_id_type_", None) is ID_Type.HASHID:
+            key = (obj.__class__, obj.get_primary_key())
+            session._deleted_hash_ids.add(key)
+            session._pending_hash_ids.discard(key)
+
+@event.listens_for(Session, "after_flush")
+def _collect_overwritten_keys(session:Session, flush_context):
+    if session.data_engine is None:
+        return
+    # (Newly inserted rows can not have been marked clean before)
+    for obj in session.dirty.union(session.deleted):
+        if hasattr(obj, "FieldsInfo"):
+            session._overwritten_keys.add((obj.__class__, obj.get_primary_key()))
+
+@event.listens_for(Session, "after_flush")
+def _collect_written_keys(session:Session, flush_context):
+    if session.data_engine is None or session.data_engine.identity_cache is None:
+        return
+    for obj in session.new.union(session.dirty):
+        if getattr(obj.__class__, "_id_type_", None) is not ID_Type.HASHID:
+            session._written_keys.add((obj.__class__, obj.get_primary_key()))
+    # Even HASHID objects can be deleted:
+    for obj in session.deleted:
+        session._written_keys.add((obj.__class__, obj.get_primary_key()))
+
+@event.listens_for(Session, "after_commit")
+def _remember_written_hash_ids(session:Session):
+    if session.data_engine is not None:
+        for cls, pk in session._pending_hash_ids:
+            session.data_engine.remember_known(cls, pk)
+        for cls, pk in session._deleted_hash_ids:
+            session.data_engine.forget_known(cls, pk)
+        for cls, pk in session._overwritten_keys:
+            session.data_engine.overwritten(cls, pk)
+        if session.data_engine.identity_cache is not None:
+            for cls, pk in session._written_keys:
+                session.data_engine.identity_cache.invalidate(cls, pk)
+    session._pending_hash_ids.clear()
+    session._deleted_hash_ids.clear()
+    session._written_keys.clear()
+    session._overwritten_keys.clear()
+
+@event.listens_for(Session, "after_rollback")
+def _forget_written_hash_ids(session:Session):
+    session._pending_hash_ids.clear()
+    session._deleted_hash_ids.clear()
+    session._written_keys.clear()
+    session._overwritten_keys.clear()
+
 class DATAEngine:
     @property
     def engine_metadata(self):
@@ -87,7 +492,24 @@ class DATAEngine:
         else:
             logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
     
-    def __init__(self, data_decorator:"DATADecorator", engine:Engine=None, engine_str:str="sqlite:///:memory:", should_backup:bool=True, backup_dir:str=None, auto_add_new_columns:bool=True, auto_replace_database_fallback:bool=True, suppress_fk_warnings:bool=True):        
+    def __init__(self, data_decorator:"DATADecorator", engine:Engine=None, engine_str:str="sqlite:///:memory:", should_backup:bool=True, backup_dir:str=None, auto_add_new_columns:bool=True, auto_replace_database_fallback:bool=True, suppress_fk_warnings:bool=True, copy_on_write:bool=True, track_known_ids:bool=True, identity_cache:IdentityCache=None):        
+        '''
+        :param copy_on_write: If True (the default) add and merge deepcopy the
+        objects they are given and persist the copies, leaving the callers
+        objects untouched. If False that copy of the whole object graph is
+        skipped: add persists the callers objects directly, leaving them
+        detached afterward, and merge has the session copy their state onto
+        its own instances (as it always does), so the callers objects are
+        never attached to it. This can be overridden per call with their copy
+        parameter.
+        :param track_known_ids: If True the engine remembers the primary keys
+        of the HASHID objects it has written (see load_known_ids) and merge
+        skips writing any HASHID object whose hash covers all of its fields
+        that it knows is already stored (though not what it references).
+        :param identity_cache: An optional IdentityCache that get serves objects
+        from across sessions. It is filled by get and query, and the objects
+        in it are invalidated when this engine writes them.
+        '''
         if suppress_fk_warnings:
             import warnings
             from sqlalchemy.exc import SAWarning
@@ -96,6 +518,15 @@ class DATAEngine:
         
         self.data_decorator = data_decorator
         self.backup_dir = backup_dir
+        self.copy_on_write = copy_on_write
+        self.known_hash_ids :Dict[type, Set[Any]] = {} if track_known_ids else None
+        self.identity_cache = identity_cache
+        # Identifies this engine to the objects it loads and persists (see dirty_tracking):
+        self.engine_token = object()
+        # The generation of each (class, primary key) whose row has been
+        # overwritten or deleted, see overwritten:
+        self._key_generations :Dict[Tuple[type, Any], int] = {}
+        self._shallow_update_plans = {}
         
         self.data_decorator.finalize()
         
@@ -105,6 +536,7 @@ class DATAEngine:
                 self._add_new_columns(should_backup)
             
             self.decorator_metadata.create_all(self.engine)
+            self._table_count = len(self.decorator_metadata.tables)
         except Exception as e:
             self.dispose()
             
@@ -112,18 +544,36 @@ class DATAEngine:
                 print(f"An error occurred while creating the database: {e}. Attempting to replace the database with the new schema.")
                 self._init_engine(engine, engine_str)
                 
-                old_db_values = self.to_json()
-                if not getattr(self, "_backup_performed", False):
-                    self.backup_database()
-                
-                old_db_path = self.engine.url.database
-                self.dispose()
-                os.remove(old_db_path)
-                
-                self._init_engine(engine, engine_str)
-                self.decorator_metadata.create_all(self.engine)
-                self.insert_json(old_db_values)
-                self._bind_engine_metadata()
+                # Streamed through a file, so the old database does not have to fit in memory:
+                with tempfile.TemporaryFile("w+", encoding="utf-8") as old_db_values:
+                    self.export(old_db_values)
+                    if not getattr(self, "_backup_performed", False):
+                        self.backup_database()
+                    
+                    old_db_url = self.engine.url
+                    old_db_path = old_db_url.database
+                    self.dispose()
+                    
+                    # The new database is built beside the old one, which is
+                    # only replaced once all of its data is in the new one:
+                    new_db_path = f"{old_db_path}.replacing"
+                    if os.path.exists(new_db_path):
+                        os.remove(new_db_path)
+                    self._init_engine(create_engine(old_db_url.set(database=new_db_path)), None)
+                    try:
+                        self.decorator_metadata.create_all(self.engine)
+                        old_db_values.seek(0)
+                        self.restore(old_db_values)
+                    except Exception:
+                        self.dispose()
+                        os.remove(new_db_path)
+                        self._init_engine(engine, engine_str)
+                        raise
+                    self.dispose()
+                    os.replace(new_db_path, old_db_path)
+                    
+                    self._init_engine(engine, engine_str)
+                    self._table_count = len(self.decorator_metadata.tables)
             else:
                 raise e
         
@@ -155,6 +605,38 @@ class DATAEngine:
                     alter_table_cmd = f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"# {fk_constraints}"
                     with self.engine.connect() as conn:
                         conn.execute(text(alter_table_cmd))
+                
+                list_position = new_table.info.get("list_position", None)
+                if list_position in missing_columns:
+                    self._number_list_positions(table_name, new_table.info["list_parent_fk"], list_position)
+                
+                # Indexes are only created along with their table, so add any
+                # the existing table is missing:
+                old_indexes = set(index.name for index in old_table.indexes)
+                for index in new_table.indexes:
+                    if index.name not in old_indexes:
+                        try:
+                            index.create(self.engine)
+                        except IntegrityError as e:
+                            raise Exception(f"Could not add the unique index {index.name}, the rows already in {table_name} are not unique.") from e
+    
+    def _number_list_positions(self, table_name:str, parent_fk:str, position:str):
+        '''
+        Numbers the rows of a list mapping table that was created before it had
+        a position column, in the order they were inserted.
+        '''
+        if self.engine.name != 'sqlite':
+            print(f"Warning: The {position} column added to {table_name} could not be filled in, only SQLite is supported. Lists stored before it was added will load unordered.")
+            return
+        
+        number_cmd = (
+            f"UPDATE {table_name} SET {position} = ("
+            f"SELECT COUNT(*) FROM {table_name} AS earlier "
+            f"WHERE earlier.{parent_fk} = {table_name}.{parent_fk} AND earlier.rowid < {table_name}.rowid)"
+        )
+        with self.engine.connect() as conn:
+            conn.execute(text(number_cmd))
+            conn.commit()
                         
     def _init_engine(self, engine, engine_str):
         if engine is None:
@@ -162,7 +644,7 @@ class DATAEngine:
         else:
             self.engine = engine
         
-        self.session_maker = sessionmaker(bind=self.engine, class_=Session)
+        self.session_maker = sessionmaker(bind=self.engine, class_=Session, data_engine=self)
         
         self._bind_engine_metadata()
     
@@ -195,70 +677,406 @@ class DATAEngine:
             shutil.copy(original_database_file_path, backup_file_path)
             self._backup_performed = True
         
-    def add(self, obj:Any):
-        obj = deepcopy(obj)
+    def is_known(self, obj:Any) -> bool:
+        '''
+        Returns True if obj is a HASHID object this engine knows is stored,
+        and its hash covers all of its fields, so it is stored as it is.
+        '''
+        if self.known_hash_ids is None or getattr(obj.__class__, "_id_type_", None) is not ID_Type.HASHID:
+            return False
+        if not obj.__class__.__dict__.get("_hashes_all_fields_", False):
+            # Edits to the fields left out of its hash would be lost:
+            return False
+        return obj.get_primary_key() in self.known_hash_ids.get(obj.__class__, ())
+    
+    def remember_known(self, cls:type, primary_key:Any) -> None:
+        if self.known_hash_ids is not None:
+            self.known_hash_ids.setdefault(cls, set()).add(primary_key)
+    
+    def forget_known(self, cls:type, primary_key:Any) -> None:
+        if self.known_hash_ids is not None:
+            self.known_hash_ids.get(cls, set()).discard(primary_key)
+    
+    def load_known_ids(self) -> None:
+        '''
+        Warms the known id cache with the primary keys of every HASHID
+        object that is already stored in the database.
+        '''
+        if self.known_hash_ids is None:
+            return
+        
         with self.session_maker() as session:
-            session.add(obj)
+            for cls in self.data_decorator.decorated_classes.values():
+                if getattr(cls, "_id_type_", None) is not ID_Type.HASHID:
+                    continue
+                
+                mapper = class_mapper(cls)
+                stmt = select(getattr(cls, cls.FieldsInfo.primary_key_name)).select_from(cls)
+                if mapper.polymorphic_on is not None:
+                    stmt = stmt.where(mapper.polymorphic_on == mapper.polymorphic_identity)
+                self.known_hash_ids.setdefault(cls, set()).update(session.scalars(stmt))
+    
+    def overwritten(self, cls:type, primary_key:Any) -> None:
+        '''
+        Records that the stored row of the cls object with primary_key has
+        been updated or deleted, so the objects marked clean for it before
+        no longer are.
+        '''
+        key = (cls, primary_key)
+        self._key_generations[key] = self._key_generations.get(key, 0) + 1
+    
+    def _generation(self, obj:Any) -> int:
+        return self._key_generations.get((obj.__class__, obj.get_primary_key()), 0)
+    
+    def is_clean(self, obj:Any) -> bool:
+        '''
+        Returns True if obj is known to match what this engine has stored,
+        meaning it was loaded or persisted by this engine and neither it nor
+        its row has been changed since.
+        '''
+        return dirty_tracking.is_clean(obj, self.engine_token, self._generation(obj))
+    
+    def get_dirty_fields(self, obj:Any) -> Set[str]:
+        '''
+        Returns the names of obj's fields that may differ from what this
+        engine has stored, or all of them if it is not known to be stored here.
+        '''
+        dirty_fields = dirty_tracking.get_dirty_fields(obj, self.engine_token, self._generation(obj))
+        if dirty_fields is None:
+            return set(obj.FieldsInfo.field_names)
+        return dirty_fields
+    
+    def mark_clean(self, obj:Any) -> None:
+        '''
+        Marks obj (alone) clean, once it has been loaded or persisted.
+        '''
+        dirty_tracking.mark_clean(obj, self.engine_token, generation=self._generation(obj))
+    
+    def _mark_clean(self, obj:Any) -> None:
+        '''
+        Marks obj and everything reachable from it clean, once they have been persisted.
+        '''
+        def mark(o) -> bool:
+            self.mark_clean(o)
+            return True
+        crawl(obj, mark)
+    
+    def _snapshot(self, obj:Any, memo:Dict[int, Any]=None) -> Any:
+        '''
+        Deep copies obj for writing. Objects that merge is not going to write
+        (see find_prunable) are not copied.
+        '''
+        if memo is None:
+            memo = {}
+        for pruned in find_prunable(obj, self.is_known, self.is_clean):
+            memo[id(pruned)] = pruned
+        return deepcopy(obj, memo)
+    
+    def _should_copy(self, copy:bool=None) -> bool:
+        if copy is None:
+            return self.copy_on_write
+        return copy
+    
+    def _write_session(self, copy:bool) -> Session:
+        '''
+        Creates a session for writing objects. When we are not writing copies
+        the callers objects stay loaded after commit so they are still usable
+        once they have been expunged.
+        '''
+        return self.session_maker(expire_on_commit=copy)
+    
+    def add(self, obj:Any, copy:bool=None):
+        copy = self._should_copy(copy)
+        with self._write_session(copy) as session:
+            session.add(deepcopy(obj) if copy else obj)
             session.commit()
+            if not copy:
+                session.expunge_all()
+        self._mark_clean(obj)
+    
+    def add_all(self, objs:Iterable[Any], chunk_size:int=1000, copy:bool=None) -> List[ChunkStats]:
+        '''
+        Adds every object in objs using a single session, committing once
+        every chunk_size objects.
+        
+        Objects shared between the items of objs are only copied (and
+        inserted) once.
+        
+        :return: A ChunkStats for every committed chunk.
+        '''
+        return self._write_all(objs, chunk_size, lambda session, obj: session.add(obj), copy, deepcopy)
+    
+    def merge_all(self, objs:Iterable[Any], chunk_size:int=1000, copy:bool=None) -> List[ChunkStats]:
+        '''
+        Deeply merges every object in objs using a single session, committing
+        once every chunk_size objects.
+        
+        Objects shared between the items of objs are only copied once.
+        
+        :return: A ChunkStats for every committed chunk.
+        '''
+        return self._write_all(objs, chunk_size, lambda session, obj: session.merge(obj), copy, self._snapshot)
+    
+    def _write_all(self, objs:Iterable[Any], chunk_size:int, write:Callable[[Session, Any], Any], copy:bool, snapshot:Callable[[Any, Dict[int, Any]], Any]) -> List[ChunkStats]:
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1.")
+        
+        copy = self._should_copy(copy)
+        stats = []
+        memo = {}
+        with self._write_session(copy) as session:
+            chunk_objs = []
+            def commit_chunk(chunk_start:float):
+                session.commit()
+                # Keep the identity map from growing with the whole ingest,
+                # the copies in memo are all we need to share objects:
+                session.expunge_all()
+                for obj in chunk_objs:
+                    self._mark_clean(obj)
+                stats.append(ChunkStats(len(stats), len(chunk_objs), time.perf_counter()-chunk_start))
+                chunk_objs.clear()
+            
+            chunk_start = time.perf_counter()
+            for obj in objs:
+                write(session, snapshot(obj, memo) if copy else obj)
+                chunk_objs.append(obj)
+                if len(chunk_objs) == chunk_size:
+                    commit_chunk(chunk_start)
+                    chunk_start = time.perf_counter()
+            
+            if len(chunk_objs) > 0:
+                commit_chunk(chunk_start)
+        return stats
     
-    def merge(self, obj:Any, deeply:bool=True):
+    def upsert(self, obj:Any) -> None:
+        '''
+        Deeply merges obj using native upserts, see upsert_all.
+        '''
+        self.upsert_all([obj])
+    
+    def upsert_all(self, objs:Iterable[Any], chunk_size:int=1000) -> None:
+        '''
+        An alternative to merge_all that writes everything reachable from objs
+        with batched "INSERT ... ON CONFLICT" statements, one executemany per
+        table, rather than having SQLAlchemy SELECT every object before it
+        decides whether to INSERT or UPDATE it.
+        
+        Stored rows have every column but those of their no_update fields
+        updated, apart from the rows of HASHID classes, which are left as they
+        are. Stored lists are replaced.
+        
+        Only SQLite and PostgreSQL are supported.
+        '''
+        insert = self._dialect_insert()
+        
+        objs_by_key = {}
+        def collect(obj) -> bool:
+            if self.is_known(obj):
+                # (what it references may still need writing)
+                return True
+            primary_key = obj.get_primary_key()
+            if primary_key is None:
+                raise ValueError(f"Object of type {type(obj).__name__} lacks a primary key value.")
+            objs_by_key[(obj.__class__, primary_key)] = obj
+            return True
+        for obj in objs:
+            crawl(obj, collect)
+        
+        # Build every row we need to write, grouped by the statement that will
+        # write it. (Rows that lack deferred columns that were never loaded
+        # are written by statements that leave those as they are.)
+        rows :Dict[Tuple[Table, bool, frozenset], List[Dict[str, Any]]] = {}
+        locked_names :Dict[Table, Set[str]] = {}
+        list_rows :Dict[OneToMany_List, Tuple[List[Any], List[Dict[str, Any]]]] = {}
+        for (cls, primary_key), obj in objs_by_key.items():
+            do_nothing = cls._id_type_ is ID_Type.HASHID
+            for table, getter_setters in get_table_getter_setters(cls):
+                if table not in locked_names:
+                    locked_names[table] = self._locked_column_names(getter_setters)
+                row = {}
+                for getter_setter in getter_setters:
+                    row.update(getter_setter.get_column_values(obj))
+                    if isinstance(getter_setter, OneToMany_List) and get_loaded_list(obj, getter_setter.field_info.field_name) is not None:
+                        parent_pks, mapping_rows = list_rows.setdefault(getter_setter, ([], []))
+                        parent_pks.append(primary_key)
+                        mapping_rows.extend(getter_setter.get_mapping_rows(obj))
+                rows.setdefault((table, do_nothing, frozenset(row.keys())), []).append(row)
+        
+        table_order = {table: i for i, table in enumerate(self.decorator_metadata.sorted_tables)}
+        with self.session_maker() as session:
+            for (table, do_nothing, row_names), table_rows in sorted(rows.items(), key=lambda item: table_order[item[0][0]]):
+                stmt = insert(table)
+                pk_names = [column.name for column in table.primary_key.columns]
+                update_names = [
+                    column.name for column in table.columns
+                    if column.name in row_names and column.name not in pk_names and column.name not in locked_names[table]
+                ]
+                if do_nothing or not update_names:
+                    stmt = stmt.on_conflict_do_nothing(index_elements=pk_names)
+                else:
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=pk_names,
+                        set_={name: stmt.excluded[name] for name in update_names}
+                    )
+                
+                for i in range(0, len(table_rows), chunk_size):
+                    session.execute(stmt, table_rows[i:i+chunk_size])
+            
+            for list_getter_setter, (parent_pks, mapping_rows) in list_rows.items():
+                mapping_table = list_getter_setter.mapping_table
+                parent_fk = mapping_table.c[list_getter_setter.fk_name_parent]
+                for i in range(0, len(parent_pks), IN_CHUNK_SIZE):
+                    session.execute(delete(mapping_table).where(parent_fk.in_(parent_pks[i:i+IN_CHUNK_SIZE])))
+                for i in range(0, len(mapping_rows), chunk_size):
+                    session.execute(mapping_table.insert(), mapping_rows[i:i+chunk_size])
+            
+            for cls, primary_key in objs_by_key.keys():
+                if cls._id_type_ is ID_Type.HASHID:
+                    session._pending_hash_ids.add((cls, primary_key))
+            session.commit()
+        
+        for (cls, primary_key), obj in objs_by_key.items():
+            self.overwritten(cls, primary_key)
+            self.mark_clean(obj)
+            if self.identity_cache is not None:
+                self.identity_cache.written(cls, primary_key)
+    
+    def _dialect_insert(self) -> Callable[[Table], Any]:
+        if self.engine.dialect.name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        elif self.engine.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            raise Exception(f"Upserts are not supported with {self.engine.dialect.name}.")
+        return insert
+    
+    @staticmethod
+    def _locked_column_names(getter_setters:List[GetterSetter]) -> Set[str]:
+        '''
+        Returns the names of the columns of getter_setters that belong to no_update fields.
+        '''
+        locked_names = set()
+        for getter_setter in getter_setters:
+            field_info = getter_setter.field_info
+            if field_info is not None and field_info.field_name in field_info.parent_type.FieldsInfo.no_update_fields:
+                locked_names.update(column.name for column in getter_setter.columns)
+        return locked_names
+    
+    def merge(self, obj:Any, deeply:bool=True, copy:bool=None):
+        '''
+        Merges obj into the database.
+        
+        :param deeply: If True obj and everything reachable from it is merged,
+        otherwise only obj's own columns are updated.
+        :param copy: Overrides copy_on_write for this call (deep merges only).
+        '''
         if deeply:
-            obj = deepcopy(obj)
-            with self.session_maker() as session:
-                session.merge(obj)
+            copy = self._should_copy(copy)
+            with self._write_session(copy) as session:
+                session.merge(self._snapshot(obj) if copy else obj)
                 session.commit()
+            self._mark_clean(obj)
         else:
-            model_class = type(obj)
-            model_base_class = model_class.__bases__[0]
-            fields_info = getattr(model_class, 'FieldsInfo', None)
-            if not fields_info:
-                raise ValueError(f"No FieldsInfo found for class {model_class.__name__}")
-
-            primary_key_name = fields_info.primary_key_name
-            primary_key_value = getattr(obj, primary_key_name)
-
-            if primary_key_value is None:
-                raise ValueError(f"Object of type {model_class.__name__} lacks a primary key value.")
-
-            update_values = {}
-            for field_name in fields_info.field_names:
-                if field_name == primary_key_name:
-                    continue  # Skip the primary key field
-                
-                field_value = getattr(obj, field_name, None)
-                if isinstance(field_value, list):
-                    continue # Skip list fields (for now)
-                if hasattr(model_base_class, field_name):
+            self.shallow_merge_all([obj])
+    
+    def shallow_merge_all(self, objs:Iterable[Any], chunk_size:int=1000) -> None:
+        '''
+        Updates the stored columns of each object in objs without merging
+        anything they reference (the same as merge with deeply=False), using a
+        single executemany UPDATE per class and table.
+        
+        References to other objects are updated through their foreign keys,
+        and lists through their mapping rows (see sync_mapping_rows), but the
+        objects they hold are not written, and no_update fields are left as
+        they are. Objects this engine knows are clean are skipped, and only the
+        changed columns of the others that it loaded or persisted before are
+        written.
+        '''
+        objs_by_class :Dict[Tuple[type, frozenset], List[Any]] = {}
+        written_objs = []
+        for obj in objs:
+            if getattr(type(obj), 'FieldsInfo', None) is None:
+                raise ValueError(f"No FieldsInfo found for class {type(obj).__name__}")
+            if obj.get_primary_key() is None:
+                raise ValueError(f"Object of type {type(obj).__name__} lacks a primary key value.")
+            
+            dirty_fields = dirty_tracking.get_dirty_fields(obj, self.engine_token, self._generation(obj))
+            if dirty_fields is not None:
+                if len(dirty_fields) == 0:
                     continue
+                dirty_fields = frozenset(dirty_fields)
+            elif any(not getter_setter.is_loaded(obj) for table, getter_setters in get_table_getter_setters(type(obj)) for getter_setter in getter_setters):
+                # Deferred fields that were never loaded can not be written:
+                dirty_fields = frozenset(
+                    getter_setter.field_info.field_name
+                    for table, getter_setters in get_table_getter_setters(type(obj))
+                    for getter_setter in getter_setters
+                    if getter_setter.field_info is not None and getter_setter.is_loaded(obj)
+                )
+            objs_by_class.setdefault((type(obj), dirty_fields), []).append(obj)
+            written_objs.append(obj)
+        
+        with self.session_maker() as session:
+            for (model_class, dirty_fields), class_objs in objs_by_class.items():
+                for stmt, getter_setters in self._shallow_update_plan(model_class):
+                    if dirty_fields is not None:
+                        getter_setters = [
+                            getter_setter for getter_setter in getter_setters
+                            if getter_setter.field_info.field_name in dirty_fields
+                        ]
+                        if not getter_setters:
+                            continue
+                    for i in range(0, len(class_objs), chunk_size):
+                        params = []
+                        for obj in class_objs[i:i+chunk_size]:
+                            values = {"__pk__": obj.get_primary_key()}
+                            for getter_setter in getter_setters:
+                                values.update(getter_setter.get_column_values(obj))
+                            params.append(values)
+                        session.execute(stmt, params)
                 
-                field_info = fields_info.fields_dict.get(field_name)
-                if field_info:  # This includes both regular fields and foreign key fields
-                    if hasattr(field_value, "FieldsInfo"):
-                        # For foreign key fields, get the primary key of the related object
-                        related_obj_primary_key = getattr(field_value, field_value.FieldsInfo.primary_key_name, None)
-                        field_name = field_name + "_fk"
-                        update_values[field_name] = related_obj_primary_key
-                    elif hasattr(obj, f"{field_name}__DateTimeObj") and hasattr(obj, f"{field_name}__TimeZone"):
-                        # Custom handling for split datetime fields
-                        datetime_value = getattr(obj, f"{field_name}__DateTimeObj", None)
-                        timezone_value = getattr(obj, f"{field_name}__TimeZone", None)
-                        update_values[f"{field_name}__DateTimeObj"] = datetime_value
-                        update_values[f"{field_name}__TimeZone"] = timezone_value
-                    elif type(field_value) not in type_map:
+                for getter_setter in get_list_getter_setters(model_class):
+                    field_name = getter_setter.field_info.field_name
+                    if dirty_fields is not None and field_name not in dirty_fields:
                         continue
-                    else:
-                        update_values[field_name] = field_value
-
-            if update_values:
-                stmt = (
-                    update(model_class).
-                    where(getattr(model_class, primary_key_name) == primary_key_value).
-                    values(**update_values)
-                )
-                with self.session_maker() as session:
-                    session.execute(stmt)
-                    session.commit()
-            
+                    # Lists that were never loaded can not have changed:
+                    list_objs = [obj for obj in class_objs if get_loaded_list(obj, field_name) is not None]
+                    sync_mapping_rows(session, getter_setter, list_objs, chunk_size)
+            session.commit()
+        
+        for obj in written_objs:
+            self.overwritten(type(obj), obj.get_primary_key())
+            self.mark_clean(obj)
+            if self.identity_cache is not None:
+                self.identity_cache.written(type(obj), obj.get_primary_key())
+    
+    def _shallow_update_plan(self, model_class:type) -> List[Tuple[Any, List[GetterSetter]]]:
+        '''
+        Returns an UPDATE statement for each table model_class is stored in,
+        along with the getter setters whose columns it sets. The primary key
+        of the row to update is bound as "__pk__".
+        '''
+        plan = self._shallow_update_plans.get(model_class, None)
+        if plan is None:
+            plan = []
+            for table, getter_setters in get_table_getter_setters(model_class):
+                locked_names = self._locked_column_names(getter_setters)
+                pk_names = [column.name for column in table.primary_key.columns]
+                update_getter_setters = [
+                    getter_setter for getter_setter in getter_setters
+                    if getter_setter.field_info is not None
+                    and getter_setter.columns
+                    and not any(column.name in pk_names or column.name in locked_names for column in getter_setter.columns)
+                ]
+                if not update_getter_setters:
+                    continue
+                
+                # The SET clause is taken from the parameters' keys:
+                stmt = update(table).where(table.c[pk_names[0]] == bindparam("__pk__"))
+                plan.append((stmt, update_getter_setters))
+            self._shallow_update_plans[model_class] = plan
+        return plan
+    
     @contextmanager
     def session(self) -> Session:
         session = self.session_maker()
@@ -270,6 +1088,307 @@ class DATAEngine:
         finally:
             session.close()
     
+    def get(self, model_class:type, primary_key:Any, depth:int=DEFAULT_DEPTH) -> Any:
+        '''
+        Returns the detached model_class object with primary_key, loaded along
+        with everything it references up to depth relationships away, or None
+        if there isn't one.
+        
+        If this engine has an identity_cache, the object is taken from it when
+        it is there, loaded at least as deep, and neither it nor anything
+        loaded with it has changed since.
+        '''
+        if self.identity_cache is not None:
+            obj = self.identity_cache.get(model_class, primary_key, depth)
+            if obj is not None:
+                if self._is_graph_clean(obj):
+                    return obj
+                self.identity_cache.invalidate(model_class, primary_key)
+        
+        primary_key_attribute = getattr(model_class, model_class.FieldsInfo.primary_key_name)
+        return self.query(model_class, depth).where(primary_key_attribute == primary_key).first()
+    
+    def _is_graph_clean(self, obj:Any) -> bool:
+        '''
+        Returns True if obj and everything reachable from it is clean.
+        '''
+        clean = True
+        def check(o) -> bool:
+            nonlocal clean
+            clean = clean and self.is_clean(o)
+            return clean
+        crawl(obj, check)
+        return clean
+    
+    def _cache(self, obj:Any, depth:int) -> None:
+        '''
+        Adds obj, just loaded depth relationships deep, to identity_cache.
+        '''
+        contained_objs = []
+        def collect(o) -> bool:
+            contained_objs.append(o)
+            return True
+        crawl(obj, collect)
+        self.identity_cache.put(obj, depth, contained_objs)
+    
+    def undefer(self, objs:Iterable[Any], *field_names:str, chunk_size:int=IN_CHUNK_SIZE) -> None:
+        '''
+        Loads the fields field_names (by default, every deferred field) of
+        the objects in objs that were left out when they were loaded, with a
+        single SELECT per class for every chunk_size of them, rather than one
+        per object as accessing them one at a time in a session would.
+        
+        Loaded values are not considered changes, and the objects can be
+        detached.
+        '''
+        objs_by_class :Dict[type, List[Any]] = {}
+        for obj in objs:
+            objs_by_class.setdefault(type(obj), []).append(obj)
+        
+        with self.session() as session:
+            for model_class, class_objs in objs_by_class.items():
+                if field_names:
+                    getter_setters = [get_field_getter_setter(model_class, field_name) for field_name in field_names]
+                else:
+                    getter_setters = [
+                        getter_setter
+                        for table, table_getter_setters in get_table_getter_setters(model_class)
+                        for getter_setter in table_getter_setters
+                        if getter_setter.deferred
+                    ]
+                column_names = [column.name for getter_setter in getter_setters if not getter_setter.relationships for column in getter_setter.columns]
+                if not column_names:
+                    continue
+                
+                pending :Dict[Any, List[Any]] = {}
+                for obj in class_objs:
+                    if any(name not in obj.__dict__ for name in column_names):
+                        pending.setdefault(obj.get_primary_key(), []).append(obj)
+                
+                # Selecting the mapped attributes joins every table they are in:
+                primary_key_attribute = getattr(model_class, model_class.FieldsInfo.primary_key_name)
+                stmt = select(primary_key_attribute, *(getattr(model_class, name) for name in column_names))
+                primary_keys = list(pending.keys())
+                for i in range(0, len(primary_keys), chunk_size):
+                    for row in session.execute(stmt.where(primary_key_attribute.in_(primary_keys[i:i+chunk_size]))):
+                        for obj in pending[row[0]]:
+                            for name, value in zip(column_names, row[1:]):
+                                if name not in obj.__dict__:
+                                    attributes.set_committed_value(obj, name, value)
+    
+    def fetch_graph(self, model_class:type, primary_key:Any, fields:Optional[Iterable[str]]=None) -> Any:
+        '''
+        Returns the detached model_class object with primary_key along with
+        everything reachable from it, however far away, or None if there
+        isn't one.
+        
+        Rather than loading one hop at a time (eg: one query per edit while
+        following EditSource.original), the primary keys of everything
+        reachable are found with a single recursive CTE over the foreign key
+        columns and list mapping tables, then loaded with one SELECT per class
+        hierarchy and one per list field, and wired together in memory.
+        
+        :param fields: The names of the reference and list fields to follow
+        (eg: ["source", "original"]), by default all of them. Fields that are
+        not followed are left unloaded.
+        '''
+        if getattr(model_class, 'FieldsInfo', None) is None:
+            raise ValueError(f"No FieldsInfo found for class {model_class.__name__}")
+        if fields is not None:
+            fields = set(fields)
+        def follows(getter_setter:GetterSetter) -> bool:
+            return fields is None or getter_setter.field_info.field_name in fields
+        def base_of(cls:type) -> type:
+            return class_mapper(cls).base_mapper.class_
+        
+        # Objects are identified by the base class of their hierarchy and their
+        # primary key, which is only cast in the seed, so that each step below
+        # compares columns of their own type and can use their indexes:
+        root_pk_column = base_of(model_class).__table__.c[model_class.FieldsInfo.primary_key_name]
+        reachable = select(
+            literal(base_of(model_class).__name__).label("type"),
+            literal(primary_key, type_=root_pk_column.type).label("pk")
+        ).cte("reachable", recursive=True)
+        
+        # One recursive step per reference field and list field, each looking
+        # up the children of the rows reached so far by their parents key:
+        steps = []
+        for cls in self.data_decorator.decorated_classes.values():
+            parent_name = base_of(cls).__name__
+            parent_pk = cls.__table__.c[cls.FieldsInfo.primary_key_name]
+            for getter_setter in cls.__dict__["__getter_setters__"]:
+                if isinstance(getter_setter, OneToOneReference) and follows(getter_setter):
+                    child_fk = getter_setter.fk_column
+                    steps.append(
+                        select(literal(base_of(getter_setter.field_info.field_type).__name__), child_fk)
+                        .select_from(reachable.join(cls.__table__, parent_pk == reachable.c.pk))
+                        .where(reachable.c.type == parent_name, child_fk.isnot(None))
+                    )
+                elif isinstance(getter_setter, OneToMany_List) and follows(getter_setter):
+                    mapping_table = getter_setter.mapping_table
+                    steps.append(
+                        select(literal(base_of(getter_setter.field_info.field_type.__args__[0]).__name__), mapping_table.c[getter_setter.fk_name_field])
+                        .select_from(reachable.join(mapping_table, mapping_table.c[getter_setter.fk_name_parent] == reachable.c.pk))
+                        .where(reachable.c.type == parent_name)
+                    )
+        if steps:
+            # UNION rather than UNION ALL, so that cycles end:
+            reachable = reachable.union(*steps)
+        
+        with self.session() as session:
+            keys_by_base :Dict[str, List[str]] = {}
+            for type_name, pk in session.execute(select(reachable.c.type, reachable.c.pk)):
+                keys_by_base.setdefault(type_name, []).append(pk)
+            
+            objs :Dict[Tuple[type, Any], Any] = {}
+            for base_name, pks in keys_by_base.items():
+                base_class = self.data_decorator.decorated_classes[base_name]
+                primary_key_attribute = getattr(base_class, base_class.FieldsInfo.primary_key_name)
+                pk_type = base_class.FieldsInfo.get_field_type(base_class.FieldsInfo.primary_key_name)
+                pks = [pk_type(pk) for pk in pks]
+                stmt = select(polymorphic_entity(base_class, aliased=False)).options(lazyload("*"))
+                for i in range(0, len(pks), IN_CHUNK_SIZE):
+                    for obj in session.execute(stmt.where(primary_key_attribute.in_(pks[i:i+IN_CHUNK_SIZE]))).scalars():
+                        objs[(base_class, obj.get_primary_key())] = obj
+            
+            root = objs.get((base_of(model_class), primary_key), None)
+            if root is None or not isinstance(root, model_class):
+                detach_loaded(session, self)
+                return None
+            
+            for (base_class, pk), obj in objs.items():
+                for table, getter_setters in get_table_getter_setters(type(obj)):
+                    for getter_setter in getter_setters:
+                        if isinstance(getter_setter, OneToOneReference) and follows(getter_setter):
+                            child_pk = obj.__dict__.get(getter_setter.fk_name, None)
+                            child = None if child_pk is None else objs.get((base_of(getter_setter.field_info.field_type), child_pk), None)
+                            attributes.set_committed_value(obj, getter_setter.field_info.field_name, child)
+            
+            for cls in self.data_decorator.decorated_classes.values():
+                for getter_setter in cls.__dict__["__getter_setters__"]:
+                    if not isinstance(getter_setter, OneToMany_List) or not follows(getter_setter):
+                        continue
+                    parents = {pk: obj for (base_class, pk), obj in objs.items() if isinstance(obj, cls)}
+                    if not parents:
+                        continue
+                    item_base = base_of(getter_setter.field_info.field_type.__args__[0])
+                    mapping_table = getter_setter.mapping_table
+                    parent_fk = mapping_table.c[getter_setter.fk_name_parent]
+                    items :Dict[Any, List[Any]] = {pk: [] for pk in parents.keys()}
+                    parent_pks = list(parents.keys())
+                    for i in range(0, len(parent_pks), IN_CHUNK_SIZE):
+                        rows = session.execute(
+                            select(parent_fk, mapping_table.c[getter_setter.fk_name_field])
+                            .where(parent_fk.in_(parent_pks[i:i+IN_CHUNK_SIZE]))
+                            .order_by(parent_fk, mapping_table.c[getter_setter.position_name])
+                        )
+                        for parent_pk, item_pk in rows:
+                            items[parent_pk].append(objs.get((item_base, item_pk), None))
+                    for pk, obj in parents.items():
+                        attributes.set_committed_value(obj, getter_setter.items_key, items[pk])
+            
+            detach_loaded(session, self)
+        return root
+    
+    def iter(self, model_class:type, batch_size:int=1000, where:Any=None, load_lists:bool=False) -> Iterator[Any]:
+        '''
+        Yields every model_class object (that matches where) detached, while
+        only ever holding batch_size of them in memory, however large the
+        table is. Rows are streamed with yield_per (using a server side
+        cursor where the database supports one), and each batch is expunged
+        before the next one is loaded.
+        
+        References are not loaded, and raise DetachedInstanceError if they
+        are accessed.
+        
+        :param where: A criterion, or a list of them, to filter by.
+        :param load_lists: If True, the list fields of each batch are loaded
+        along with it, using one statement per list field per batch.
+        '''
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        
+        entity = polymorphic_entity(model_class, aliased=False)
+        stmt = select(entity).execution_options(yield_per=batch_size)
+        if where is not None:
+            stmt = stmt.where(*(where if isinstance(where, (list, tuple)) else [where]))
+        if load_lists:
+            stmt = stmt.options(*(
+                selectinload(getattr(model_class, getter_setter.rows_key)).joinedload(getter_setter.row_class.item)
+                for getter_setter in get_list_getter_setters(model_class)
+            ))
+        
+        with self.session() as session:
+            for batch in session.execute(stmt).scalars().partitions():
+                detach_loaded(session, self)
+                yield from batch
+    
+    def page(self, model_class:type, order_by:Union[str, Sequence[str]], after:Optional[str]=None, limit:int=50, descending:bool=False, where:Any=None, depth:int=DEFAULT_DEPTH) -> Page:
+        '''
+        Returns a Page of up to limit model_class objects sorted by the fields
+        order_by, that come after the opaque cursor after (the next_cursor
+        of the previous page). See DATAQuery.page.
+        
+        :param where: A criterion, or a list of them, to filter by.
+        '''
+        return self._where(model_class, where, depth).page(order_by, after, limit, descending)
+    
+    def _where(self, model_class:type, where:Any, depth:int=DEFAULT_DEPTH) -> DATAQuery:
+        query = self.query(model_class, depth)
+        if where is not None:
+            query = query.where(*(where if isinstance(where, (list, tuple)) else [where]))
+        return query
+    
+    def find(self, model_class:type, depth:int=DEFAULT_DEPTH, **field_values) -> List[Any]:
+        '''
+        Returns every detached model_class object whose fields have
+        field_values, see DATAQuery.find, eg:
+        engine.find(Message, conversation=conversation, date_created__gte=yesterday)
+        '''
+        return self.query(model_class, depth).find(**field_values).all()
+    
+    def count(self, model_class:type, where:Any=None) -> int:
+        '''
+        Returns how many model_class objects (subclasses included) there are
+        that match where, a criterion or a list of them.
+        '''
+        return self._where(model_class, where).count()
+    
+    def exists(self, model_class:type, where:Any=None) -> bool:
+        '''
+        Returns whether there is any model_class object that matches where.
+        '''
+        return self._where(model_class, where).exists()
+    
+    def min(self, model_class:type, field_name:str, where:Any=None) -> Any:
+        '''
+        Returns the smallest value of field_name among the model_class objects
+        that match where, see DATAQuery.min.
+        '''
+        return self._where(model_class, where).min(field_name)
+    
+    def max(self, model_class:type, field_name:str, where:Any=None) -> Any:
+        '''
+        Returns the largest value of field_name among the model_class objects
+        that match where, see DATAQuery.max.
+        '''
+        return self._where(model_class, where).max(field_name)
+    
+    def count_by(self, model_class:type, field_name:str, where:Any=None) -> Dict[Any, int]:
+        '''
+        Returns how many of the model_class objects that match where have each
+        value of field_name.
+        '''
+        return self._where(model_class, where).count_by(field_name)
+    
+    def query(self, model_class:type, depth:int=DEFAULT_DEPTH) -> DATAQuery:
+        '''
+        Returns a query for the objects of model_class (and its subclasses)
+        that loads them along with everything they reference up to depth
+        relationships away, and returns them detached. See DATAQuery.
+        '''
+        return DATAQuery(self, model_class, depth)
+    
     def has_tables(self) -> bool:
         with self.session_maker() as session:
             metadata = MetaData()
@@ -277,13 +1396,16 @@ class DATAEngine:
             return bool(metadata.tables)
     
     def has_data(self) -> bool:
-        with self.session_maker() as session:
-            metadata = MetaData()
-            metadata.reflect(bind=session.bind)
-            for table_name, table in metadata.tables.items():
-                if session.execute(table.select()).fetchone():
-                    return True
+        '''
+        Returns whether any table in the database has a row, using a single
+        EXISTS query rather than reflecting every table.
+        '''
+        table_names = inspect(self.engine).get_table_names()
+        if not table_names:
             return False
+        stmt = select(or_(*(exists(select(literal(1)).select_from(table_clause(name))) for name in table_names)))
+        with self.session_maker() as session:
+            return bool(session.execute(stmt).scalar())
         
     def to_json(self) -> dict:
         with self.session_maker() as session:
@@ -296,39 +1418,181 @@ class DATAEngine:
 
             return json_data
     
-    def insert_json(self, json_data :dict) -> None:
+    def insert_json(self, json_data :dict, chunk_size:int=1000) -> None:
+        '''
+        Inserts the rows of json_data (as returned by to_json) into their
+        tables, with one executemany per chunk_size rows, in foreign key
+        order so that it works with foreign keys enforced.
+        
+        Mapping rows from before lists had positions are numbered in the
+        order they appear in.
+        '''
         with self.session_maker() as session:
             metadata = MetaData()
             metadata.reflect(bind=session.bind)
             
-            for table_name, rows in json_data.items():
-                table = metadata.tables.get(table_name, None)
-                if table is None:
+            for table_name in json_data.keys():
+                if table_name not in metadata.tables:
                     print(f"Could not insert json into table '{table_name}' as it does not exist. This might be due to a model change, check your data, know your model and revert to backups if you need to. This table will simply be ignored for now.")
+            
+            # Foreign keys in cycles between tables are left out of the order
+            # (rather than warned about like sorted_tables does):
+            tables = [table for table, _ in sort_tables_and_constraints(metadata.tables.values()) if table is not None]
+            for table in tables:
+                rows = json_data.get(table.name, None)
+                if not rows:
                     continue
                 
-                # Identify columns that require conversion
-                columns_to_convert = {
-                    column_name: column.type
-                    for column_name, column in table.columns.items()
-                    if isinstance(column.type, DateTime)
-                }
-
-                # Prepare and insert data for each row
-                for row_data in rows:
-                    if columns_to_convert:
-                        # Only copy and convert if necessary
-                        row_copy = row_data.copy()
-                        for column_name, column_type in columns_to_convert.items():
-                            if column_name in row_copy:
-                                row_copy[column_name] = convert_to_column_type(row_copy[column_name], column_type)
-                        session.execute(table.insert(), row_copy)
-                    else:
-                        # Insert directly if no conversions are needed
-                        session.execute(table.insert(), row_data)
-
+                next_positions = {}
+                for i in range(0, len(rows), chunk_size):
+                    chunk = self._with_list_positions(table.name, rows[i:i+chunk_size], next_positions)
+                    self._insert_rows(session, table, chunk)
+            
             session.commit()
     
+    def export(self, path_or_stream:Union[str, IO[str]], chunk_size:int=1000) -> None:
+        '''
+        Writes every row of every table in the database to path_or_stream,
+        a path or a text stream, as the same JSON to_json returns (so the
+        file can be json.load-ed and given to insert_json). Tables are
+        written one at a time in foreign key order, and their rows are
+        fetched chunk_size at a time, so memory use does not grow with the
+        size of the database.
+        
+        Each row is written on a line of its own, which restore relies on to
+        read them back just as incrementally.
+        '''
+        from ClassyFlaskDB.serialization import JSONEncoder
+        
+        metadata = MetaData()
+        metadata.reflect(bind=self.engine)
+        tables = metadata.sorted_tables
+        with open_text(path_or_stream, "w") as stream, self.engine.connect() as connection:
+            stream.write("{\n")
+            for i, table in enumerate(tables):
+                stream.write(f"{json.dumps(table.name)}: [\n")
+                separator = ""
+                result = connection.execution_options(yield_per=chunk_size).execute(table.select())
+                for rows in result.partitions():
+                    for row in rows:
+                        stream.write(separator)
+                        stream.write(json.dumps(row._asdict(), cls=JSONEncoder))
+                        separator = ",\n"
+                stream.write("\n]" + ("," if i < len(tables)-1 else "") + "\n")
+            stream.write("}\n")
+    
+    def restore(self, path_or_stream:Union[str, IO[str]], chunk_size:int=1000) -> None:
+        '''
+        Inserts the rows that export wrote to path_or_stream, reading and
+        inserting them chunk_size rows at a time, in a single transaction.
+        
+        Tables that no longer exist are skipped, and so are columns that no
+        longer exist.
+        '''
+        metadata = MetaData()
+        metadata.reflect(bind=self.engine)
+        with open_text(path_or_stream, "r") as stream, self.session_maker() as session:
+            if stream.readline().strip() != "{":
+                raise ValueError("This is not a database export, it does not start with a line holding only '{'.")
+            
+            table = None
+            in_table = False
+            rows = []
+            for line in stream:
+                line = line.strip()
+                if not line:
+                    continue
+                if not in_table:
+                    if line == "}":
+                        break
+                    # eg: "Message_Table": [
+                    table_name = json.loads(line.rpartition(":")[0])
+                    table = metadata.tables.get(table_name, None)
+                    if table is None:
+                        print(f"Could not restore table '{table_name}' as it does not exist. This might be due to a model change, check your data, know your model and revert to backups if you need to. This table will simply be ignored for now.")
+                    next_positions = {}
+                    in_table = True
+                elif line == "]" or line == "],":
+                    if table is not None and rows:
+                        self._insert_rows(session, table, self._with_list_positions(table.name, rows, next_positions))
+                    rows = []
+                    in_table = False
+                elif table is not None:
+                    rows.append(json.loads(line.rstrip(",")))
+                    if len(rows) >= chunk_size:
+                        self._insert_rows(session, table, self._with_list_positions(table.name, rows, next_positions))
+                        rows = []
+            session.commit()
+    
+    def _with_list_positions(self, table_name:str, rows:List[Dict[str, Any]], next_positions:Dict[Any, int]) -> List[Dict[str, Any]]:
+        '''
+        Returns rows, with the rows of a list mapping table that were stored
+        before lists had positions given the positions of the order they
+        come in. next_positions holds the next position of each list between
+        calls, so a table's rows can be given a chunk at a time.
+        '''
+        decorator_table = self.decorator_metadata.tables.get(table_name, None)
+        position_name = None if decorator_table is None else decorator_table.info.get("list_position", None)
+        if position_name is None:
+            return rows
+        
+        parent_fk = decorator_table.info["list_parent_fk"]
+        numbered = []
+        for row in rows:
+            parent = row.get(parent_fk, None)
+            position = row.get(position_name, None)
+            if position is None:
+                position = next_positions.get(parent, 0)
+                row = dict(row, **{position_name: position})
+            next_positions[parent] = max(next_positions.get(parent, 0), position + 1)
+            numbered.append(row)
+        return numbered
+    
+    @staticmethod
+    def _insert_rows(session:Any, table:Table, rows:List[Dict[str, Any]]) -> None:
+        '''
+        Inserts rows into table in order with an executemany per run of rows
+        with the same columns, converting the values of its datetime columns and
+        dropping values of columns it does not have.
+        '''
+        column_types = {column.name: column.type for column in table.columns}
+        datetime_names = [name for name, column_type in column_types.items() if isinstance(column_type, DateTime)]
+        # An executemany needs every row to have the same columns, so each
+        # run of rows with the same columns gets one, keeping the rows in
+        # order (rows can reference rows before them in the same table):
+        run_names = None
+        run :List[Dict[str, Any]] = []
+        for row in rows:
+            row = {name: value for name, value in row.items() if name in column_types}
+            for name in datetime_names:
+                if name in row:
+                    row[name] = convert_to_column_type(row[name], column_types[name])
+            names = row.keys()
+            if run and names != run_names:
+                session.execute(table.insert(), run)
+                run = []
+            run_names = names
+            run.append(row)
+        if run:
+            session.execute(table.insert(), run)
+    
+    def clear(self) -> None:
+        '''
+        Deletes every row of every DATA table, and forgets everything this
+        engine knew about the objects it loaded or persisted, so that it can
+        be reused as if it were new.
+        '''
+        with self.engine.begin() as connection:
+            for table in reversed(self.decorator_metadata.sorted_tables):
+                connection.execute(table.delete())
+        if self.known_hash_ids is not None:
+            self.known_hash_ids = {}
+        if self.identity_cache is not None:
+            self.identity_cache.clear()
+        # Objects marked clean for this engine no longer are:
+        self.engine_token = object()
+        self._key_generations = {}
+    
     def dispose(self):
         self.session_maker.close_all()
         self.engine.dispose()
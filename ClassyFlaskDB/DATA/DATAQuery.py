@@ -0,0 +1,509 @@
+from sqlalchemy import Select, select, and_, or_, func
+from sqlalchemy.orm import class_mapper, selectinload, joinedload, lazyload, raiseload, noload, with_polymorphic, defer, undefer
+from typing import Any, Dict, Generic, List, Optional, Sequence, Type, TypeVar, Union
+from dataclasses import dataclass
+from datetime import datetime
+from copy import copy
+import base64
+import json
+
+from ClassyFlaskDB.helpers.Decorators.to_sql import get_table_getter_setters, get_field_getter_setter, get_field_column, GetterSetter, OneToOneReference, OneToMany_List, EnumGetterSetter, DateTimeGetterSetter
+
+T = TypeVar("T")
+
+DEFAULT_DEPTH = 3
+
+# The most tables loading_plan joins into one statement (SQLite allows at
+# most 64), past which it selectin loads in another statement instead:
+MAX_JOINED_TABLES = 32
+
+# The loader option for each value of the "load" field metadata:
+LOADERS = {
+    "selectin": selectinload,
+    "joined": joinedload,
+    "lazy": lazyload,
+    "raise": raiseload,
+    "noload": noload,
+}
+
+def mapped_subclasses(cls:Type[Any]) -> List[Type[Any]]:
+    '''
+    Returns every DATA class that inherits from cls, however indirectly.
+    '''
+    subclasses = []
+    for subclass in cls.__subclasses__():
+        if "__getter_setters__" in subclass.__dict__:
+            subclasses.append(subclass)
+            subclasses.extend(mapped_subclasses(subclass))
+    return subclasses
+
+def polymorphic_entity(cls:Type[Any], aliased:bool=True) -> Any:
+    '''
+    Returns what to select (or load a relationship as) to get instances of cls
+    and of any of its subclasses, with the columns of all of them.
+
+    :param aliased: False to select from cls's own tables, so that criteria
+    written against cls apply to it.
+    '''
+    subclasses = mapped_subclasses(cls)
+    if len(subclasses) == 0:
+        return cls
+    return with_polymorphic(cls, subclasses, flat=aliased)
+
+def _relationship_fields(cls:Type[Any], own_only:bool) -> List[tuple]:
+    '''
+    Returns (attribute name, referenced class, list row class, load metadata)
+    for every field of cls that references other DATA objects. Lists are
+    loaded as their mapping rows (see OneToMany_List), so theirs is the
+    attribute of those rows, and references have no row class.
+    '''
+    if own_only:
+        getter_setters = cls.__dict__["__getter_setters__"]
+    else:
+        getter_setters = [gs for table, table_getter_setters in get_table_getter_setters(cls) for gs in table_getter_setters]
+
+    fields = []
+    for getter_setter in getter_setters:
+        if isinstance(getter_setter, OneToOneReference):
+            fields.append((getter_setter.field_info.field_name, getter_setter.field_info.field_type, None, getter_setter.load))
+        elif isinstance(getter_setter, OneToMany_List):
+            fields.append((getter_setter.rows_key, getter_setter.field_info.field_type.__args__[0], getter_setter.row_class, getter_setter.load))
+    return fields
+
+def _table_count(cls:Type[Any], entity:Any) -> int:
+    '''
+    Returns how many tables loading entity (cls or its polymorphic_entity) joins.
+    '''
+    tables = set(class_mapper(cls).tables)
+    if entity is not cls:
+        for subclass in mapped_subclasses(cls):
+            tables.update(class_mapper(subclass).tables)
+    return len(tables)
+
+def loading_plan(cls:Type[Any], entity:Any, depth:int, parent_option:Any=None, joined_tables:List[int]=None) -> List[Any]:
+    '''
+    Returns the loader options that eagerly load everything reachable from
+    entity (the polymorphic_entity of cls) through its fields, up to depth
+    relationships away. Lists are selectin loaded and references are joined,
+    unless their field's "load" metadata says otherwise. Fields that are not
+    eagerly loaded that way are not followed any further.
+
+    References to classes with subclasses join all of their tables, so a
+    join that would take a statement past MAX_JOINED_TABLES tables is
+    selectin loaded instead, in a statement of its own.
+
+    :param parent_option: The option that loads entity, that the returned ones are chained to.
+    :param joined_tables: How many tables the statement loading entity joins so far, in a list so the fields joined into it can add to it.
+    '''
+    options = []
+    if depth <= 0:
+        return options
+    if joined_tables is None:
+        joined_tables = [_table_count(cls, entity)]
+
+    # Fields declared by subclasses are only reachable through with_polymorphic:
+    owners = [(cls, entity, _relationship_fields(cls, own_only=False))]
+    if entity is not cls:
+        for subclass in mapped_subclasses(cls):
+            owners.append((subclass, getattr(entity, subclass.__name__), _relationship_fields(subclass, own_only=True)))
+
+    for owner, owner_entity, fields in owners:
+        for attribute_name, field_type, row_class, load_strategy in fields:
+            is_list = row_class is not None
+            attribute = getattr(owner_entity, attribute_name)
+            field_entity = polymorphic_entity(field_type)
+            item_attribute = row_class.item if is_list else attribute
+            if field_entity is not field_type:
+                item_attribute = item_attribute.of_type(field_entity)
+            if not is_list:
+                attribute = item_attribute
+
+            if load_strategy is None:
+                load = selectinload if is_list else joinedload
+            else:
+                load = LOADERS[load_strategy]
+
+            # A list's rows come through its mapping table:
+            field_tables = _table_count(field_type, field_entity) + (1 if is_list else 0)
+            if load is joinedload:
+                if joined_tables[0] + field_tables > MAX_JOINED_TABLES:
+                    load = selectinload
+                else:
+                    joined_tables[0] += field_tables
+
+            if parent_option is None:
+                option = load(attribute)
+            else:
+                option = getattr(parent_option, load.__name__)(attribute)
+            if is_list and load in (joinedload, selectinload):
+                # Each row's item is joined to it:
+                option = option.joinedload(item_attribute)
+            options.append(option)
+            if load is joinedload:
+                options.extend(loading_plan(field_type, field_entity, depth-1, option, joined_tables))
+            elif load is selectinload:
+                options.extend(loading_plan(field_type, field_entity, depth-1, option, [field_tables]))
+    return options
+
+@dataclass
+class Page(Generic[T]):
+    '''
+    A page of results from DATAQuery.page.
+    
+    next_cursor is None once there are no more results after these.
+    '''
+    items: List[T]
+    next_cursor: Optional[str]
+
+def _encode_key_value(value:Any) -> Any:
+    if isinstance(value, datetime):
+        return {"datetime": value.isoformat()}
+    return value
+
+def _decode_key_value(value:Any) -> Any:
+    if isinstance(value, dict):
+        return datetime.fromisoformat(value["datetime"])
+    return value
+
+def encode_cursor(order_by:List[str], descending:bool, key:List[Any]) -> str:
+    '''
+    Returns an opaque cursor for the page after the one whose last object's
+    sort key is key.
+    '''
+    cursor = {"order_by": order_by, "descending": descending, "key": [_encode_key_value(value) for value in key]}
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor:str, order_by:List[str], descending:bool) -> List[Any]:
+    '''
+    Returns the sort key cursor continues after, checking it was made for
+    the same ordering.
+    '''
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except ValueError as e:
+        raise ValueError("Invalid page cursor.") from e
+    if decoded.get("order_by", None) != order_by or decoded.get("descending", None) != descending:
+        raise ValueError(f"The page cursor is for a different ordering than {order_by}.")
+    return [_decode_key_value(value) for value in decoded["key"]]
+
+def keyset_criterion(columns:List[Any], key:List[Any], descending:bool) -> Any:
+    '''
+    Returns the criterion that rows sorted by columns come after key, eg:
+    (a > 1) OR (a = 1 AND b > 2)
+    '''
+    alternatives = []
+    for i, column in enumerate(columns):
+        after = column < key[i] if descending else column > key[i]
+        alternatives.append(and_(*(columns[j] == key[j] for j in range(i)), after))
+    return or_(*alternatives)
+
+# The operators find understands, as suffixes of the field names it is given:
+OPERATORS = {
+    "gt": lambda column, value: column > value,
+    "gte": lambda column, value: column >= value,
+    "lt": lambda column, value: column < value,
+    "lte": lambda column, value: column <= value,
+    "ne": lambda column, value: column != value,
+    "in": lambda column, values: column.in_(values),
+}
+
+def to_column_value(getter_setter:GetterSetter, value:Any) -> Any:
+    '''
+    Returns value, a value of the field getter_setter stores, the way it is
+    stored in that field's column (see get_field_column).
+    '''
+    if value is None:
+        return None
+    if isinstance(getter_setter, DateTimeGetterSetter):
+        return value.replace(tzinfo=None)
+    if isinstance(getter_setter, EnumGetterSetter):
+        return str(value.value)
+    if isinstance(getter_setter, OneToOneReference) and hasattr(value, "FieldsInfo"):
+        return value.get_primary_key()
+    return value
+
+def field_criterion(cls:Type[Any], key:str, value:Any) -> Any:
+    '''
+    Returns the criterion that the field named by key of a cls object has
+    value, where key is a field name optionally followed by one of
+    OPERATORS, eg: "date_created__gte".
+    '''
+    field_name, operator = key, None
+    if "__" in key:
+        name, suffix = key.rsplit("__", 1)
+        if suffix in OPERATORS:
+            field_name, operator = name, suffix
+
+    getter_setter = get_field_getter_setter(cls, field_name)
+    column = get_field_column(cls, field_name)
+    if operator == "in":
+        return OPERATORS[operator](column, [to_column_value(getter_setter, v) for v in value])
+    value = to_column_value(getter_setter, value)
+    if operator is None:
+        return column == value
+    return OPERATORS[operator](column, value)
+
+def detach_loaded(session:Any, data_engine:"DATAEngine") -> None:
+    '''
+    Marks everything session loaded clean for data_engine and expunges it.
+    '''
+    # The load event marks objects clean before their eager loaded
+    # relationships are populated, so mark them again now they are:
+    # Expunged one by one rather than with expunge_all, which would replace
+    # the identity map that a streaming result is still loading into:
+    for obj in list(session.identity_map.values()):
+        # (lists' mapping rows are not DATA objects)
+        if getattr(type(obj), "FieldsInfo", None) is not None:
+            data_engine.mark_clean(obj)
+        # (expunge cascades, so it may already be gone)
+        if obj in session:
+            session.expunge(obj)
+
+class DATAQuery(Generic[T]):
+    '''
+    A query for the objects of a DATA class, see DATAEngine.query.
+
+    Results are loaded along with everything reachable from them through
+    their fields, up to depth relationships away, using one statement per
+    list field in the loading plan (references are joined into the
+    statement that loads the object holding them) rather than one per
+    object, and are returned detached. They are also added to the engine's
+    identity_cache if it has one, unless defer left some of their fields out.
+
+    Relationships further than depth away are not loaded, and raise
+    DetachedInstanceError if they are accessed.
+
+    Deferred fields (see to_sql) are not loaded unless they are undeferred,
+    and other fields can be left out of a query with defer. Fields that were
+    not loaded raise DetachedInstanceError if they are accessed, and are left
+    as they are by writes of the objects they are missing from. They can be
+    loaded afterwards with DATAEngine.undefer.
+
+    count, exists, min, max, and count_by answer questions about the
+    matching rows in SQL without loading any objects.
+
+    Like SQLAlchemy's own queries, where, filter_by, order_by, limit,
+    offset, defer, and undefer return a new query rather than changing this
+    one.
+    '''
+    def __init__(self, data_engine:"DATAEngine", model_class:Type[T], depth:int=DEFAULT_DEPTH):
+        if getattr(model_class, 'FieldsInfo', None) is None:
+            raise ValueError(f"No FieldsInfo found for class {model_class.__name__}")
+
+        self.data_engine = data_engine
+        self.model_class = model_class
+        self.depth = depth
+        self._criteria = []
+        self._order_by = []
+        self._limit :Optional[int] = None
+        self._offset :Optional[int] = None
+        self._column_options = []
+        # Whether fields that are normally loaded are left out:
+        self._narrowed = False
+
+    def _clone(self) -> "DATAQuery[T]":
+        query = copy(self)
+        query._criteria = list(self._criteria)
+        query._order_by = list(self._order_by)
+        query._column_options = list(self._column_options)
+        return query
+
+    def where(self, *criteria) -> "DATAQuery[T]":
+        query = self._clone()
+        query._criteria.extend(criteria)
+        return query
+
+    def find(self, **field_values) -> "DATAQuery[T]":
+        '''
+        Filters by the values of the model class's fields, the same values
+        the fields hold on its objects (datetimes, enums, referenced
+        objects...), which are compared to the columns that store them. So
+        the filters run in SQL, using any index on those columns.
+
+        A field name can end with one of __gt, __gte, __lt, __lte, __ne, or
+        __in to compare by something other than equality, eg:
+        query.find(status=Status.OPEN, date_created__gte=last_week, author__in=[alice, bob])
+
+        Datetimes are compared without their timezone, see page, and
+        references by the primary key of the object they reference (which
+        can also be given instead of the object).
+        '''
+        return self.where(*(field_criterion(self.model_class, key, value) for key, value in field_values.items()))
+
+    def filter_by(self, **field_values) -> "DATAQuery[T]":
+        return self.find(**field_values)
+
+    def order_by(self, *clauses) -> "DATAQuery[T]":
+        query = self._clone()
+        query._order_by.extend(clauses)
+        return query
+
+    def limit(self, limit:Optional[int]) -> "DATAQuery[T]":
+        query = self._clone()
+        query._limit = limit
+        return query
+
+    def offset(self, offset:Optional[int]) -> "DATAQuery[T]":
+        query = self._clone()
+        query._offset = offset
+        return query
+
+    def defer(self, *field_names:str) -> "DATAQuery[T]":
+        '''
+        Leaves the fields field_names of the model class out of the query.
+        Its results are then not added to the identity_cache, since they
+        are missing fields that get would otherwise serve from it.
+        '''
+        query = self._with_column_option(defer, field_names)
+        query._narrowed = True
+        return query
+
+    def undefer(self, *field_names:str) -> "DATAQuery[T]":
+        '''
+        Loads the deferred fields field_names of the model class along with
+        the rest of its fields.
+        '''
+        return self._with_column_option(undefer, field_names)
+
+    def _with_column_option(self, option:Any, field_names:Sequence[str]) -> "DATAQuery[T]":
+        query = self._clone()
+        for field_name in field_names:
+            getter_setter = get_field_getter_setter(self.model_class, field_name)
+            if getter_setter.field_info.is_primary_key or getter_setter.relationships or not getter_setter.columns:
+                raise ValueError(f"{self.model_class.__name__}.{field_name} can not be deferred, only fields stored in columns of their own can be.")
+            query._column_options.extend(option(getattr(self.model_class, column.name)) for column in getter_setter.columns)
+        return query
+
+    def statement(self) -> Select:
+        '''
+        Returns the select statement this query runs, loader options included.
+        '''
+        entity = polymorphic_entity(self.model_class, aliased=False)
+        stmt = select(entity).options(*loading_plan(self.model_class, entity, self.depth), *self._column_options)
+        if self._criteria:
+            stmt = stmt.where(*self._criteria)
+        if self._order_by:
+            stmt = stmt.order_by(*self._order_by)
+        if self._limit is not None:
+            stmt = stmt.limit(self._limit)
+        if self._offset is not None:
+            stmt = stmt.offset(self._offset)
+        return stmt
+
+    def _aggregate_statement(self, *columns) -> Select:
+        '''
+        Returns a select of columns over the rows of the model class (and its
+        subclasses) that match this query's criteria.
+        '''
+        stmt = select(*columns).select_from(polymorphic_entity(self.model_class, aliased=False))
+        if self._criteria:
+            stmt = stmt.where(*self._criteria)
+        return stmt
+
+    def _scalar(self, stmt:Select) -> Any:
+        with self.data_engine.session() as session:
+            return session.execute(stmt).scalar()
+
+    def _field_column(self, field_name:str) -> tuple:
+        getter_setter = get_field_getter_setter(self.model_class, field_name)
+        return getter_setter, get_field_column(self.model_class, field_name)
+
+    @staticmethod
+    def _field_value(getter_setter:GetterSetter, value:Any) -> Any:
+        if value is not None and isinstance(getter_setter, EnumGetterSetter):
+            return {str(member.value): member for member in getter_setter.field_info.field_type}.get(value, None)
+        return value
+
+    def count(self) -> int:
+        '''
+        Returns how many objects this query matches, limit and offset included.
+        '''
+        primary_key_attribute = getattr(self.model_class, self.model_class.FieldsInfo.primary_key_name)
+        if self._limit is None and self._offset is None:
+            return self._scalar(self._aggregate_statement(func.count(primary_key_attribute)))
+        matched = self._aggregate_statement(primary_key_attribute).limit(self._limit).offset(self._offset).subquery()
+        return self._scalar(select(func.count()).select_from(matched))
+
+    def exists(self) -> bool:
+        '''
+        Returns whether this query matches anything.
+        '''
+        primary_key_attribute = getattr(self.model_class, self.model_class.FieldsInfo.primary_key_name)
+        return self._scalar(self._aggregate_statement(primary_key_attribute).offset(self._offset).limit(1)) is not None
+
+    def min(self, field_name:str) -> Any:
+        '''
+        Returns the smallest value of the field field_name among the objects
+        this query matches, or None if it matches none. Datetimes are
+        compared (and returned) without their timezone, see page.
+        '''
+        getter_setter, column = self._field_column(field_name)
+        return self._field_value(getter_setter, self._scalar(self._aggregate_statement(func.min(column))))
+
+    def max(self, field_name:str) -> Any:
+        '''
+        Returns the largest value of the field field_name among the objects
+        this query matches, or None if it matches none. Datetimes are
+        compared (and returned) without their timezone, see page.
+        '''
+        getter_setter, column = self._field_column(field_name)
+        return self._field_value(getter_setter, self._scalar(self._aggregate_statement(func.max(column))))
+
+    def count_by(self, field_name:str) -> Dict[Any, int]:
+        '''
+        Returns how many of the objects this query matches have each value
+        of the field field_name. References are counted by the primary key
+        of the object they reference.
+        '''
+        getter_setter, column = self._field_column(field_name)
+        stmt = self._aggregate_statement(column, func.count()).group_by(column)
+        with self.data_engine.session() as session:
+            return {self._field_value(getter_setter, value): count for value, count in session.execute(stmt)}
+
+    def all(self) -> List[T]:
+        with self.data_engine.session() as session:
+            results = session.execute(self.statement()).unique().scalars().all()
+            detach_loaded(session, self.data_engine)
+
+        if self.data_engine.identity_cache is not None and not self._narrowed:
+            for obj in results:
+                self.data_engine._cache(obj, self.depth)
+        return results
+
+    def first(self) -> Optional[T]:
+        results = self.limit(1).all()
+        return results[0] if results else None
+
+    def page(self, order_by:Union[str, Sequence[str]], after:Optional[str]=None, limit:int=50, descending:bool=False) -> Page[T]:
+        '''
+        Returns up to limit results that come after the cursor after, sorted
+        by the fields order_by, and the cursor for the page that follows.
+
+        Rather than an OFFSET, which has to skip every row before the page,
+        pages are found with a keyset predicate on the sort columns. So each
+        page takes about as long as the first, given an index on them (see
+        the "index" field metadata). The primary key is always added as the
+        last sort column so that every row has a distinct key, and the other
+        fields should not be None.
+
+        Datetime fields are compared by their timezone naive __DateTimeObj
+        column, enums by their value, and references by their foreign key.
+        '''
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        order_by = [order_by] if isinstance(order_by, str) else list(order_by)
+        primary_key_name = self.model_class.FieldsInfo.primary_key_name
+        if primary_key_name not in order_by:
+            order_by.append(primary_key_name)
+        columns = [get_field_column(self.model_class, field_name) for field_name in order_by]
+
+        query = self.order_by(*(column.desc() if descending else column.asc() for column in columns)).limit(limit+1)
+        if after is not None:
+            query = query.where(keyset_criterion(columns, decode_cursor(after, order_by, descending), descending))
+
+        items = query.all()
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = encode_cursor(order_by, descending, [getattr(items[-1], column.name) for column in columns])
+        return Page(items, next_cursor)
@@ -0,0 +1,67 @@
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+from contextlib import contextmanager
+from typing import Iterator, List
+import threading
+
+from ClassyFlaskDB.DATA.DATAEngine import DATAEngine
+
+class EnginePool:
+    '''
+    A thread safe pool of in-memory DATAEngines for a DATADecorator, for
+    work that needs a scratch database (like serializing a single object)
+    without paying for creating every table each time.
+
+    Each engine is handed to one caller at a time, and is cleared (see
+    DATAEngine.clear) rather than disposed when it is given back. At most
+    max_idle engines are kept around between uses.
+    '''
+    def __init__(self, data_decorator:"DATADecorator", max_idle:int=4):
+        self.data_decorator = data_decorator
+        self.max_idle = max_idle
+        self._idle :List[DATAEngine] = []
+        self._lock = threading.Lock()
+
+    def _create(self) -> DATAEngine:
+        # A single connection shared by whichever thread has the engine,
+        # since every connection to :memory: is a database of its own:
+        engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+        return DATAEngine(self.data_decorator, engine=engine, should_backup=False, auto_add_new_columns=False, auto_replace_database_fallback=False)
+
+    @contextmanager
+    def engine(self) -> Iterator[DATAEngine]:
+        '''
+        Lends out an empty engine for the duration of the with block.
+        '''
+        with self._lock:
+            data_engine = self._idle.pop() if self._idle else None
+        if data_engine is None:
+            data_engine = self._create()
+        else:
+            # Classes may have been decorated since the engine was made:
+            self.data_decorator.finalize()
+            if len(data_engine.decorator_metadata.tables) != data_engine._table_count:
+                data_engine.decorator_metadata.create_all(data_engine.engine)
+                data_engine._table_count = len(data_engine.decorator_metadata.tables)
+
+        try:
+            yield data_engine
+        except BaseException:
+            data_engine.dispose()
+            raise
+
+        data_engine.clear()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(data_engine)
+                return
+        data_engine.dispose()
+
+    def dispose(self) -> None:
+        '''
+        Disposes of every idle engine.
+        '''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for data_engine in idle:
+            data_engine.dispose()
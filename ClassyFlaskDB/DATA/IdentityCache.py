@@ -0,0 +1,150 @@
+from sqlalchemy.orm import class_mapper
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass
+import threading
+import sys
+
+from ClassyFlaskDB.DATA.ID_Type import ID_Type
+
+def identity_key(cls:type, primary_key:Any) -> Tuple[type, Any]:
+    '''
+    Returns the key an object of cls is cached under. Objects are keyed by the
+    base class of their hierarchy, the same way SQLAlchemy's identity map is,
+    so that getting a Base by primary key finds a cached Sub.
+    '''
+    return (class_mapper(cls).base_mapper.class_, primary_key)
+
+def estimate_size(objs:Iterable[Any]) -> int:
+    '''
+    Returns a rough estimate, in bytes, of the memory used by the field
+    values of objs, not counting the DATA objects they reference.
+    '''
+    size = 0
+    for obj in objs:
+        size += sys.getsizeof(obj)
+        for name, value in obj.__dict__.items():
+            if name.startswith("_sa_") or hasattr(value, "FieldsInfo") or isinstance(value, list):
+                continue
+            size += sys.getsizeof(value)
+    return size
+
+@dataclass
+class CacheEntry:
+    obj: Any
+    depth: int
+    contained_keys: Set[Tuple[type, Any]]
+    size: int
+
+class IdentityCache:
+    '''
+    A thread safe LRU cache of detached DATA objects keyed by class and
+    primary key, that a DATAEngine shares across its sessions (see
+    DATAEngine.get).
+
+    Each entry holds an object along with everything loaded from it (up to
+    depth relationships away), and is dropped when any object in it is
+    invalidated. HASHID objects can not change, so writing them never
+    invalidates anything.
+
+    The least recently used entries are evicted once there are more than
+    max_count of them, or once their estimated size is over max_bytes.
+    '''
+    def __init__(self, max_count:int=10000, max_bytes:Optional[int]=None):
+        if max_count < 1:
+            raise ValueError("max_count must be at least 1")
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+
+        self._entries :"OrderedDict[Tuple[type, Any], CacheEntry]" = OrderedDict()
+        # The keys of the entries each object key is part of:
+        self._containing :Dict[Tuple[type, Any], Set[Tuple[type, Any]]] = {}
+        self._size = 0
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        '''The estimated size of every cached entry, in bytes.'''
+        return self._size
+
+    def get(self, cls:type, primary_key:Any, depth:int=0) -> Optional[Any]:
+        '''
+        Returns the cached cls object with primary_key if it was loaded at
+        least depth relationships deep, otherwise None.
+        '''
+        key = identity_key(cls, primary_key)
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None or entry.depth < depth or not isinstance(entry.obj, cls):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.obj
+
+    def put(self, obj:Any, depth:int, contained_objs:Iterable[Any]) -> None:
+        '''
+        Caches obj, which was loaded depth relationships deep.
+
+        :param contained_objs: Every object loaded from obj (including obj),
+        so that invalidating any of them drops obj.
+        '''
+        contained_objs = list(contained_objs)
+        key = identity_key(type(obj), obj.get_primary_key())
+        entry = CacheEntry(
+            obj, depth,
+            set(identity_key(type(o), o.get_primary_key()) for o in contained_objs),
+            estimate_size(contained_objs)
+        )
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._size += entry.size
+            for contained_key in entry.contained_keys:
+                self._containing.setdefault(contained_key, set()).add(key)
+            self._evict()
+
+    def invalidate(self, cls:type, primary_key:Any) -> None:
+        '''
+        Drops every entry that holds the cls object with primary_key.
+        '''
+        key = identity_key(cls, primary_key)
+        with self._lock:
+            for entry_key in list(self._containing.get(key, ())):
+                self._remove(entry_key)
+
+    def written(self, cls:type, primary_key:Any) -> None:
+        '''
+        Invalidates the cls object with primary_key, since it was written,
+        unless it is a HASHID object.
+        '''
+        if getattr(cls, "_id_type_", None) is not ID_Type.HASHID:
+            self.invalidate(cls, primary_key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._containing.clear()
+            self._size = 0
+
+    def _remove(self, key:Tuple[type, Any]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._size -= entry.size
+        for contained_key in entry.contained_keys:
+            containing = self._containing.get(contained_key, None)
+            if containing is not None:
+                containing.discard(key)
+                if len(containing) == 0:
+                    del self._containing[contained_key]
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_count or (self.max_bytes is not None and self._size > self.max_bytes):
+            self._remove(next(iter(self._entries)))
@@ -1,7 +1,11 @@
 from dataclasses import field, dataclass
 
 from .DATADecorator import DATADecorator, ID_Type
-from .DATAEngine import DATAEngine, Session
+from .DATAEngine import DATAEngine, Session, ChunkStats
+from .DATAQuery import DATAQuery, Page
+from .IdentityCache import IdentityCache
+from .EnginePool import EnginePool
+from .materializer import materialize, materialize_all
 
 def print_DATA_json(json_data:dict) -> None:
 	from ClassyFlaskDB.serialization import JSONEncoder
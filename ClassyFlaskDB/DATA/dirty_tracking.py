@@ -0,0 +1,143 @@
+'''
+Field level dirty tracking for DATA decorated classes.
+
+Every DATA object records the names of the attributes assigned on it, but only
+once it has been marked clean for a DATAEngine, which happens when that engine
+loads or persists it. Until then an object is simply considered dirty.
+
+References and lists can change without anything being assigned to the object
+holding them (eg: list.append, or a referenced HASHID object being re-hashed),
+so the primary keys they held when the object was marked clean are kept and
+compared as well.
+
+The row an object was marked clean for can also be overwritten (by another
+instance with the same primary key) or deleted, so the engine keeps a
+generation for every such key, bumped whenever that happens, and a clean mark
+only holds while the generation it was taken at is the current one.
+'''
+from typing import Any, Dict, Optional, Set, Type
+
+from ClassyFlaskDB.helpers.Decorators.to_sql import list_items_key, list_rows_key
+
+DIRTY_FIELDS = "_DATA_dirty_fields"
+CLEAN_FOR = "_DATA_clean_for"
+CLEAN_KEYS = "_DATA_clean_keys"
+CLEAN_GENERATION = "_DATA_clean_generation"
+
+class _Unloaded:
+    '''Marks a reference or list that was not loaded when its key was taken.'''
+    def __repr__(self) -> str:
+        return "<unloaded>"
+UNLOADED = _Unloaded()
+
+def track_dirty_fields(cls:Type[Any]) -> Type[Any]:
+    '''
+    Installs a __setattr__ on cls that records the names of the attributes
+    assigned on its (clean) instances.
+    '''
+    if getattr(cls, "__tracks_dirty_fields__", False):
+        return cls
+
+    base_setattr = cls.__setattr__
+    def __setattr__(self, name:str, value:Any) -> None:
+        base_setattr(self, name, value)
+        dirty_fields = self.__dict__.get(DIRTY_FIELDS, None)
+        if dirty_fields is not None:
+            dirty_fields.add(name)
+
+    setattr(cls, "__setattr__", __setattr__)
+    setattr(cls, "__tracks_dirty_fields__", True)
+    return cls
+
+def _reference_key(obj:Any, field_name:str) -> Any:
+    obj_dict = obj.__dict__
+    if field_name in obj_dict:
+        value = obj_dict[field_name]
+        return None if value is None else value.get_primary_key()
+    return obj_dict.get(f"{field_name}_fk", UNLOADED)
+
+def _list_key(obj:Any, field_name:str) -> Any:
+    obj_dict = obj.__dict__
+    items_key, rows_key = list_items_key(field_name), list_rows_key(field_name)
+    if items_key in obj_dict:
+        items = obj_dict[items_key]
+    elif rows_key in obj_dict:
+        # Read straight from the mapping rows rather than through the list,
+        # which would keep its items while its rows may still be loading:
+        items = [row.item for row in obj_dict[rows_key]]
+    else:
+        return UNLOADED
+    if items is None:
+        return ()
+    return tuple(None if item is None else item.get_primary_key() for item in items)
+
+def _untracked_fields(cls:Type[Any]) -> Set[str]:
+    '''
+    Returns the names of the fields of cls that can be changed in place
+    (dict fields stored as JSON) and so are always considered dirty.
+    '''
+    untracked = cls.__dict__.get("__untracked_fields__", None)
+    if untracked is None:
+        untracked = set()
+        for field_name in cls.FieldsInfo.field_names:
+            field_type = cls.FieldsInfo.get_field_type(field_name)
+            if field_type is dict or getattr(field_type, "__origin__", None) is dict:
+                untracked.add(field_name)
+        setattr(cls, "__untracked_fields__", untracked)
+    return untracked
+
+def mark_clean(obj:Any, engine_token:Any, lists:bool=True, generation:int=0) -> None:
+    '''
+    Marks obj as matching what is stored in the database of the engine
+    identified by engine_token.
+
+    :param generation: The engine's current generation of obj's primary key.
+
+    :param lists: Whether obj's lists were stored as well. If not, their keys
+    are kept from when obj was last marked clean for the same engine.
+    '''
+    fields_info = obj.FieldsInfo
+    obj_dict = obj.__dict__
+
+    clean_keys = {}
+    if not lists and obj_dict.get(CLEAN_FOR, None) is engine_token:
+        clean_keys.update(obj_dict[CLEAN_KEYS])
+    for field_name in fields_info.fields_with_FieldsInfo:
+        clean_keys[field_name] = _reference_key(obj, field_name)
+    if lists:
+        for field_name in fields_info.list_fields_with_FieldsInfo:
+            clean_keys[field_name] = _list_key(obj, field_name)
+
+    obj_dict[CLEAN_KEYS] = clean_keys
+    obj_dict[CLEAN_FOR] = engine_token
+    obj_dict[CLEAN_GENERATION] = generation
+    obj_dict[DIRTY_FIELDS] = set()
+
+def get_dirty_fields(obj:Any, engine_token:Any, generation:int=0) -> Optional[Set[str]]:
+    '''
+    Returns the names of obj's fields that may differ from what is stored
+    in the database of the engine identified by engine_token, or None if
+    obj is not known to be stored there at all.
+
+    :param generation: The engine's current generation of obj's primary key.
+    '''
+    obj_dict = obj.__dict__
+    if obj_dict.get(CLEAN_FOR, None) is not engine_token or obj_dict.get(CLEAN_GENERATION, 0) != generation:
+        return None
+
+    fields_info = obj.FieldsInfo
+    dirty_fields = set(name for name in obj_dict[DIRTY_FIELDS] if name in fields_info.field_names)
+    dirty_fields.update(_untracked_fields(type(obj)))
+
+    clean_keys :Dict[str, Any] = obj_dict[CLEAN_KEYS]
+    for field_name in fields_info.fields_with_FieldsInfo:
+        if _reference_key(obj, field_name) != clean_keys.get(field_name, UNLOADED):
+            dirty_fields.add(field_name)
+    for field_name in fields_info.list_fields_with_FieldsInfo:
+        if _list_key(obj, field_name) != clean_keys.get(field_name, UNLOADED):
+            dirty_fields.add(field_name)
+    return dirty_fields
+
+def is_clean(obj:Any, engine_token:Any, generation:int=0) -> bool:
+    dirty_fields = get_dirty_fields(obj, engine_token, generation)
+    return dirty_fields is not None and len(dirty_fields) == 0
@@ -0,0 +1,127 @@
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.attributes import instance_state, manager_of_class, set_attribute, set_committed_value
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from copy import deepcopy
+
+from ClassyFlaskDB.helpers.Decorators.to_sql import get_loaded_list, list_items_key, list_rows_key
+
+PLAN = "__materialize_plan__"
+
+def _plan(cls:type) -> Tuple[List[str], List[Tuple[str, bool]], List[str], List[str]]:
+    '''
+    Returns the keys of cls's column attributes, the keys of its
+    relationships along with whether each is a list, the names of its list
+    fields, and the names of any of its fields that are not mapped at all.
+    '''
+    plan = cls.__dict__.get(PLAN, None)
+    if plan is None:
+        mapper = class_mapper(cls)
+        column_keys = [prop.key for prop in mapper.column_attrs]
+        # Lists are copied as their items, not as the mapping rows they are
+        # loaded as (see OneToMany_List):
+        relationship_keys = [
+            (prop.key, prop.uselist) for prop in mapper.relationships
+            if getattr(prop.mapper.class_, "FieldsInfo", None) is not None
+        ]
+        list_fields = list(cls.FieldsInfo.list_fields_with_FieldsInfo)
+        # Fields like datetimes and enums are properties over their columns:
+        other_fields = [
+            field_name for field_name in cls.FieldsInfo.field_names
+            if field_name not in mapper.attrs and not isinstance(getattr(cls, field_name, None), property)
+        ]
+        plan = (column_keys, relationship_keys, list_fields, other_fields)
+        setattr(cls, PLAN, plan)
+    return plan
+
+def _copy_value(value:Any) -> Any:
+    # Only JSON values can be changed in place:
+    if isinstance(value, (dict, list)):
+        return deepcopy(value)
+    return value
+
+def materialize(obj:Any, memo:Optional[Dict[int, Any]]=None, load:bool=False) -> Any:
+    '''
+    Returns a copy of obj, and of everything loaded from it, that does not
+    belong to any session. The same as deepcopy(obj), but in a single pass
+    over the objects' loaded attributes rather than one getattr, setattr,
+    and deepcopy per field, and without recursing (so long chains of objects
+    are fine).
+
+    Objects referenced more than once are copied once, and references and
+    lists that were not loaded are left unloaded on the copies.
+
+    :param memo: Copies already made, keyed by the id of their original, like deepcopy's.
+    :param load: Whether to load everything that was not loaded yet from
+    objects that are in a session first, like deepcopy does.
+    '''
+    if obj is None:
+        return None
+    if memo is None:
+        memo = {}
+
+    copies :List[Tuple[Any, Any]] = []
+    stack = [obj]
+    while stack:
+        original = stack.pop()
+        if id(original) in memo:
+            continue
+
+        cls = type(original)
+        column_keys, relationship_keys, list_fields, other_fields = _plan(cls)
+        if load and instance_state(original).persistent:
+            list_keys = set(key for field_name in list_fields for key in (list_items_key(field_name), list_rows_key(field_name)))
+            for key in instance_state(original).unloaded:
+                if key not in list_keys:
+                    getattr(original, key)
+            for field_name in list_fields:
+                getattr(original, field_name)
+        else:
+            # Lists loaded as their rows only hold their items once read:
+            for field_name in list_fields:
+                get_loaded_list(original, field_name)
+
+        copy = manager_of_class(cls).new_instance()
+        memo[id(original)] = copy
+        copies.append((original, copy))
+
+        original_dict = original.__dict__
+        copy_dict = copy.__dict__
+        for key in column_keys:
+            if key in original_dict:
+                copy_dict[key] = _copy_value(original_dict[key])
+        for field_name in other_fields:
+            if field_name in original_dict:
+                copy_dict[field_name] = deepcopy(original_dict[field_name], memo)
+
+        for key, uselist in relationship_keys:
+            value = original_dict.get(key, None)
+            if value is None:
+                continue
+            if uselist:
+                stack.extend(item for item in value if item is not None)
+            else:
+                stack.append(value)
+
+    # Relationships are set once everything has a copy, so that cycles work:
+    for original, copy in copies:
+        original_dict = original.__dict__
+        for key, uselist in _plan(type(original))[1]:
+            if key not in original_dict:
+                continue
+            value = original_dict[key]
+            if uselist:
+                # Lists are viewonly and the mapping rows of new objects are
+                # written from whatever they hold, so they are set without
+                # the cost of firing an append event per item:
+                set_committed_value(copy, key, [None if item is None else memo[id(item)] for item in value or []])
+            else:
+                set_attribute(copy, key, None if value is None else memo[id(value)])
+    return memo[id(obj)]
+
+def materialize_all(objs:Iterable[Any], load:bool=False) -> List[Any]:
+    '''
+    Materializes every object in objs, sharing the copies of anything they
+    have in common.
+    '''
+    memo = {}
+    return [materialize(obj, memo, load) for obj in objs]
@@ -0,0 +1,130 @@
+from sqlalchemy import MetaData, DateTime
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.attributes import manager_of_class, set_attribute, set_committed_value
+from dataclasses import fields, MISSING
+from typing import Any, Dict, List, Optional, Tuple
+
+from ClassyFlaskDB.helpers.Decorators.to_sql import get_table_getter_setters, get_loaded_list, OneToOneReference, OneToMany_List
+from ClassyFlaskDB.DATA.DATAEngine import crawl, convert_to_column_type
+
+def to_table_json(obj:Any, metadata:MetaData) -> Dict[str, List[Dict[str, Any]]]:
+    '''
+    Returns the rows that storing obj, and everything reachable from it,
+    would write to each table of metadata, keyed by table name. The same JSON
+    DATAEngine.to_json returns for a database holding only obj, but built
+    straight from the objects without one.
+    
+    Objects with the same primary key are written to the same row, and
+    references and lists that were not loaded are left out, the same as
+    merging obj would.
+    '''
+    rows :Dict[str, Dict[Any, Dict[str, Any]]] = {table_name: {} for table_name in sorted(metadata.tables.keys())}
+    
+    def write(o:Any) -> bool:
+        primary_key = o.get_primary_key()
+        for table, getter_setters in get_table_getter_setters(type(o)):
+            table_rows = rows[table.name]
+            row = table_rows.get(primary_key, None)
+            if row is None:
+                row = table_rows[primary_key] = {column.name: None for column in table.columns}
+            for getter_setter in getter_setters:
+                row.update(getter_setter.get_column_values(o))
+                if isinstance(getter_setter, OneToMany_List) and get_loaded_list(o, getter_setter.field_info.field_name) is not None:
+                    # Keyed by parent, so a list written twice replaces its rows:
+                    rows[getter_setter.mapping_table_name][primary_key] = getter_setter.get_mapping_rows(o)
+        return True
+    crawl(obj, write)
+    
+    json_data = {}
+    for table_name, table_rows in rows.items():
+        if "list_position" in metadata.tables[table_name].info:
+            json_data[table_name] = [row for list_rows in table_rows.values() for row in list_rows]
+        else:
+            json_data[table_name] = list(table_rows.values())
+    return json_data
+
+def from_table_json(json_data:Dict[str, List[Dict[str, Any]]], model_class:type, primary_key:Any) -> Optional[Any]:
+    '''
+    Returns the model_class object with primary_key, and everything it
+    references, rebuilt straight from json_data (as returned by
+    to_table_json or DATAEngine.to_json) rather than by inserting it into a
+    database and querying it back out. None if json_data has no such object.
+    
+    Objects are rebuilt as the class named by their row's __cls_type__, and
+    are not in any session, the same as deep copies of queried objects.
+    '''
+    rows_by_table :Dict[str, Dict[Any, Dict[str, Any]]] = {}
+    def rows_of(table:Any) -> Dict[Any, Dict[str, Any]]:
+        table_rows = rows_by_table.get(table.name, None)
+        if table_rows is None:
+            pk_name = table.primary_key.columns.values()[0].name
+            table_rows = rows_by_table[table.name] = {row[pk_name]: row for row in json_data.get(table.name, [])}
+        return table_rows
+    
+    items_by_list :Dict[str, Dict[Any, List[Dict[str, Any]]]] = {}
+    def items_of(getter_setter:OneToMany_List, parent_pk:Any) -> List[Dict[str, Any]]:
+        items = items_by_list.get(getter_setter.mapping_table_name, None)
+        if items is None:
+            items = items_by_list[getter_setter.mapping_table_name] = {}
+            for row in json_data.get(getter_setter.mapping_table_name, []):
+                items.setdefault(row[getter_setter.fk_name_parent], []).append(row)
+            for parent_items in items.values():
+                parent_items.sort(key=lambda row: row[getter_setter.position_name])
+        return items.get(parent_pk, [])
+    
+    objs :Dict[Tuple[type, Any], Any] = {}
+    built :List[Tuple[Any, Any]] = []
+    def get(cls:type, pk:Any) -> Optional[Any]:
+        '''Returns the (unfilled) object of cls's hierarchy with pk, making it if need be.'''
+        if pk is None:
+            return None
+        mapper = class_mapper(cls).base_mapper
+        key = (mapper.class_, pk)
+        if key in objs:
+            return objs[key]
+        row = rows_of(mapper.local_table).get(pk, None)
+        if row is None:
+            objs[key] = None
+            return None
+        if mapper.polymorphic_on is not None:
+            mapper = mapper.polymorphic_map[row[mapper.polymorphic_on.name]]
+        obj = objs[key] = manager_of_class(mapper.class_).new_instance()
+        built.append((obj, pk))
+        return obj
+    
+    root = get(model_class, primary_key)
+    if root is None or not isinstance(root, model_class):
+        return None
+    
+    # Objects are appended to built as the ones referencing them are filled:
+    i = 0
+    while i < len(built):
+        obj, pk = built[i]
+        i += 1
+        obj_dict = obj.__dict__
+        for table, getter_setters in get_table_getter_setters(type(obj)):
+            row = rows_of(table).get(pk, {})
+            for column in table.columns:
+                if column.name in row:
+                    value = row[column.name]
+                    obj_dict[column.name] = convert_to_column_type(value, column.type) if isinstance(column.type, DateTime) else value
+            for getter_setter in getter_setters:
+                if isinstance(getter_setter, OneToOneReference):
+                    set_attribute(obj, getter_setter.field_info.field_name, get(getter_setter.field_info.field_type, row.get(getter_setter.fk_name, None)))
+                elif isinstance(getter_setter, OneToMany_List):
+                    item_type = getter_setter.field_info.field_type.__args__[0]
+                    set_committed_value(obj, getter_setter.items_key, [
+                        get(item_type, item_row[getter_setter.fk_name_field])
+                        for item_row in items_of(getter_setter, pk)
+                    ])
+        
+        # Like loading does, give fields that are not stored their defaults:
+        mapper = class_mapper(type(obj))
+        for field in fields(obj):
+            if field.name in mapper.attrs or field.name in obj_dict or isinstance(getattr(type(obj), field.name, None), property):
+                continue
+            if field.default is not MISSING:
+                obj_dict[field.name] = field.default
+            elif field.default_factory is not MISSING:
+                obj_dict[field.name] = field.default_factory()
+    return root
@@ -1,5 +1,6 @@
-from sqlalchemy import Table, Column, String, Integer, ForeignKey, DateTime, JSON, Enum, Boolean, Float, Text
-from sqlalchemy.orm import declarative_base, relationship, registry
+from sqlalchemy import Table, Column, Index, String, Integer, ForeignKey, DateTime, JSON, Enum, Boolean, Float, Text
+from sqlalchemy.orm import declarative_base, relationship, registry, deferred
+from sqlalchemy.orm.attributes import flag_dirty, instance_state, set_committed_value
 from sqlalchemy.ext.declarative import declared_attr, DeclarativeMeta
 from datetime import datetime
 from ClassyFlaskDB.helpers.Decorators.capture_field_info import FieldInfo
@@ -10,6 +11,7 @@ from ClassyFlaskDB.helpers import *
 from dateutil import tz
 
 from dataclasses import fields, is_dataclass, MISSING
+from typing import Optional
 from sqlalchemy import event
 import enum
 
@@ -25,11 +27,55 @@ type_map = {
 def type_table_name(cls):
 	return f"{cls.__name__}_Table"
 
+# The values of the "load" field metadata, and the relationship lazy option each means:
+LOAD_STRATEGIES = {
+	"selectin": "selectin",
+	"joined": "joined",
+	"lazy": "select",
+	"raise": "raise",
+	"noload": "noload",
+}
+def get_load_strategy(field_info:FieldInfo) -> Optional[str]:
+	'''
+	Returns the "load" metadata of the field described by field_info, or None if it has none.
+	'''
+	field = field_info.parent_type.FieldsInfo.fields_dict.get(field_info.field_name, None)
+	load = None if field is None else field.metadata.get("load", None)
+	if load is not None and load not in LOAD_STRATEGIES:
+		raise ValueError(f"Unknown load strategy '{load}' for {field_info.parent_type.__name__}.{field_info.field_name}, expected one of {list(LOAD_STRATEGIES.keys())}")
+	return load
+
+def is_deferred(field_info:FieldInfo) -> bool:
+	'''
+	Returns whether the field described by field_info has "deferred" metadata.
+	'''
+	field = field_info.parent_type.FieldsInfo.fields_dict.get(field_info.field_name, None)
+	return field is not None and field.metadata.get("deferred", False)
+
 class GetterSetter:
 	def __init__(self, field_info:FieldInfo):
 		self.field_info = field_info
 		self.columns :List[Column] = []
 		self.relationships :Dict[str,relationship] = {}
+		self.deferred = field_info is not None and is_deferred(field_info)
+	
+	def is_loaded(self, obj:Any) -> bool:
+		'''
+		Returns whether every one of self.columns is loaded on obj, which is
+		only not the case for deferred fields that have not been accessed yet.
+		'''
+		return not self.deferred or all(column.name in obj.__dict__ for column in self.columns)
+	
+	def get_column_values(self, obj:Any) -> Dict[str, Any]:
+		'''
+		Returns the value of each of self.columns for obj, keyed by column name.
+		
+		Deferred fields that were never loaded have no values, so that
+		writing obj leaves what is stored for them as it is.
+		'''
+		if not self.is_loaded(obj):
+			return {}
+		return {column.name: getattr(obj, column.name, None) for column in self.columns}
 
 class SimpleOneToOne(GetterSetter):
 	def __init__(self, field_info:FieldInfo, column:Column):
@@ -47,20 +93,53 @@ class OneToOneReference(GetterSetter):
 		# Create foreign key column:
 		self.fk_name = f"{self.field_info.field_name}_fk"
 		self.fk_type = field_type.FieldsInfo.get_field_type(field_primary_key_name)
-		fk_column = Column(self.fk_name, type_map[self.fk_type], ForeignKey(f"{type_table_name(field_type)}.{field_primary_key_name}"))
+		fk_column = Column(self.fk_name, type_map[self.fk_type], ForeignKey(f"{type_table_name(field_type)}.{field_primary_key_name}"), index=True)
 
 		self.columns = [fk_column]
+		self.fk_column = fk_column
+		self.load = get_load_strategy(field_info)
 
 		self.relationships = {
 			self.field_info.field_name: relationship(
 				field_type,
 				uselist=False,
+				lazy=LOAD_STRATEGIES[self.load or "lazy"],
 				foreign_keys=[fk_column],
 				post_update=True,
 				primaryjoin=lambda: fk_column == getattr(field_type, field_primary_key_name),
 				remote_side=lambda: getattr(field_type, field_primary_key_name)
 			)
 		}
+	
+	def get_column_values(self, obj:Any) -> Dict[str, Any]:
+		obj_dict = obj.__dict__
+		if self.field_info.field_name not in obj_dict and self.fk_name in obj_dict:
+			# The reference was never loaded, but its foreign key was:
+			return {self.fk_name: obj_dict[self.fk_name]}
+		value = getattr(obj, self.field_info.field_name, None)
+		return {self.fk_name: None if value is None else value.get_primary_key()}
+CHANGED_LISTS = "_DATA_changed_lists"
+def list_items_key(field_name:str) -> str:
+	return f"_{field_name}_items"
+def list_rows_key(field_name:str) -> str:
+	return f"_{field_name}_rows"
+
+def get_loaded_list(obj:Any, field_name:str, default:Any=None) -> Any:
+	'''
+	Returns obj's list field_name if it was loaded or set, without loading
+	it, otherwise default.
+	'''
+	obj_dict = obj.__dict__
+	if list_items_key(field_name) in obj_dict or list_rows_key(field_name) in obj_dict:
+		return getattr(obj, field_name)
+	return default
+
+class ListRow:
+	'''
+	A row of the mapping table of a list field (see OneToMany_List), and the
+	item at its position.
+	'''
+
 class OneToMany_List(GetterSetter):
 	def __init__(self, field_info:FieldInfo, mapper_registry:registry):
 		super().__init__(field_info)
@@ -70,6 +149,8 @@ class OneToMany_List(GetterSetter):
 
 		self.fk_name_parent = f"{field_info.parent_type.__name__}_fk"
 		self.fk_name_field = f"{field_info.field_name}_fk"
+		self.position_name = "position"
+		self.load = get_load_strategy(field_info)
 
 		parent_primary_key_name = field_info.parent_type.FieldsInfo.primary_key_name
 		#Get the type inside any collection like foo from list[foo] or foo from tuple[foo] or foo from set[foo], and get its primary key name from its FieldsInfo where field_info.field_type is something like list[foo] or tuple[foo] or set[foo]:
@@ -81,23 +162,95 @@ class OneToMany_List(GetterSetter):
 			Column(
 				self.fk_name_parent,
 				type_map[field_info.parent_type.FieldsInfo.get_field_type(parent_primary_key_name)],
-				ForeignKey(f"{type_table_name(field_info.parent_type)}.{parent_primary_key_name}")
+				ForeignKey(f"{type_table_name(field_info.parent_type)}.{parent_primary_key_name}"),
+				primary_key=True
 			),
+			Column(self.position_name, Integer, primary_key=True),
 			Column(
 				self.fk_name_field,
 				type_map[field_type.FieldsInfo.get_field_type(field_primary_key_name)],
-				ForeignKey(f"{type_table_name(field_type)}.{field_primary_key_name}")
-			)
+				ForeignKey(f"{type_table_name(field_type)}.{field_primary_key_name}"),
+				index=True
+			),
+			info={"list_position": self.position_name, "list_parent_fk": self.fk_name_parent}
 		)
 
+		# A list is loaded as the rows of its mapping table, one per item in
+		# order, since loading its items straight through the mapping table
+		# makes them unique and drops the repeats a list can hold:
+		self.row_class = type(f"{field_info.parent_type.__name__}_{field_info.field_name}_Row", (ListRow,), {})
+		mapper_registry.map_imperatively(self.row_class, self.mapping_table, properties={
+			"item": relationship(
+				field_type,
+				lazy="joined",
+				foreign_keys=[self.mapping_table.c[self.fk_name_field]],
+				viewonly=True,
+				cascade="expunge, refresh-expire"
+			)
+		})
+		
+		# The list field itself is a property (see add_list_property) over
+		# the list's items, which are only ever set (by it or by merge), and
+		# its rows, which are what is loaded.
+		#
+		# SQLAlchemy can only write the two foreign keys of a secondary table,
+		# so both are viewonly and DATAEngine's Session writes the mapping
+		# rows itself, positions included (see sync_mapping_rows). Viewonly
+		# collections keep no history, so listen_for_changes records which
+		# lists changed instead.
+		self.items_key = list_items_key(field_info.field_name)
+		self.rows_key = list_rows_key(field_info.field_name)
 		self.relationships = {
-			self.field_info.field_name: relationship(
+			self.items_key: relationship(
 				field_type,
-				secondary=self.mapping_table
-				# primaryjoin=self.fk_name_parent == self.mapping_table.c[self.fk_name_parent],
-				# secondaryjoin=self.fk_name_field == self.mapping_table.c[self.fk_name_field]
+				secondary=self.mapping_table,
+				order_by=self.mapping_table.c[self.position_name],
+				# Only merge loads the items, to replace them:
+				lazy="raise",
+				viewonly=True,
+				cascade="merge, expunge, refresh-expire"
+			),
+			self.rows_key: relationship(
+				self.row_class,
+				order_by=self.mapping_table.c[self.position_name],
+				foreign_keys=[self.mapping_table.c[self.fk_name_parent]],
+				lazy=LOAD_STRATEGIES[self.load or "lazy"],
+				viewonly=True,
+				cascade="expunge, refresh-expire"
 			)
 		}
+	
+	def get_column_values(self, obj:Any) -> Dict[str, Any]:
+		return {}
+	
+	def listen_for_changes(self, cls:Type[Any]) -> None:
+		'''
+		Records the name of this list field in CHANGED_LISTS on any object of
+		cls whose list is changed, and flags it dirty so that it is flushed.
+		'''
+		field_name = self.field_info.field_name
+		def list_changed(target, *args):
+			changed_lists = target.__dict__.get(CHANGED_LISTS, None)
+			if changed_lists is None:
+				changed_lists = target.__dict__[CHANGED_LISTS] = set()
+			changed_lists.add(field_name)
+			flag_dirty(target)
+		for event_name in ['append', 'remove', 'bulk_replace']:
+			event.listen(getattr(cls, self.items_key), event_name, list_changed)
+	
+	def get_mapping_rows(self, obj:Any) -> List[Dict[str, Any]]:
+		'''
+		Returns the rows of self.mapping_table that store obj's list.
+		'''
+		items = getattr(obj, self.field_info.field_name, None)
+		if not items:
+			return []
+		
+		parent_pk = obj.get_primary_key()
+		return [
+			{self.fk_name_parent: parent_pk, self.position_name: position, self.fk_name_field: None if item is None else item.get_primary_key()}
+			for position, item in enumerate(items)
+		]
 def add_dynamic_datetime_property(cls, field_name):
 	"""Adds dynamic properties to handle datetime with timezone."""
 	def getter(self):
@@ -126,6 +279,23 @@ def add_dynamic_datetime_property(cls, field_name):
 	setattr(cls, f"{field_name}__TimeZone", None)
 	setattr(cls, field_name, property(getter, setter))
 
+def add_list_property(cls, field_name):
+	"""Adds a property for a list field, over its items and the mapping rows they are loaded as."""
+	items_key = list_items_key(field_name)
+	rows_key = list_rows_key(field_name)
+	def getter(self):
+		obj_dict = self.__dict__
+		if items_key not in obj_dict:
+			# Loads the rows if they are not, or raises if self is detached:
+			rows = getattr(self, rows_key)
+			set_committed_value(self, items_key, [row.item for row in rows])
+		return obj_dict[items_key]
+
+	def setter(self, value):
+		setattr(self, items_key, value)
+
+	setattr(cls, field_name, property(getter, setter))
+
 def add_enum_property(cls, field_name, field_type):
 	"""Adds dynamic properties to handle datetime with timezone."""
 	backing_field_name = f"_{field_name}_enum_value"
@@ -154,7 +324,113 @@ class EnumGetterSetter(GetterSetter):
 
 		self._column = Column(f"_{field_info.field_name}_enum_value", String)
 		self.columns = [self._column]
+
+class PolymorphicDiscriminator(GetterSetter):
+	'''
+	Stores the name of an object's class in the '__cls_type__' column
+	of the base table of a class hierarchy.
+	'''
+	def __init__(self, column:Column):
+		super().__init__(None)
+		self.columns = [column]
+	
+	def get_column_values(self, obj:Any) -> Dict[str, Any]:
+		return {self.columns[0].name: type(obj).__name__}
+
+def get_table_getter_setters(cls:Type[Any]) -> List[Tuple[Table, List[GetterSetter]]]:
+	'''
+	Returns every table an instance of cls is stored in, from the table of
+	the base class of its hierarchy down to cls's own, along with the getter
+	setters that produce that table's columns.
+	'''
+	table_getter_setters = cls.__dict__.get("__table_getter_setters__", None)
+	if table_getter_setters is None:
+		table_getter_setters = [
+			(klass.__dict__["__table__"], klass.__dict__["__getter_setters__"])
+			for klass in reversed(cls.__mro__)
+			if "__getter_setters__" in klass.__dict__
+		]
+		setattr(cls, "__table_getter_setters__", table_getter_setters)
+	return table_getter_setters
+
+def get_field_getter_setter(cls:Type[Any], field_name:str) -> GetterSetter:
+	'''
+	Returns the getter setter that stores field_name of cls.
+	'''
+	for table, getter_setters in get_table_getter_setters(cls):
+		for getter_setter in getter_setters:
+			if getter_setter.field_info is not None and getter_setter.field_info.field_name == field_name:
+				return getter_setter
+	raise ValueError(f"{cls.__name__} has no stored field named '{field_name}'.")
+
+def get_field_column(cls:Type[Any], field_name:str) -> Column:
+	'''
+	Returns the column that stores field_name of cls in a form that can be
+	compared and sorted by. That is the timezone naive __DateTimeObj column
+	of a datetime, the value column of an enum, and the foreign key of a
+	reference.
+	'''
+	getter_setter = get_field_getter_setter(cls, field_name)
+	if not getter_setter.columns:
+		raise ValueError(f"{cls.__name__}.{field_name} is stored in {getter_setter.mapping_table_name}, it has no column of its own.")
+	return getter_setter.columns[0]
+
+def get_list_getter_setters(cls:Type[Any]) -> List[OneToMany_List]:
+	'''
+	Returns the getter setters of every list field of cls, including inherited ones.
+	'''
+	list_getter_setters = cls.__dict__.get("__list_getter_setters__", None)
+	if list_getter_setters is None:
+		list_getter_setters = [
+			getter_setter
+			for table, getter_setters in get_table_getter_setters(cls)
+			for getter_setter in getter_setters
+			if isinstance(getter_setter, OneToMany_List)
+		]
+		setattr(cls, "__list_getter_setters__", list_getter_setters)
+	return list_getter_setters
 		
+def add_indexes(cls:Type[Any], table:Table, getter_setters:List[GetterSetter]) -> None:
+	'''
+	Adds an Index to table for every field of cls that has "index" or "unique"
+	in its metadata, and for every entry of cls.__indexes__.
+	
+	Each entry of __indexes__ is either a sequence of field names, or a dict
+	with a "fields" sequence and optionally "unique" and "name", eg:
+	
+	__indexes__ = [("author", "date_created"), {"fields": ("slug",), "unique": True}]
+	
+	Fields of a parent class are stored in the parent's table, so they can
+	only be indexed by the parent.
+	'''
+	columns_by_field = {
+		gs.field_info.field_name: gs.columns
+		for gs in getter_setters
+		if gs.field_info is not None and gs.columns and not gs.field_info.is_primary_key
+	}
+	def add_index(field_names:List[str], unique:bool=False, name:str=None):
+		columns = []
+		for field_name in field_names:
+			if field_name not in columns_by_field:
+				raise ValueError(f"Can not index {cls.__name__}.{field_name}, it has no columns in {table.name}.")
+			columns.extend(columns_by_field[field_name])
+		if name is None:
+			name = f"{'uq' if unique else 'ix'}_{table.name}_{'_'.join(field_names)}"
+		Index(name, *columns, unique=unique)
+	
+	for field_name in columns_by_field.keys():
+		metadata = cls.FieldsInfo.fields_dict[field_name].metadata
+		if metadata.get("unique", False):
+			add_index([field_name], unique=True)
+		elif metadata.get("index", False):
+			add_index([field_name])
+	
+	for index in cls.__dict__.get("__indexes__", []):
+		if isinstance(index, dict):
+			add_index(list(index["fields"]), unique=index.get("unique", False), name=index.get("name", None))
+		else:
+			add_index(list(index))
+
 def to_sql():
 	'''
 	Creates an SQLAlchemy schema class equivalent of the decorated class.
@@ -174,6 +450,16 @@ def to_sql():
 	3. "type" = <sqlalchemy.Type> will specify the type of the column, eg Column(Integer), Column(String), etc
 	4. "to_schema" = <Callable> will specify a function to convert the field to a schema equivalent
 	5. "from_schema" = <Callable> will specify a function to convert the field from a schema equivalent
+	6. "index" = True will index the column(s) of the field
+	7. "unique" = True will add a unique index on the column(s) of the field
+	8. "load" = "selectin" | "joined" | "lazy" | "raise" | "noload" will set how a reference or list
+	   field is loaded, by default it is lazy loaded when it is first accessed
+	9. "deferred" = True will leave the column(s) of a field out of the statements that load its
+	   object, so it is only loaded when it is first accessed in a session or is explicitly
+	   undeferred (see DATAQuery.undefer and DATAEngine.undefer). Meant for large Text and JSON fields.
+	
+	Indexes over several fields can be declared with a class level __indexes__ list, see add_indexes.
+	Foreign key columns, including those of list intermediary tables, are always indexed.
 	
 	Any thing that is not a default sqlalchemy type without a "Column" key, "type" key, or "to_schema"
 	and "from_schema" keys, but that has a "__SQL_Schema_Class__" will create a relationship to the
@@ -242,6 +528,7 @@ def to_sql():
 				#figure out if field_type which might be like this "list[__main__.Bar]" is a list:
 				elif hasattr(field_type, "__origin__") and field_type.__origin__ in [list, tuple, set]:
 					getter_setters.append(OneToMany_List(fi, mapper_registry))
+					add_list_property(cls, field_name)
 				elif field_type is datetime:
 					getter_setters.append(DateTimeGetterSetter(fi))
 					add_dynamic_datetime_property(cls, fi.field_name)
@@ -263,11 +550,18 @@ def to_sql():
 			for relationship_name, relationship in gs.relationships.items():
 				# print(f"Setting up relationship for {cls.__name__}: {relationship_name} -> {relationship}")
 				relationships[relationship_name] = relationship
+			if gs.deferred:
+				if gs.field_info.is_primary_key or gs.relationships or not gs.columns:
+					raise ValueError(f"{cls.__name__}.{gs.field_info.field_name} can not be deferred, only fields stored in columns of their own can be. (Use \"load\" for references and lists.)")
+				# Grouped so that all the columns of a field load together:
+				for column in gs.columns:
+					relationships[column.name] = deferred(column, group=gs.field_info.field_name)
 		
 		if cls_is_base:
 			if cls_has_children:
 				polymorphic_descriminator = Column('__cls_type__', String)
 				columns.append(polymorphic_descriminator)
+				getter_setters.append(PolymorphicDiscriminator(polymorphic_descriminator))
 				cls_table = Table(type_table_name(cls), mapper_registry.metadata, *columns)
 				mapper_registry.map_imperatively(cls, cls_table, properties=relationships,
 					polymorphic_identity=cls.__name__, polymorphic_on=polymorphic_descriminator
@@ -286,7 +580,13 @@ def to_sql():
 			)
 		
 		def initialize_missing_dataclass_fields(target, context):
+			manager = instance_state(target).manager
 			for field in fields(target):
+				# Mapped fields are never missing, and checking them (or the
+				# properties over them) would lazy load any relationship that
+				# is not loaded yet:
+				if field.name in manager or isinstance(getattr(type(target), field.name, None), property):
+					continue
 				# Check if the field is not already set
 				if not hasattr(target, field.name):
 					value = MISSING
@@ -297,7 +597,12 @@ def to_sql():
 
 					if value is not MISSING:
 						setattr(target, field.name, value)
+		add_indexes(cls, cls_table, getter_setters)
 		event.listen(cls, 'load', initialize_missing_dataclass_fields, restore_load_context=True)
+		for gs in getter_setters:
+			if isinstance(gs, OneToMany_List):
+				gs.listen_for_changes(cls)
 		setattr(cls, "__table__", cls_table)
+		setattr(cls, "__getter_setters__", getter_setters)
 		return cls
 	return decorator
\ No newline at end of file
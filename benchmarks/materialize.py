@@ -0,0 +1,33 @@
+'''
+Compares copying query results out of a session with deepcopy against
+materialize.
+
+Run from the root of the repo with:
+python -m benchmarks.materialize
+'''
+from ClassyFlaskDB.DATA import *
+from sqlalchemy.orm import selectinload, joinedload
+from copy import deepcopy
+import time
+
+from benchmarks.merge_strategies import DATA, Post, make_posts
+
+def time_copy(name:str, copy, engine:DATAEngine) -> None:
+	with engine.session() as session:
+		posts = session.query(Post).options(joinedload(Post.author), selectinload(Post.comments)).all()
+		
+		start = time.perf_counter()
+		copies = copy(posts)
+		seconds = time.perf_counter() - start
+	assert len(copies) == len(posts) and len(copies[0].comments) == 5
+	print(f"{name:<16} {seconds:8.3f}s")
+
+if __name__ == "__main__":
+	post_count = 2000
+	engine = DATAEngine(DATA)
+	engine.upsert_all(make_posts(post_count))
+	
+	print(f"Copying {post_count} loaded posts with 5 comments each:")
+	time_copy("deepcopy", lambda posts: deepcopy(posts), engine)
+	time_copy("materialize_all", lambda posts: materialize_all(posts), engine)
+	engine.dispose()
@@ -0,0 +1,63 @@
+'''
+Compares DATAEngine.merge_all against DATAEngine.upsert_all.
+
+Run from the root of the repo with:
+python -m benchmarks.merge_strategies
+'''
+from ClassyFlaskDB.DATA import *
+from typing import List
+import tempfile
+import time
+import os
+
+DATA = DATADecorator()
+
+@DATA
+class Author:
+	name: str
+
+@DATA
+class Comment:
+	text: str
+	score: int
+
+@DATA
+class Post:
+	title: str
+	author: Author
+	comments: List[Comment] = field(default_factory=list)
+
+DATA.finalize()
+
+def make_posts(count:int) -> List[Post]:
+	authors = [Author(name=f"Author {i}") for i in range(10)]
+	return [
+		Post(
+			title=f"Post {i}", author=authors[i % len(authors)],
+			comments=[Comment(text=f"Comment {i}.{j}", score=j) for j in range(5)]
+		)
+		for i in range(count)
+	]
+
+def time_strategy(name:str, write, posts:List[Post]) -> None:
+	with tempfile.TemporaryDirectory() as temp_dir:
+		engine = DATAEngine(DATA, engine_str=f"sqlite:///{os.path.join(temp_dir, 'bench.db')}")
+		
+		start = time.perf_counter()
+		write(engine, posts)
+		insert_seconds = time.perf_counter() - start
+		
+		for post in posts:
+			post.title += " (edited)"
+		start = time.perf_counter()
+		write(engine, posts)
+		update_seconds = time.perf_counter() - start
+		
+		engine.dispose()
+	print(f"{name:<12} insert: {insert_seconds:8.3f}s   update: {update_seconds:8.3f}s")
+
+if __name__ == "__main__":
+	post_count = 2000
+	print(f"Writing {post_count} posts with 5 comments each:")
+	time_strategy("merge_all", lambda engine, posts: engine.merge_all(posts), make_posts(post_count))
+	time_strategy("upsert_all", lambda engine, posts: engine.upsert_all(posts), make_posts(post_count))
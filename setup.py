@@ -3,10 +3,11 @@ from setuptools import setup, find_packages
 setup(
     name="ClassyFlaskDB",
     version="0.1.0",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     install_requires=[
         "Flask",
-        "SQLAlchemy",
+        # DATAEngine's Session relies on Session._merge, which is private:
+        "SQLAlchemy>=2.0,<2.1",
 		
         "six",
 		"pytz",
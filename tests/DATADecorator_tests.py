@@ -842,10 +842,8 @@ class DATADecorator_tests(unittest.TestCase):
 		with data_engine.session() as session:
 			queried_parent = session.query(ParentObject).filter_by(title="Parent").first()
 			self.assertIsNotNone(queried_parent)
-			self.assertEqual(len(queried_parent.nested_objects), 2) # 2 because we merged with deeply=False, this is not ideal behavior but it is the current behavior
-			self.assertEqual(queried_parent.nested_objects[0].name, "Nested 1")
-			self.assertEqual(queried_parent.nested_objects[1].name, "Nested 2")
-			# self.assertEqual(queried_parent.nested_objects[2].name, "Nested 3")
+			self.assertEqual(len(queried_parent.nested_objects), 3)
+			self.assertEqual(set(nested.name for nested in queried_parent.nested_objects), {"Nested 1", "Nested 2", "Nested 3"})
 	
 	def test_merge_with_date_field(self):
 		DATA = DATADecorator()
@@ -1243,5 +1241,1610 @@ class DATADecorator_tests(unittest.TestCase):
 		self.assertEqual(obj.tags[1].key, "my_thing2")
 		self.assertEqual(obj.tags[1].obj, "hello computer")
 		
+	def test_merge_all_and_add_all(self):
+		DATA = DATADecorator()
+
+		@DATA
+		class Foe:
+			name: str
+			strength: int
+
+		@DATA
+		class Bar:
+			name: str
+			foe: Foe = None
+
+		data_engine = DATAEngine(DATA)
+
+		shared_foe = Foe(name="Dragon", strength=100)
+		bars = [Bar(name=f"Bar {i}", foe=shared_foe) for i in range(25)]
+		stats = data_engine.merge_all(bars, chunk_size=10)
+
+		self.assertEqual([s.object_count for s in stats], [10, 10, 5])
+		self.assertEqual([s.chunk_index for s in stats], [0, 1, 2])
+
+		foes = [Foe(name=f"Foe {i}", strength=i) for i in range(7)]
+		stats = data_engine.add_all(foes, chunk_size=10)
+		self.assertEqual(len(stats), 1)
+		self.assertEqual(stats[0].object_count, 7)
+
+		with data_engine.session() as session:
+			self.assertEqual(session.query(Bar).count(), 25)
+			self.assertEqual(session.query(Foe).count(), 8)
+			queried_bar = session.query(Bar).filter_by(name="Bar 24").first()
+			self.assertEqual(queried_bar.foe.auto_id, shared_foe.auto_id)
+		
+	def test_merge_and_add_without_copying(self):
+		from sqlalchemy import inspect
+
+		DATA = DATADecorator()
+
+		@DATA
+		class Foe:
+			name: str
+			strength: int
+
+		@DATA
+		class Bar:
+			name: str
+			foes: List[Foe] = field(default_factory=list)
+
+		data_engine = DATAEngine(DATA, copy_on_write=False)
+
+		bar = Bar(name="Dragon's Lair", foes=[Foe(name="Dragon", strength=100)])
+		data_engine.add(bar)
+
+		# The callers objects were persisted directly and are usable afterward:
+		self.assertTrue(inspect(bar).detached)
+		self.assertEqual(bar.foes[0].name, "Dragon")
+
+		bar2 = Bar(name="Cave", foes=[Foe(name="Bat", strength=1)])
+		data_engine.merge(bar2)
+		# Merging copies their state instead, so they are never attached:
+		self.assertTrue(inspect(bar2).transient)
+		self.assertTrue(inspect(bar2.foes[0]).transient)
+		data_engine.merge(Foe(name="Troll", strength=50), copy=True)
+
+		with data_engine.session() as session:
+			self.assertEqual(session.query(Bar).count(), 2)
+			self.assertEqual(session.query(Foe).count(), 3)
+			queried_bar = session.query(Bar).filter_by(name="Cave").first()
+			self.assertEqual(queried_bar.foes[0].name, "Bat")
+		
+	def test_locked_fields_are_preserved_in_batches(self):
+		from sqlalchemy import event
+
+		DATA = DATADecorator(auto_decorate_as_dataclass=False)
+
+		@DATA
+		@dataclass
+		class Object:
+			date_created: datetime = field(
+				default_factory=datetime.utcnow, kw_only=True,
+				metadata={"no_update":True}
+			)
+
+		@DATA(generated_id_type=ID_Type.HASHID, hashed_fields=["key"])
+		@dataclass
+		class Tag(Object):
+			key: str
+
+		@DATA
+		@dataclass
+		class Holder(Object):
+			tags: List[Tag] = field(default_factory=list)
+
+		data_engine = DATAEngine(DATA)
+		holder = Holder(tags=[Tag(key=str(i)) for i in range(50)])
+		data_engine.merge(holder)
+
+		statements = []
+		event.listen(data_engine.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+		new_holder = Holder(tags=[Tag(key=str(i), date_created=datetime(2000, 1, 1)) for i in range(50)])
+		data_engine.merge(new_holder)
+
+		selects = [s for s in statements if s.startswith("SELECT")]
+		self.assertLess(len(selects), 5)
+		with data_engine.session() as session:
+			queried_tag = session.query(Tag).filter_by(key="7").first()
+			self.assertEqual(queried_tag.date_created, holder.tags[7].date_created)
+		
+	def test_known_hash_ids_are_pruned_from_merge(self):
+		from sqlalchemy import event
+
+		DATA = DATADecorator()
+
+		@DATA(generated_id_type=ID_Type.HASHID)
+		class Leaf:
+			value: str
+
+		@DATA(generated_id_type=ID_Type.HASHID, hashed_fields=["leaves"])
+		class Branch:
+			leaves: List[Leaf] = field(default_factory=list)
+
+		@DATA
+		class Tree:
+			name: str
+			branch: Branch = None
+
+		data_engine = DATAEngine(DATA)
+		tree = Tree(name="Oak", branch=Branch(leaves=[Leaf(value=str(i)) for i in range(20)]))
+		tree.branch.new_id()
+		data_engine.merge(tree)
+		self.assertTrue(data_engine.is_known(tree.branch))
+		self.assertTrue(data_engine.is_known(tree.branch.leaves[0]))
+
+		statements = []
+		event.listen(data_engine.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+		tree.name = "Old Oak"
+		data_engine.merge(tree)
+		self.assertFalse(any("Leaf_Table" in s or "Branch_Table" in s for s in statements))
+
+		# A second engine on the same database can warm its cache from the tables:
+		other_engine = DATAEngine(DATA, engine=data_engine.engine)
+		self.assertFalse(other_engine.is_known(tree.branch))
+		other_engine.load_known_ids()
+		self.assertTrue(other_engine.is_known(tree.branch))
+		self.assertTrue(other_engine.is_known(tree.branch.leaves[19]))
+
+		with data_engine.session() as session:
+			queried_tree = session.query(Tree).first()
+			self.assertEqual(queried_tree.name, "Old Oak")
+			self.assertEqual(len(queried_tree.branch.leaves), 20)
+
+	def test_known_hash_ids_only_prune_what_their_hash_covers(self):
+		DATA = DATADecorator()
+
+		@DATA
+		class Note:
+			text: str
+
+		@DATA(generated_id_type=ID_Type.HASHID)
+		class Pin:
+			note: Note
+
+		@DATA(generated_id_type=ID_Type.HASHID, hashed_fields=["name"])
+		class Label:
+			name: str
+			color: str
+			pin: Pin = None
+
+		@DATA
+		class Board:
+			title: str
+			label: Label = None
+
+		data_engine = DATAEngine(DATA)
+		board = Board(title="Plans", label=Label(name="todo", color="red", pin=Pin(note=Note(text="first"))))
+		data_engine.merge(board)
+		self.assertFalse(data_engine.is_known(board.label))
+		self.assertTrue(data_engine.is_known(board.label.pin))
+
+		# Neither a field left out of the label's hash, nor a note that the
+		# pin's hash only covers the primary key of, is dropped:
+		board.label.color = "green"
+		board.label.pin.note.text = "second"
+		data_engine.merge(board)
+		loaded = data_engine.get(Board, board.get_primary_key())
+		self.assertEqual(loaded.label.color, "green")
+		self.assertEqual(loaded.label.pin.note.text, "second")
+
+		board.label.pin.note.text = "third"
+		data_engine.upsert(board)
+		self.assertEqual(data_engine.get(Note, board.label.pin.note.get_primary_key()).text, "third")
+
+	def test_upsert(self):
+		DATA = DATADecorator(auto_decorate_as_dataclass=False)
+
+		@DATA
+		@dataclass
+		class Object:
+			date_created: datetime = field(
+				default_factory=datetime.utcnow, kw_only=True,
+				metadata={"no_update":True}
+			)
+
+		@DATA(generated_id_type=ID_Type.HASHID, hashed_fields=["key"])
+		@dataclass
+		class Tag(Object):
+			key: str
+			note: str = None
+
+		@DATA
+		@dataclass
+		class Message(Object):
+			content: str
+			tags: List[Tag] = field(default_factory=list)
+			reply_to: "Message" = None
+
+		data_engine = DATAEngine(DATA)
+
+		first = Message("Hello", tags=[Tag("greeting"), Tag("short")])
+		reply = Message("Hi!", tags=[Tag("greeting")], reply_to=first)
+		data_engine.upsert(reply)
+
+		original_date = first.date_created
+		first.content = "Hello there"
+		first.date_created = datetime(2000, 1, 1)
+		first.tags.pop()
+		first.tags[0].note = "ignored, tags are hash ids"
+		data_engine.upsert_all([first, reply])
+
+		with data_engine.session() as session:
+			self.assertEqual(session.query(Message).count(), 2)
+			self.assertEqual(session.query(Tag).count(), 2)
+
+			queried_first = session.query(Message).filter_by(auto_id=first.auto_id).first()
+			self.assertEqual(queried_first.content, "Hello there")
+			self.assertEqual(queried_first.date_created, original_date)
+			self.assertEqual([tag.key for tag in queried_first.tags], ["greeting"])
+			self.assertIsNone(queried_first.tags[0].note)
+
+			queried_reply = session.query(Message).filter_by(auto_id=reply.auto_id).first()
+			self.assertEqual(queried_reply.reply_to.auto_id, first.auto_id)
+			self.assertIsInstance(queried_reply.tags[0], Tag)
+		
+	def test_shallow_merge_all(self):
+		from sqlalchemy import event
+
+		DATA = DATADecorator()
+
+		@DATA
+		class Task:
+			name: str
+			done: bool = False
+			finished_at: datetime = None
+
+		@DATA
+		class Chore(Task):
+			room: str = None
+			helper: Task = None
+
+		data_engine = DATAEngine(DATA)
+		tasks = [Task(name=f"Task {i}") for i in range(30)]
+		chores = [Chore(name=f"Chore {i}", room="Kitchen") for i in range(20)]
+		data_engine.merge_all(tasks + chores)
+
+		finished_at = datetime(2024, 5, 1, 12, 30)
+		for obj in tasks + chores:
+			obj.done = True
+			obj.finished_at = finished_at
+		for chore in chores:
+			chore.room = "Garage"
+			chore.helper = tasks[0]
+
+		statements = []
+		event.listen(data_engine.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+		data_engine.shallow_merge_all(tasks + chores)
+		self.assertEqual(len([s for s in statements if s.startswith("UPDATE")]), 3)
+
+		with data_engine.session() as session:
+			self.assertEqual(session.query(Task).filter_by(done=True).count(), 50)
+			queried_chore = session.query(Chore).filter_by(name="Chore 3").first()
+			self.assertEqual(queried_chore.room, "Garage")
+			self.assertEqual(queried_chore.finished_at, finished_at)
+			self.assertEqual(queried_chore.helper.name, "Task 0")
+
+	def test_dirty_tracking(self):
+		from sqlalchemy import event
+
+		DATA = DATADecorator()
+
+		@DATA
+		class Part:
+			name: str
+			price: float = 0
+
+		@DATA
+		class Machine:
+			name: str
+			notes: str = None
+			parts: List[Part] = field(default_factory=list)
+
+		data_engine = DATAEngine(DATA)
+		other_engine = DATAEngine(DATA)
+		machines = [Machine(name=f"Machine {i}", parts=[Part(name=f"Part {i}")]) for i in range(10)]
+		data_engine.merge_all(machines)
+		for machine in machines:
+			self.assertTrue(data_engine.is_clean(machine))
+			self.assertFalse(other_engine.is_clean(machine))
+
+		statements = []
+		event.listen(data_engine.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+		data_engine.merge_all(machines)
+		data_engine.shallow_merge_all(machines)
+		self.assertEqual(statements, [])
+
+		machines[0].notes = "Oiled"
+		machines[1].parts[0].price = 5
+		machines[2].parts.append(Part(name="Spare"))
+		self.assertFalse(data_engine.is_clean(machines[0]))
+		self.assertTrue(data_engine.is_clean(machines[1]))
+		self.assertFalse(data_engine.is_clean(machines[1].parts[0]))
+		self.assertFalse(data_engine.is_clean(machines[2]))
+
+		data_engine.shallow_merge_all(machines)
+		updates = [s for s in statements if s.startswith("UPDATE")]
+		self.assertEqual(len(updates), 1)
+		self.assertNotIn("name", updates[0].split("WHERE")[0])
+
+		data_engine.merge(machines[1])
+		data_engine.merge(machines[2])
+		with data_engine.session() as session:
+			self.assertEqual(session.query(Machine).filter_by(notes="Oiled").count(), 1)
+			self.assertEqual(session.query(Part).filter_by(price=5).count(), 1)
+			self.assertEqual(len(session.query(Machine).filter_by(name="Machine 2").first().parts), 2)
+
+		with data_engine.session() as session:
+			loaded = session.query(Machine).filter_by(name="Machine 3").first()
+			self.assertTrue(data_engine.is_clean(loaded))
+			loaded.notes = "Loaded"
+			self.assertEqual(data_engine.get_dirty_fields(loaded), {"notes"})
+
+	def test_clean_marks_do_not_outlive_their_rows(self):
+		DATA = DATADecorator()
+
+		@DATA
+		class Part:
+			name: str
+			price: float = 0
+
+		data_engine = DATAEngine(DATA)
+		part = Part(name="Bolt", price=1)
+		data_engine.merge(part)
+		self.assertTrue(data_engine.is_clean(part))
+
+		# Deleting the row leaves nothing for part to match:
+		with data_engine.session() as session:
+			session.delete(session.get(Part, part.get_primary_key()))
+			session.commit()
+		self.assertFalse(data_engine.is_clean(part))
+		data_engine.merge(part)
+		with data_engine.session() as session:
+			self.assertEqual(session.get(Part, part.get_primary_key()).price, 1)
+
+		# As does another instance overwriting it:
+		other = Part(name="Bolt", price=2)
+		setattr(other, Part.FieldsInfo.primary_key_name, part.get_primary_key())
+		data_engine.merge(other)
+		self.assertTrue(data_engine.is_clean(other))
+		self.assertFalse(data_engine.is_clean(part))
+		data_engine.merge(part)
+		with data_engine.session() as session:
+			self.assertEqual(session.get(Part, part.get_primary_key()).price, 1)
+
+		other.price = 3
+		data_engine.shallow_merge_all([other])
+		self.assertFalse(data_engine.is_clean(part))
+		data_engine.shallow_merge_all([part])
+		with data_engine.session() as session:
+			self.assertEqual(session.get(Part, part.get_primary_key()).price, 1)
+
+	def test_list_mapping_rows_are_diffed(self):
+		from sqlalchemy import event
+
+		DATA = DATADecorator()
+
+		@DATA
+		class Track:
+			title: str
+
+		@DATA
+		class Playlist:
+			name: str
+			tracks: List[Track] = field(default_factory=list)
+
+		data_engine = DATAEngine(DATA)
+		tracks = [Track(title=f"Track {i}") for i in range(200)]
+		playlist = Playlist(name="Long", tracks=list(tracks))
+		data_engine.merge(playlist)
+
+		statements = []
+		event.listen(data_engine.engine, "before_cursor_execute", lambda *args: statements.append((args[2], args[3])))
+		def mapping_writes():
+			writes = [(sql, params) for sql, params in statements if "Playlist_tracks_mapping" in sql and not sql.startswith("SELECT")]
+			statements.clear()
+			return writes
+
+		new_track = Track(title="New")
+		playlist.tracks.append(new_track)
+		data_engine.merge(playlist)
+		writes = mapping_writes()
+		self.assertEqual(len(writes), 1)
+		self.assertTrue(writes[0][0].startswith("INSERT"))
+
+		second_track = Track(title="Second")
+		data_engine.add(second_track)
+		statements.clear()
+		playlist.tracks.append(second_track)
+		data_engine.shallow_merge_all([playlist])
+		writes = mapping_writes()
+		self.assertEqual(len(writes), 1)
+		self.assertTrue(writes[0][0].startswith("INSERT"))
+		self.assertIn(second_track.get_primary_key(), writes[0][1])
+
+		playlist.tracks.remove(tracks[5])
+		data_engine.merge(playlist, deeply=False)
+		writes = mapping_writes()
+		self.assertEqual([sql.split()[0] for sql, params in writes], ["DELETE", "UPDATE"])
+
+		data_engine.merge(playlist, deeply=False)
+		self.assertEqual(mapping_writes(), [])
+
+		with data_engine.session() as session:
+			stored = session.query(Playlist).filter_by(name="Long").first()
+			self.assertEqual([track.title for track in stored.tracks], [track.title for track in playlist.tracks])
+			self.assertEqual(stored.tracks[-2].title, "New")
+			self.assertEqual(stored.tracks[-1].title, "Second")
+			self.assertNotIn("Track 5", [track.title for track in stored.tracks])
+
+	def test_list_order_is_preserved(self):
+		DATA = DATADecorator()
+
+		@DATA
+		class Line:
+			text: str
+
+		@DATA
+		class Script:
+			name: str
+			lines: List[Line] = field(default_factory=list)
+
+		data_engine = DATAEngine(DATA)
+		texts = ["c", "a", "b", "a", "d", "c"]
+		script = Script(name="Play", lines=[Line(text=text) for text in texts])
+		data_engine.merge(script)
+
+		with data_engine.session() as session:
+			stored = session.query(Script).first()
+			self.assertEqual([line.text for line in stored.lines], texts)
+
+			stored.lines.insert(0, Line(text="first"))
+			del stored.lines[3]
+			session.commit()
+
+		with data_engine.session() as session:
+			stored = session.query(Script).first()
+			self.assertEqual([line.text for line in stored.lines], ["first", "c", "a", "a", "d", "c"])
+
+			session.delete(stored)
+			session.commit()
+			mapping_table = data_engine.decorator_metadata.tables["Script_lines_mapping"]
+			self.assertEqual(session.execute(mapping_table.select()).fetchall(), [])
+
+	def test_adding_list_positions(self):
+		import os
+		from sqlalchemy import text
+		if os.path.exists("test_adding_list_positions.db"):
+			os.remove("test_adding_list_positions.db")
+
+		DATA = DATADecorator()
+
+		@DATA
+		class Line:
+			text: str
+
+		@DATA
+		class Script:
+			name: str
+			lines: List[Line] = field(default_factory=list)
+
+		data_engine = DATAEngine(DATA, engine_str='sqlite:///test_adding_list_positions.db')
+		texts = ["c", "a", "b", "d"]
+		data_engine.merge(Script(name="Play", lines=[Line(text=text) for text in texts]))
+
+		# Recreate the mapping table the way it was stored before it had positions:
+		with data_engine.engine.connect() as conn:
+			conn.execute(text("CREATE TABLE old_mapping (Script_fk TEXT, lines_fk TEXT)"))
+			conn.execute(text("INSERT INTO old_mapping SELECT Script_fk, lines_fk FROM Script_lines_mapping ORDER BY position"))
+			conn.execute(text("DROP TABLE Script_lines_mapping"))
+			conn.execute(text("ALTER TABLE old_mapping RENAME TO Script_lines_mapping"))
+			conn.commit()
+		data_engine.dispose()
+
+		data_engine = DATAEngine(DATA, engine_str='sqlite:///test_adding_list_positions.db', should_backup=False)
+		with data_engine.session() as session:
+			stored = session.query(Script).first()
+			self.assertEqual([line.text for line in stored.lines], texts)
+			positions = session.execute(text("SELECT position FROM Script_lines_mapping ORDER BY position")).scalars().all()
+			self.assertEqual(positions, [0, 1, 2, 3])
+		
+	def test_indexes(self):
+		import os
+		from sqlalchemy import inspect
+		if os.path.exists("test_indexes.db"):
+			os.remove("test_indexes.db")
+
+		def define_classes(with_indexes:bool):
+			DATA = DATADecorator()
+
+			@DATA
+			class Author:
+				name: str
+				email: str = field(default=None, metadata={"unique": with_indexes})
+
+			@DATA
+			class Book:
+				title: str = field(default=None, metadata={"index": with_indexes})
+				author: Author = None
+				published: datetime = None
+				co_authors: List[Author] = field(default_factory=list)
+				if with_indexes:
+					__indexes__ = [("author", "published"), {"fields": ("title", "published"), "unique": True, "name": "title_edition"}]
+			return DATA, Author, Book
+
+		def index_names(data_engine, table_name):
+			return set(index["name"] for index in inspect(data_engine.engine).get_indexes(table_name))
+
+		DATA, Author, Book = define_classes(False)
+		data_engine = DATAEngine(DATA, engine_str='sqlite:///test_indexes.db')
+		# Foreign keys are always indexed:
+		self.assertEqual(index_names(data_engine, "Book_Table"), {"ix_Book_Table_author_fk"})
+		self.assertEqual(index_names(data_engine, "Book_co_authors_mapping"), {"ix_Book_co_authors_mapping_co_authors_fk"})
+		data_engine.merge(Book(title="Book", author=Author(name="A", email="a@example.com")))
+		data_engine.merge(Author(name="B", email="a@example.com"))
+		data_engine.dispose()
+
+		# Existing tables get new indexes, unless their rows would break them:
+		DATA, Author, Book = define_classes(True)
+		with self.assertRaises(Exception):
+			DATAEngine(DATA, engine_str='sqlite:///test_indexes.db', should_backup=False, auto_replace_database_fallback=False)
+		data_engine = DATAEngine(DATA, engine_str='sqlite:///test_indexes.db', should_backup=False, auto_add_new_columns=False)
+		with data_engine.session() as session:
+			session.query(Author).filter_by(name="B").delete()
+			session.commit()
+		data_engine.dispose()
+
+		data_engine = DATAEngine(DATA, engine_str='sqlite:///test_indexes.db', should_backup=False, auto_replace_database_fallback=False)
+		self.assertEqual(index_names(data_engine, "Book_Table"), {
+			"ix_Book_Table_author_fk", "ix_Book_Table_title",
+			"ix_Book_Table_author_published", "title_edition"
+		})
+		self.assertEqual(index_names(data_engine, "Author_Table"), {"uq_Author_Table_email"})
+		with self.assertRaises(Exception):
+			data_engine.merge(Author(name="C", email="a@example.com"))
+		data_engine.dispose()
+
+	def test_query(self):
+		from sqlalchemy import event
+		from sqlalchemy.orm.exc import DetachedInstanceError
+
+		DATA = DATADecorator()
+
+		@DATA
+		class Tag:
+			name: str
+
+		@DATA
+		class Message:
+			text: str
+			tags: List[Tag] = field(default_factory=list)
+			prev: 'Message' = None
+
+		@DATA
+		class Reply(Message):
+			quoted: Message = None
+
+		@DATA
+		class Conversation:
+			name: str
+			messages: List[Message] = field(default_factory=list)
+
+		data_engine = DATAEngine(DATA)
+		for i in range(5):
+			message = Message(text=f"Hi {i}", tags=[Tag(name="greeting")])
+			reply = Reply(text=f"Hello {i}", prev=message, quoted=message, tags=[Tag(name="reply")])
+			data_engine.merge(Conversation(name=f"Conversation {i}", messages=[message, reply]))
+
+		statements = []
+		event.listen(data_engine.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+		data_engine.query(Conversation).filter_by(name="Conversation 0").all()
+		statement_count = len(statements)
+		statements.clear()
+		conversations = data_engine.query(Conversation).where(Conversation.name != "Conversation 0").order_by(Conversation.name).all()
+		# The number of statements depends on the loading plan, not on the number of objects:
+		self.assertEqual(len(statements), statement_count)
+		self.assertLessEqual(statement_count, 5)
+
+		self.assertEqual([conversation.name for conversation in conversations], [f"Conversation {i}" for i in range(1, 5)])
+		message, reply = conversations[0].messages
+		self.assertIsInstance(reply, Reply)
+		self.assertIs(reply.prev, message)
+		self.assertIs(reply.quoted, message)
+		self.assertEqual(reply.tags[0].name, "reply")
+		self.assertEqual(message.tags[0].name, "greeting")
+		self.assertTrue(data_engine.is_clean(conversations[0]))
+		self.assertTrue(data_engine.is_clean(reply))
+
+		reply = data_engine.query(Message, depth=1).filter_by(text="Hello 2").first()
+		self.assertIsInstance(reply, Reply)
+		self.assertEqual(reply.quoted.text, "Hi 2")
+		with self.assertRaises(DetachedInstanceError):
+			reply.quoted.tags
+		self.assertIsNone(data_engine.query(Message).filter_by(text="Bye").first())
+
+	def test_load_strategies(self):
+		from sqlalchemy import event
+		from sqlalchemy.exc import InvalidRequestError
+
+		DATA = DATADecorator()
+
+		@DATA
+		class Label:
+			name: str
+
+		@DATA
+		class Document:
+			title: str
+			labels: List[Label] = field(default_factory=list, metadata={"load": "selectin"})
+			source: 'Document' = field(default=None, metadata={"load": "raise"})
+
+		data_engine = DATAEngine(DATA)
+		original = Document(title="Original", labels=[Label(name="first")])
+		for i in range(4):
+			data_engine.merge(Document(title=f"Copy {i}", labels=[Label(name="copy"), Label(name=f"{i}")], source=original))
+
+		statements = []
+		event.listen(data_engine.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+		with data_engine.session() as session:
+			documents = session.query(Document).filter(Document.title != "Original").all()
+			self.assertEqual(len(statements), 2)
+			self.assertEqual([label.name for label in documents[2].labels], ["copy", "2"])
+			self.assertEqual(len(statements), 2)
+			with self.assertRaises(InvalidRequestError):
+				documents[0].source
+
+		# Queries use the field's strategy rather than their default plan:
+		statements.clear()
+		copy = data_engine.query(Document).filter_by(title="Copy 1").first()
+		self.assertEqual(len(statements), 2)
+		self.assertEqual(len(copy.labels), 2)
+
+		# Merging still works with raise loaded fields:
+		copy.title = "Copy 1b"
+		data_engine.merge(copy)
+		with data_engine.session() as session:
+			self.assertEqual(session.query(Document).filter_by(title="Copy 1b").count(), 1)
+			self.assertEqual(session.query(Document).filter_by(title="Copy 1b").first().source_fk, original.auto_id)
+
+		Bad_DATA = DATADecorator()
+		@Bad_DATA
+		class Bad:
+			other: 'Bad' = field(default=None, metadata={"load": "eager"})
+		with self.assertRaises(ValueError):
+			DATAEngine(Bad_DATA)
+
+	def test_identity_cache(self):
+		from sqlalchemy import event
+		from ClassyFlaskDB.DATA import IdentityCache
+
+		DATA = DATADecorator()
+
+		@DATA(generated_id_type=ID_Type.HASHID)
+		class Config:
+			model: str
+
+		@DATA
+		class Setting:
+			value: str
+
+		@DATA
+		class Profile:
+			name: str
+			config: Config = None
+			settings: List[Setting] = field(default_factory=list)
+
+		cache = IdentityCache(max_count=2)
+		data_engine = DATAEngine(DATA, identity_cache=cache)
+		config = Config(model="big")
+		profiles = [Profile(name=f"Profile {i}", config=config, settings=[Setting(value=f"{i}")]) for i in range(3)]
+		data_engine.merge_all(profiles)
+
+		statements = []
+		event.listen(data_engine.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+		profile = data_engine.get(Profile, profiles[0].auto_id)
+		self.assertEqual(profile.settings[0].value, "0")
+		self.assertGreater(len(statements), 0)
+		statements.clear()
+		self.assertIs(data_engine.get(Profile, profiles[0].auto_id), profile)
+		self.assertEqual(statements, [])
+		self.assertEqual(cache.hits, 1)
+
+		# Writing anything an entry holds drops the entry, but HASHID objects never change:
+		data_engine.merge(Config(model="big"))
+		self.assertIs(data_engine.get(Profile, profiles[0].auto_id), profile)
+		profiles[0].settings[0].value = "changed"
+		data_engine.merge(profiles[0].settings[0])
+		reloaded = data_engine.get(Profile, profiles[0].auto_id)
+		self.assertIsNot(reloaded, profile)
+		self.assertEqual(reloaded.settings[0].value, "changed")
+
+		# Objects changed since they were cached are not served:
+		reloaded.name = "Renamed"
+		self.assertEqual(data_engine.get(Profile, profiles[0].auto_id).name, "Profile 0")
+		reloaded = data_engine.get(Profile, profiles[0].auto_id)
+		reloaded.settings[0].value = "unsaved"
+		self.assertEqual(data_engine.get(Profile, profiles[0].auto_id).settings[0].value, "changed")
+
+		# Shallower entries don't satisfy deeper gets:
+		statements.clear()
+		data_engine.get(Profile, profiles[1].auto_id, depth=0)
+		data_engine.get(Profile, profiles[1].auto_id, depth=1)
+		self.assertEqual(len([s for s in statements if s.startswith("SELECT")]), 3)
+
+		# Least recently used entries are evicted:
+		data_engine.get(Profile, profiles[2].auto_id)
+		self.assertEqual(len(cache), 2)
+		self.assertIsNone(cache.get(Profile, profiles[0].auto_id))
+
+		cache.max_bytes = 1
+		data_engine.get(Profile, profiles[0].auto_id)
+		self.assertEqual(len(cache), 0)
+
+	def test_iter(self):
+		from sqlalchemy import event
+		from sqlalchemy.orm.attributes import instance_state
+
+		DATA = DATADecorator()
+
+		@DATA
+		class Attachment:
+			path: str
+
+		@DATA
+		class LogEntry:
+			level: int
+			message: str
+			files: List[Attachment] = field(default_factory=list)
+
+		data_engine = DATAEngine(DATA)
+		data_engine.add_all([
+			LogEntry(level=i % 3, message=f"Entry {i}", files=[Attachment(path=f"{i}.txt")])
+			for i in range(25)
+		])
+
+		statements = []
+		event.listen(data_engine.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+		entries = []
+		for entry in data_engine.iter(LogEntry, batch_size=10, load_lists=True):
+			self.assertTrue(instance_state(entry).detached)
+			entries.append(entry)
+		self.assertEqual(len(entries), 25)
+		self.assertEqual(sorted(int(entry.files[0].path.split(".")[0]) for entry in entries), list(range(25)))
+		# One statement for the entries, and one per batch for their files:
+		self.assertEqual(len(statements), 4)
+		self.assertTrue(data_engine.is_clean(entries[0]))
+
+		errors = list(data_engine.iter(LogEntry, batch_size=4, where=LogEntry.level == 2))
+		self.assertEqual(len(errors), 8)
+		self.assertTrue(all(entry.level == 2 for entry in errors))
+		self.assertEqual(len(list(data_engine.iter(LogEntry, where=[LogEntry.level == 2, LogEntry.message == "Entry 2"]))), 1)
+
+	def test_page(self):
+		DATA = DATADecorator()
+
+		@DATA
+		class Post:
+			title: str
+			posted: datetime = field(default=None, metadata={"index": True})
+
+		data_engine = DATAEngine(DATA)
+		start = datetime(2024, 1, 1)
+		# Pairs of posts share a date, so the primary key has to break ties:
+		data_engine.add_all([Post(title=f"Post {i}", posted=start + timedelta(days=i // 2)) for i in range(15)])
+
+		titles = []
+		cursor = None
+		pages = 0
+		while True:
+			page = data_engine.page(Post, order_by="posted", after=cursor, limit=4)
+			pages += 1
+			self.assertLessEqual(len(page.items), 4)
+			titles.extend(post.title for post in page.items)
+			cursor = page.next_cursor
+			if cursor is None:
+				break
+		self.assertEqual(pages, 4)
+		self.assertEqual(len(titles), 15)
+		self.assertEqual(len(set(titles)), 15)
+		self.assertEqual(sorted(titles, key=lambda title: int(title.split()[1]) // 2), titles)
+
+		page = data_engine.page(Post, order_by="posted", limit=3, descending=True)
+		self.assertEqual(page.items[0].title, "Post 14")
+		page = data_engine.page(Post, order_by="posted", after=page.next_cursor, limit=20, descending=True)
+		self.assertEqual(len(page.items), 12)
+		self.assertIsNone(page.next_cursor)
+		self.assertEqual(page.items[-1].posted.replace(tzinfo=None), start)
+
+		filtered = data_engine.page(Post, order_by="posted", limit=20, where=Post.title != "Post 0")
+		self.assertEqual(len(filtered.items), 14)
+
+		with self.assertRaises(ValueError):
+			data_engine.page(Post, order_by="title", after=data_engine.page(Post, order_by="posted", limit=2).next_cursor)
+
+	def test_deferred_fields(self):
+		from sqlalchemy import event
+		from sqlalchemy.orm.exc import DetachedInstanceError
+
+		DATA = DATADecorator()
+
+		@DATA
+		class Document:
+			title: str
+			content: str = field(default=None, metadata={"deferred": True})
+			json_data: dict = field(default=None, metadata={"deferred": True})
+
+		@DATA
+		class Folder:
+			name: str
+			documents: List[Document] = field(default_factory=list)
+
+		data_engine = DATAEngine(DATA)
+		folder = Folder(name="Folder", documents=[
+			Document(title=f"Document {i}", content="x" * 1000, json_data={"i": i})
+			for i in range(5)
+		])
+		data_engine.add(folder)
+
+		statements = []
+		event.listen(data_engine.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+		documents = data_engine.query(Document).order_by(Document.title).all()
+		self.assertTrue(all("content" not in statement for statement in statements))
+		with self.assertRaises(DetachedInstanceError):
+			documents[0].content
+
+		# Deferred fields load when they are accessed in a session:
+		with data_engine.session() as session:
+			document = session.query(Document).filter(Document.title == "Document 1").first()
+			self.assertNotIn("content", document.__dict__)
+			self.assertEqual(document.content, "x" * 1000)
+
+		# Or all at once:
+		statements.clear()
+		data_engine.undefer(documents)
+		self.assertEqual(len(statements), 1)
+		self.assertEqual([document.json_data["i"] for document in documents], list(range(5)))
+		self.assertNotIn("content", data_engine.get_dirty_fields(documents[0]))
+
+		undeferred = data_engine.query(Document).undefer("content").first()
+		self.assertEqual(undeferred.content, "x" * 1000)
+		self.assertNotIn("json_data", undeferred.__dict__)
+		projected = data_engine.query(Folder).defer("name").first()
+		self.assertNotIn("name", projected.__dict__)
+		self.assertEqual(len(projected.documents), 5)
+
+		# Writing objects leaves the fields they never loaded as they are:
+		loaded = data_engine.query(Document).order_by(Document.title).all()
+		for document in loaded:
+			document.title = document.title + "!"
+		data_engine.shallow_merge_all(loaded)
+		data_engine.upsert_all(loaded)
+		data_engine.merge(loaded[0])
+		data_engine.undefer(loaded)
+		self.assertEqual([document.title for document in loaded], [f"Document {i}!" for i in range(5)])
+		self.assertEqual([document.content for document in loaded], ["x" * 1000] * 5)
+
+		with self.assertRaises(ValueError):
+			data_engine.query(Folder).defer("documents")
+
+	def test_materialize(self):
+		from enum import Enum
+		from sqlalchemy.orm.attributes import instance_state
+
+		DATA = DATADecorator()
+
+		class Mood(Enum):
+			HAPPY = "happy"
+			SAD = "sad"
+
+		@DATA
+		class Person:
+			name: str
+			mood: Mood = Mood.HAPPY
+			born: datetime = None
+			settings: dict = None
+
+		@DATA
+		class Message:
+			text: str
+			author: Person
+			readers: List[Person] = field(default_factory=list)
+
+		data_engine = DATAEngine(DATA)
+		alice = Person(name="Alice", mood=Mood.SAD, born=datetime(1990, 5, 4, 3, 2, 1), settings={"theme": "dark"})
+		bob = Person(name="Bob")
+		data_engine.add_all([
+			Message(text="Hi", author=alice, readers=[bob, alice]),
+			Message(text="Bye", author=alice),
+		])
+
+		with data_engine.session() as session:
+			messages = session.query(Message).order_by(Message.text.desc()).all()
+			for message in messages:
+				message.author
+			copies = materialize_all(messages)
+			deep_copies = [deepcopy(message) for message in messages]
+
+		for copy, deep_copy in zip(copies, deep_copies):
+			self.assertTrue(instance_state(copy).transient)
+			self.assertEqual(copy.get_primary_key(), deep_copy.get_primary_key())
+			self.assertEqual(copy.text, deep_copy.text)
+			self.assertEqual(copy.author.name, deep_copy.author.name)
+			self.assertEqual(copy.author.mood, Mood.SAD)
+			self.assertEqual(copy.author.born, deep_copy.author.born)
+			self.assertEqual(copy.author.settings, {"theme": "dark"})
+		# Objects shared by the originals are shared by their copies:
+		self.assertIs(copies[0].author, copies[1].author)
+		self.assertIsNot(copies[0].author.settings, messages[0].author.settings)
+		# Lists that were not loaded are not either:
+		self.assertNotIn("readers", copies[0].__dict__)
+
+		with data_engine.session() as session:
+			message = session.query(Message).filter(Message.text == "Hi").first()
+			copy = materialize(message, load=True)
+		self.assertEqual([reader.name for reader in copy.readers], ["Bob", "Alice"])
+		self.assertIs(copy.readers[1], copy.author)
+
+		# The copies can be written like any other object:
+		copy.text = "Hello"
+		data_engine.merge(copy)
+		self.assertEqual(data_engine.query(Message).where(Message.text == "Hello").first().readers[0].name, "Bob")
+
+	def test_fetch_graph(self):
+		from sqlalchemy import event
+
+		DATA = DATADecorator()
+
+		@DATA
+		class Thing:
+			name: str
+			source: "Thing" = field(default=None, kw_only=True)
+			tags: List["Label"] = field(default_factory=list, kw_only=True)
+
+		@DATA
+		class Label:
+			key: str
+
+		@DATA
+		class Edit(Thing):
+			original: Thing = None
+
+		DATA.finalize(globals())
+		data_engine = DATAEngine(DATA)
+
+		def edit_history(length:int) -> Thing:
+			thing = Thing(name="v0", tags=[Label(key="first")])
+			for i in range(1, length+1):
+				thing = Thing(name=f"v{i}", source=Edit(name=f"edit {i}", original=thing), tags=[Label(key=f"tag {i}")])
+			return thing
+
+		statements = []
+		event.listen(data_engine.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+		def fetch(thing:Thing) -> Thing:
+			data_engine.add(thing)
+			statements.clear()
+			return data_engine.fetch_graph(Thing, thing.get_primary_key())
+
+		short = fetch(edit_history(3))
+		short_statements = len(statements)
+		latest = fetch(edit_history(20))
+		# The number of statements does not depend on how far the graph goes:
+		self.assertEqual(len(statements), short_statements)
+
+		self.assertEqual(short.source.original.source.original.name, "v1")
+		thing = latest
+		names = []
+		while thing is not None:
+			names.append(thing.name)
+			self.assertEqual(len(thing.tags), 1)
+			self.assertTrue(data_engine.is_clean(thing))
+			thing = thing.source.original if thing.source is not None else None
+		self.assertEqual(names, [f"v{i}" for i in range(20, -1, -1)])
+		self.assertEqual(len(statements), short_statements)
+
+		# Only the fields given are followed:
+		partial = data_engine.fetch_graph(Thing, latest.get_primary_key(), fields=["source"])
+		self.assertEqual(partial.source.name, "edit 20")
+		self.assertNotIn("original", partial.source.__dict__)
+		self.assertNotIn("tags", partial.__dict__)
+
+		self.assertIsNone(data_engine.fetch_graph(Thing, "missing"))
+		self.assertIsNone(data_engine.fetch_graph(Edit, latest.get_primary_key()))
+
+		# Each step of the CTE looks rows up by their keys, rather than
+		# scanning tables, so unrelated rows do not slow it down:
+		executed = []
+		event.listen(data_engine.engine, "before_cursor_execute", lambda connection, cursor, statement, parameters, context, executemany: executed.append((statement, parameters)))
+		data_engine.fetch_graph(Thing, latest.get_primary_key())
+		statement, parameters = next((statement, parameters) for statement, parameters in executed if "reachable" in statement)
+		with data_engine.engine.connect() as connection:
+			plan = [row[3] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+		self.assertEqual([step for step in plan if step.startswith("SCAN") and "reachable" not in step and "CONSTANT ROW" not in step], [])
+
+	def test_aggregates(self):
+		from enum import Enum
+		from sqlalchemy import event
+
+		DATA = DATADecorator()
+
+		class Status(Enum):
+			OPEN = "open"
+			CLOSED = "closed"
+
+		@DATA
+		class Ticket:
+			title: str
+			status: Status = Status.OPEN
+			opened: datetime = None
+
+		@DATA
+		class Bug(Ticket):
+			severity: int = 1
+
+		data_engine = DATAEngine(DATA)
+		self.assertFalse(data_engine.has_data())
+		start = datetime(2024, 3, 1)
+		data_engine.add_all([Ticket(title=f"Ticket {i}", status=Status.CLOSED if i % 3 == 0 else Status.OPEN, opened=start + timedelta(days=i)) for i in range(6)])
+		data_engine.add_all([Bug(title=f"Bug {i}", severity=i, opened=start - timedelta(days=i)) for i in range(4)])
+		self.assertTrue(data_engine.has_data())
+
+		loaded = []
+		event.listen(Ticket, "load", lambda target, context: loaded.append(target), propagate=True)
+
+		self.assertEqual(data_engine.count(Ticket), 10)
+		self.assertEqual(data_engine.count(Bug), 4)
+		self.assertEqual(data_engine.count(Ticket, where=Ticket.title.like("Bug%")), 4)
+		self.assertEqual(data_engine.count(Bug, where=[Bug.severity >= 1, Bug.severity < 3]), 2)
+		self.assertEqual(data_engine.query(Ticket).limit(3).count(), 3)
+		self.assertTrue(data_engine.exists(Bug, where=Bug.severity == 3))
+		self.assertFalse(data_engine.exists(Bug, where=Bug.severity == 4))
+
+		self.assertEqual(data_engine.min(Ticket, "opened"), start - timedelta(days=3))
+		self.assertEqual(data_engine.max(Ticket, "opened"), start + timedelta(days=5))
+		self.assertEqual(data_engine.max(Bug, "opened"), start)
+		self.assertEqual(data_engine.max(Bug, "severity", where=Bug.severity < 3), 2)
+		self.assertIsNone(data_engine.min(Bug, "opened", where=Bug.severity > 10))
+
+		self.assertEqual(data_engine.count_by(Ticket, "status"), {Status.OPEN: 8, Status.CLOSED: 2})
+		self.assertEqual(data_engine.count_by(Ticket, "status", where=Ticket.title.like("Ticket%")), {Status.OPEN: 4, Status.CLOSED: 2})
+		self.assertEqual(loaded, [])
+
+		with self.assertRaises(ValueError):
+			data_engine.max(Ticket, "missing")
+
+	def test_find(self):
+		from enum import Enum
+		from dateutil import tz
+		from sqlalchemy import text
+
+		DATA = DATADecorator()
+
+		class Priority(Enum):
+			LOW = 1
+			HIGH = 2
+
+		@DATA
+		class Owner:
+			name: str
+
+		@DATA
+		class Task:
+			title: str
+			owner: Owner = None
+			priority: Priority = Priority.LOW
+			due: datetime = field(default=None, metadata={"index": True})
+
+		data_engine = DATAEngine(DATA)
+		alice, bob = Owner(name="Alice"), Owner(name="Bob")
+		start = datetime(2024, 6, 1, 9, 0, tzinfo=tz.gettz("America/New_York"))
+		data_engine.add_all([
+			Task(title=f"Task {i}", owner=alice if i % 2 == 0 else bob, priority=Priority.HIGH if i < 3 else Priority.LOW, due=start + timedelta(days=i))
+			for i in range(8)
+		])
+
+		def titles(tasks) -> List[str]:
+			return sorted(task.title for task in tasks)
+
+		self.assertEqual(titles(data_engine.find(Task, owner=alice, priority=Priority.HIGH)), ["Task 0", "Task 2"])
+		self.assertEqual(titles(data_engine.find(Task, owner=bob.get_primary_key(), priority__ne=Priority.HIGH)), ["Task 3", "Task 5", "Task 7"])
+		self.assertEqual(titles(data_engine.find(Task, due__gte=start + timedelta(days=5), due__lt=start + timedelta(days=7))), ["Task 5", "Task 6"])
+		self.assertEqual(titles(data_engine.find(Task, due=start + timedelta(days=1))), ["Task 1"])
+		self.assertEqual(titles(data_engine.find(Task, title__in=["Task 1", "Task 4"], owner__in=[alice])), ["Task 4"])
+		self.assertEqual(data_engine.find(Task, owner=None), [])
+		self.assertEqual(data_engine.query(Task).find(due__gt=start).count(), 7)
+		self.assertEqual(data_engine.query(Task).filter_by(priority=Priority.HIGH).count(), 3)
+
+		# The filters run in SQL, on the indexed column:
+		stmt = data_engine.query(Task).find(due__gte=start).statement().compile(data_engine.engine, compile_kwargs={"literal_binds": True})
+		with data_engine.engine.connect() as connection:
+			plan = " ".join(str(row) for row in connection.execute(text(f"EXPLAIN QUERY PLAN {stmt}")))
+		self.assertIn("ix_Task_Table_due", plan)
+
+		with self.assertRaises(ValueError):
+			data_engine.find(Task, missing=1)
+
+	def test_to_json_without_an_engine(self):
+		from enum import Enum
+		from ClassyFlaskDB.DATA.table_json import to_table_json
+
+		DATA = DATADecorator()
+
+		class Kind(Enum):
+			TEXT = "text"
+			IMAGE = "image"
+
+		@DATA
+		class Part:
+			kind: Kind
+			data: dict = None
+
+		@DATA
+		class Note:
+			text: str
+			written: datetime = None
+			parts: List[Part] = field(default_factory=list)
+			reply_to: "Note" = None
+
+		@DATA
+		class PinnedNote(Note):
+			pinned: bool = True
+
+		DATA.finalize()
+		shared = Part(kind=Kind.IMAGE, data={"url": "a.png"})
+		first = Note(text="First", written=datetime(2024, 1, 2, 3, 4, 5), parts=[Part(kind=Kind.TEXT), shared])
+		pinned = PinnedNote(text="Pinned", reply_to=first, parts=[shared, shared])
+
+		def engine_json(obj) -> dict:
+			engine = DATAEngine(DATA)
+			engine.merge(deepcopy(obj))
+			json_data = engine.to_json()
+			engine.dispose()
+			return json_data
+
+		def sort_rows(json_data:dict) -> dict:
+			return {table_name: sorted(rows, key=lambda row: json.dumps(row, sort_keys=True, cls=JSONEncoder)) for table_name, rows in json_data.items()}
+
+		for obj in [first, pinned]:
+			self.assertEqual(sort_rows(to_table_json(obj, DATA.mapper_registry.metadata)), sort_rows(engine_json(obj)))
+		self.assertEqual(pinned.to_json()["obj"]["Note_Table"][0]["__cls_type__"], "PinnedNote")
+		self.assertEqual(PinnedNote.from_json(pinned.to_json()).reply_to.parts[1].data, {"url": "a.png"})
+
+	def test_from_json_parity(self):
+		from enum import Enum
+		from dateutil import tz
+		from sqlalchemy.orm.attributes import instance_state
+		from ClassyFlaskDB.DATA.table_json import to_table_json, from_table_json
+
+		DATA = DATADecorator()
+
+		class Mood(Enum):
+			CALM = "calm"
+			ANGRY = "angry"
+
+		@DATA
+		class Animal:
+			name: str
+			born: datetime = None
+			friend: "Animal" = None
+
+		@DATA
+		class Dog(Animal):
+			mood: Mood = Mood.CALM
+			toys: List["Toy"] = field(default_factory=list)
+
+		@DATA
+		class Toy:
+			label: str
+			specs: dict = None
+			owner: Animal = None
+
+		@DATA
+		class Kennel:
+			residents: List[Animal] = field(default_factory=list)
+			favorite: Dog = None
+
+		DATA.finalize()
+
+		def engine_from_json(json_data:dict, cls:type):
+			engine = DATAEngine(DATA)
+			engine.insert_json(json_data["obj"])
+			pk_column = cls.__table__.c[cls.FieldsInfo.primary_key_name]
+			with engine.session() as session:
+				obj = materialize(session.query(cls).filter(pk_column == json_data["primary_key"]).first(), load=True)
+			engine.dispose()
+			return obj
+
+		def rows(obj) -> dict:
+			return {
+				table_name: sorted(table_rows, key=lambda row: json.dumps(row, sort_keys=True, cls=JSONEncoder))
+				for table_name, table_rows in to_table_json(obj, DATA.mapper_registry.metadata).items()
+			}
+
+		rex = Dog(name="Rex", born=datetime(2020, 2, 2, 8, 30, tzinfo=tz.gettz("Europe/Paris")), mood=Mood.ANGRY)
+		tom = Animal(name="Tom", friend=rex)
+		rex.friend = tom
+		rex.toys = [Toy(label="Ball", specs={"size": 3}, owner=rex), Toy(label="Rope")]
+		kennel = Kennel(residents=[rex, tom, Animal(name="Stray")], favorite=rex)
+
+		for obj in [kennel, rex, tom, rex.toys[0], Kennel()]:
+			for json_data in [obj.to_json(), json.loads(json.dumps(obj.to_json(), cls=JSONEncoder))]:
+				direct = from_table_json(json_data["obj"], type(obj), json_data["primary_key"])
+				self.assertEqual(rows(direct), rows(engine_from_json(json_data, type(obj))))
+				self.assertEqual(rows(direct), rows(obj))
+				self.assertTrue(instance_state(direct).transient)
+
+		copy = Kennel.from_json(kennel.to_json())
+		self.assertIsInstance(copy.residents[0], Dog)
+		self.assertIs(copy.favorite, copy.residents[0])
+		self.assertIs(copy.favorite.friend.friend, copy.favorite)
+		self.assertIs(copy.favorite.toys[0].owner, copy.favorite)
+		self.assertEqual(copy.favorite.mood, Mood.ANGRY)
+		self.assertEqual(copy.favorite.born, rex.born)
+		self.assertEqual(copy.favorite.toys[0].specs, {"size": 3})
+		self.assertIsNone(copy.favorite.toys[1].owner)
+
+		self.assertIsNone(Dog.from_json({"primary_key": tom.get_primary_key(), "type": "Dog", "obj": tom.to_json()["obj"]}))
+		self.assertIsNone(from_table_json({}, Kennel, "missing"))
+
+		# The copies can be stored like any other object:
+		data_engine = DATAEngine(DATA)
+		data_engine.merge(copy)
+		self.assertEqual(data_engine.count(Animal), 3)
+
+	def test_scratch_engine_pool(self):
+		from concurrent.futures import ThreadPoolExecutor
+		from sqlalchemy import String
+
+		DATA = DATADecorator()
+
+		@DATA
+		class Setting:
+			key: str = field(default=None, metadata={"type": String})
+			value: str = None
+
+		@DATA
+		class Profile:
+			name: str
+			settings: List[Setting] = field(default_factory=list)
+
+		pool = DATA.scratch_engines
+		with pool.engine() as first:
+			first.merge(Profile(name="Ann"))
+			self.assertEqual(first.count(Profile), 1)
+		with pool.engine() as second:
+			# The same engine, emptied:
+			self.assertIs(second, first)
+			self.assertFalse(second.has_data())
+
+		# Custom column types keep to_json and from_json on the (pooled) engines:
+		self.assertTrue(DATA._json_needs_engine())
+		def round_trip(i:int) -> str:
+			profile = Profile(name=f"Profile {i}", settings=[Setting(key="theme", value=str(i))])
+			copy = Profile.from_json(profile.to_json())
+			return f"{copy.name}:{copy.settings[0].value}"
+		with ThreadPoolExecutor(max_workers=4) as executor:
+			results = list(executor.map(round_trip, range(40)))
+		self.assertEqual(results, [f"Profile {i}:{i}" for i in range(40)])
+		# Every thread used the one pool:
+		self.assertIs(DATA.scratch_engines, pool)
+		self.assertLessEqual(len(pool._idle), pool.max_idle)
+
+		# Classes decorated later get tables in engines made before them:
+		@DATA
+		class Late:
+			note: str
+		DATA.finalize()
+		late = Late(note="later")
+		self.assertEqual(Late.from_json(late.to_json()).note, "later")
+		pool.dispose()
+
+	def test_export_and_restore(self):
+		import io
+		import os
+		import tempfile
+
+		DATA = DATADecorator()
+
+		@DATA
+		class Entry:
+			text: str
+			logged: datetime = None
+			extra: dict = None
+
+		@DATA
+		class Log:
+			name: str
+			entries: List[Entry] = field(default_factory=list)
+
+		data_engine = DATAEngine(DATA)
+		start = datetime(2024, 5, 6, 7, 8, 9, 10)
+		logs = [Log(name=f"Log {i}", entries=[Entry(text=f"Entry {i}.{j}\nwith, a \"line\"", logged=start + timedelta(minutes=j), extra={"j": [j]}) for j in range(7)]) for i in range(5)]
+		data_engine.add_all(logs)
+
+		stream = io.StringIO()
+		data_engine.export(stream, chunk_size=4)
+		# It is the same JSON to_json returns:
+		exported = json.loads(stream.getvalue())
+		self.assertEqual(set(exported.keys()), set(data_engine.to_json().keys()))
+		self.assertEqual(len(exported["Entry_Table"]), 35)
+
+		def check(engine:DATAEngine) -> None:
+			self.assertEqual(engine.count(Entry), 35)
+			log = engine.query(Log).find(name="Log 3").first()
+			self.assertEqual([entry.text for entry in log.entries], [f"Entry 3.{j}\nwith, a \"line\"" for j in range(7)])
+			self.assertEqual(log.entries[2].logged, start + timedelta(minutes=2))
+			self.assertEqual(log.entries[2].extra, {"j": [2]})
+
+		with tempfile.TemporaryDirectory() as temp_dir:
+			path = os.path.join(temp_dir, "export.json")
+			data_engine.export(path)
+
+			restored = DATAEngine(DATA)
+			restored.restore(path, chunk_size=3)
+			check(restored)
+
+			from_json = DATAEngine(DATA)
+			with open(path) as file:
+				from_json.insert_json(json.load(file))
+			check(from_json)
+
+		with self.assertRaises(ValueError):
+			DATAEngine(DATA).restore(io.StringIO("[]"))
+
+	def test_insert_json_in_foreign_key_order(self):
+		DATA = DATADecorator()
+
+		@DATA
+		class Part:
+			name: str
+			made: datetime = None
+
+		@DATA
+		class Machine:
+			name: str
+			main_part: Part = None
+			parts: List[Part] = field(default_factory=list)
+
+		source_engine = DATAEngine(DATA)
+		made = datetime(2023, 1, 2, 3, 4, 5)
+		machines = [Machine(name=f"Machine {i}", main_part=Part(name=f"Main {i}", made=made), parts=[Part(name=f"Part {i}.{j}") for j in range(5)]) for i in range(4)]
+		source_engine.add_all(machines)
+		json_data = source_engine.to_json()
+
+		# Tables that are referenced come last, and rows have different columns:
+		json_data = {name: json_data[name] for name in sorted(json_data.keys(), key=lambda name: name.startswith("Part"))}
+		for row in json_data["Part_Table"][::2]:
+			if row["name"].startswith("Part"):
+				del row["made__DateTimeObj"]
+		# Mapping rows from before lists had positions:
+		for row in json_data["Machine_parts_mapping"]:
+			del row["position"]
+
+		data_engine = DATAEngine(DATA)
+		# The in memory database keeps the one connection it was made on:
+		with data_engine.engine.connect() as connection:
+			connection.exec_driver_sql("PRAGMA foreign_keys=ON")
+			self.assertEqual(connection.exec_driver_sql("PRAGMA foreign_keys").scalar(), 1)
+
+		data_engine.insert_json(json_data, chunk_size=3)
+		self.assertEqual(data_engine.count(Part), 24)
+		machine = data_engine.query(Machine).find(name="Machine 2").first()
+		self.assertEqual(machine.main_part.made, made)
+		self.assertEqual([part.name for part in machine.parts], [f"Part 2.{j}" for j in range(5)])
+
+	def test_insert_json_keeps_row_order(self):
+		DATA = DATADecorator()
+
+		@DATA
+		class Step:
+			name: str
+			done: datetime = None
+			previous: "Step" = None
+
+		source_engine = DATAEngine(DATA)
+		done = datetime(2022, 2, 3, 4, 5, 6)
+		step = None
+		for i in range(10):
+			step = Step(name=f"Step {i}", done=done, previous=step)
+		source_engine.merge(step)
+		rows = {row["name"]: row for row in source_engine.to_json()["Step_Table"]}
+
+		# Each step comes after the one it references, and rows alternate
+		# between having a done column and not:
+		ordered = [rows[f"Step {i}"] for i in range(10)]
+		for row in ordered[1::2]:
+			del row["done__DateTimeObj"]
+
+		data_engine = DATAEngine(DATA)
+		with data_engine.engine.connect() as connection:
+			connection.exec_driver_sql("PRAGMA foreign_keys=ON")
+
+		data_engine.insert_json({"Step_Table": ordered}, chunk_size=4)
+		with data_engine.engine.connect() as connection:
+			names = [row[0] for row in connection.exec_driver_sql('SELECT name FROM "Step_Table" ORDER BY rowid')]
+		self.assertEqual(names, [f"Step {i}" for i in range(10)])
+		last = data_engine.query(Step).find(name="Step 9").first()
+		self.assertEqual(last.previous.name, "Step 8")
+		self.assertEqual(last.previous.done, done)
+		self.assertIsNone(last.previous.previous.done)
+
+	def test_replacing_a_database_from_before_list_positions(self):
+		import os
+		import sqlite3
+		import tempfile
+
+		with tempfile.TemporaryDirectory() as temp_dir:
+			path = os.path.join(temp_dir, "scripts.db")
+			# A database written before lists had positions:
+			connection = sqlite3.connect(path)
+			connection.executescript('''
+				CREATE TABLE "Line_Table" (text TEXT, auto_id TEXT NOT NULL PRIMARY KEY);
+				CREATE TABLE "Script_Table" (name TEXT, auto_id TEXT NOT NULL PRIMARY KEY);
+				CREATE TABLE "Script_lines_mapping" (
+					"Script_fk" TEXT NOT NULL REFERENCES "Script_Table" (auto_id),
+					lines_fk TEXT NOT NULL REFERENCES "Line_Table" (auto_id),
+					PRIMARY KEY ("Script_fk", lines_fk)
+				);
+				INSERT INTO "Script_Table" VALUES ('Opening', 's1'), ('Closing', 's2');
+				INSERT INTO "Line_Table" VALUES ('Hello', 'l1'), ('There', 'l2'), ('Goodbye', 'l3');
+				INSERT INTO "Script_lines_mapping" VALUES ('s1', 'l2'), ('s2', 'l3'), ('s1', 'l1');
+			''')
+			connection.commit()
+			connection.close()
+
+			DATA = DATADecorator()
+
+			@DATA
+			class Speaker:
+				name: str
+
+			@DATA
+			class Line:
+				text: str
+				# A new foreign key, which makes the engine replace the database
+				# before it gets to adding the list's position column:
+				speaker: Speaker = None
+
+			@DATA
+			class Script:
+				name: str
+				lines: List[Line] = field(default_factory=list)
+
+			data_engine = DATAEngine(DATA, engine_str=f"sqlite:///{path}", backup_dir=temp_dir)
+			opening = data_engine.query(Script).find(name="Opening").first()
+			self.assertEqual([line.text for line in opening.lines], ["There", "Hello"])
+			self.assertIsNone(opening.lines[0].speaker)
+			self.assertEqual(data_engine.count(Line), 3)
+			data_engine.dispose()
+			self.assertFalse(os.path.exists(f"{path}.replacing"))
+
+	def test_deleted_hash_ids_are_forgotten(self):
+		DATA = DATADecorator()
+
+		@DATA(generated_id_type=ID_Type.HASHID)
+		class Tag:
+			key: str
+
+		@DATA
+		class Note:
+			text: str
+			tag: Tag = None
+
+		data_engine = DATAEngine(DATA)
+		data_engine.merge(Tag(key="x"))
+		self.assertTrue(data_engine.is_known(Tag(key="x")))
+
+		# A delete that is rolled back leaves the tag known:
+		with data_engine.session() as session:
+			session.delete(session.query(Tag).first())
+			session.flush()
+			session.rollback()
+		self.assertTrue(data_engine.is_known(Tag(key="x")))
+
+		with data_engine.session() as session:
+			session.delete(session.query(Tag).first())
+			session.commit()
+		self.assertFalse(data_engine.is_known(Tag(key="x")))
+
+		# So merging an identical tag writes it again:
+		data_engine.merge(Note(text="Hello", tag=Tag(key="x")))
+		self.assertEqual(data_engine.count(Tag), 1)
+		note = data_engine.query(Note).first()
+		self.assertEqual(note.tag.key, "x")
+
+	def test_deferred_queries_are_not_cached(self):
+		DATA = DATADecorator()
+
+		@DATA
+		class Doc:
+			title: str
+			body: str = None
+
+		cache = IdentityCache()
+		data_engine = DATAEngine(DATA, identity_cache=cache)
+		doc = Doc(title="Notes", body="...")
+		data_engine.merge(doc)
+
+		narrowed = data_engine.query(Doc).defer("title").all()
+		self.assertEqual(narrowed[0].body, "...")
+		self.assertEqual(len(cache), 0)
+
+		# get loads the whole object rather than serving the narrowed one:
+		self.assertEqual(data_engine.get(Doc, doc.get_primary_key()).title, "Notes")
+		self.assertEqual(data_engine.get(Doc, doc.get_primary_key()).title, "Notes")
+		self.assertEqual(cache.hits, 1)
+
+		# Undeferring only adds fields, so those results are cached:
+		cache.clear()
+		data_engine.query(Doc).undefer("body").all()
+		self.assertEqual(len(cache), 1)
+
+	def test_lists_with_repeated_items(self):
+		DATA = DATADecorator()
+
+		@DATA
+		class Note:
+			name: str
+
+		@DATA
+		class Song:
+			title: str
+			notes: List[Note] = field(default_factory=list)
+			chorus: List[Note] = field(default_factory=list, metadata={"load": "joined"})
+
+		data_engine = DATAEngine(DATA)
+		a, b = Note(name="a"), Note(name="b")
+		song = Song(title="Round", notes=[a, b, a, b], chorus=[b, b, a])
+		data_engine.merge(song)
+		pk = song.get_primary_key()
+
+		def names(notes:List[Note]) -> List[str]:
+			return [note.name for note in notes]
+
+		with data_engine.session() as session:
+			loaded = session.query(Song).first()
+			self.assertEqual(names(loaded.notes), ["a", "b", "a", "b"])
+			self.assertEqual(names(loaded.chorus), ["b", "b", "a"])
+		self.assertEqual(names(data_engine.query(Song).first().notes), ["a", "b", "a", "b"])
+		self.assertEqual(names(data_engine.get(Song, pk).chorus), ["b", "b", "a"])
+		self.assertEqual(names(next(data_engine.iter(Song, load_lists=True)).notes), ["a", "b", "a", "b"])
+
+		# Copies and JSON keep them too:
+		loaded = data_engine.query(Song).first()
+		self.assertEqual(names(deepcopy(loaded).chorus), ["b", "b", "a"])
+		self.assertEqual(names(Song.from_json(loaded.to_json()).notes), ["a", "b", "a", "b"])
+
+		# Writing a loaded song back keeps every repeat:
+		loaded = data_engine.query(Song).first()
+		loaded.title = "Round 2"
+		data_engine.merge(loaded)
+		with data_engine.engine.connect() as connection:
+			self.assertEqual(connection.exec_driver_sql('SELECT COUNT(*) FROM "Song_notes_mapping"').scalar(), 4)
+		self.assertEqual(names(data_engine.query(Song).first().notes), ["a", "b", "a", "b"])
+
+	def test_default_model_at_default_depth(self):
+		from ClassyFlaskDB.DefaultModel import DATA, DATAEngine, Object, Tag, EditSource
+		from ClassyFlaskDB.DATA.DATAQuery import MAX_JOINED_TABLES
+		from sqlalchemy import event
+		engine = DATAEngine(DATA)
+		
+		first, second = Object(), Object()
+		original = Object(tags=[Tag(key="note", obj=first)])
+		edited = original & Object(tags=[Tag(key="note", obj=second)])
+		engine.merge(edited)
+		
+		statements = []
+		event.listen(engine.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+		objects = {obj.get_primary_key():obj for obj in engine.query(Object).all()}
+		loaded = objects[edited.get_primary_key()]
+		self.assertEqual(loaded.tags[0].obj.get_primary_key(), second.get_primary_key())
+		self.assertEqual(loaded.source.original.tags[0].obj.get_primary_key(), first.get_primary_key())
+		
+		loaded = engine.get(Object, edited.get_primary_key())
+		self.assertIsInstance(loaded.source, EditSource)
+		self.assertEqual(loaded.source.original.get_primary_key(), original.get_primary_key())
+		for statement in statements:
+			self.assertLessEqual(statement.count(" JOIN "), MAX_JOINED_TABLES)
+	
 if __name__ == '__main__':
 	unittest.main()
\ No newline at end of file